@@ -0,0 +1,306 @@
+"""Нагрузочный тест бота: синтетические обновления через настоящий Dispatcher
+и заглушка Bot API в отдельном процессе.
+
+Пример:
+    python benchmark.py --chats 1000,10000,100000 --users 20 --messages-per-chat 5 --output bench.json
+
+Каждый масштаб запускается в отдельном процессе с чистой базой, результаты
+печатаются одним JSON-документом, чтобы их можно было сравнивать между коммитами.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from aiohttp import web, ClientSession, ClientError
+
+BENCH_TOKEN = "123456:BENCHMARK"
+BENCH_CHAT_BASE = -1000000000000
+COMMANDS = ["/top", "/mystats", "/yesterday", "/weekly"]
+JOBS = ["send_hourly_mention", "daily_report", "auto_reset_counters"]
+
+# ==================== ЗАГЛУШКА BOT API ====================
+def run_fake_api(port: int, latency_ms: float):
+    """Сервер, который отвечает на методы Bot API как Telegram, но без лимитов"""
+    calls = {}
+    next_message_id = [0]
+
+    async def handle_method(request):
+        method = request.match_info["method"]
+        calls[method] = calls.get(method, 0) + 1
+        params = await request.post()
+
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+        elif method == "sendMessage":
+            next_message_id[0] += 1
+            result = {
+                "message_id": next_message_id[0],
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "supergroup"},
+                "text": params.get("text", ""),
+            }
+        elif method == "getChatAdministrators":
+            result = []
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_stats(request):
+        return web.json_response(calls)
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handle_method)
+    app.router.add_get("/stats", handle_stats)
+    web.run_app(app, host="127.0.0.1", port=port, print=None, access_log=None)
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def wait_for_api(url: str):
+    async with ClientSession() as session:
+        for _ in range(100):
+            try:
+                async with session.get(f"{url}/stats") as response:
+                    if response.status == 200:
+                        return
+            except ClientError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError("Заглушка Bot API не запустилась")
+
+# ==================== СИНТЕТИЧЕСКИЕ ОБНОВЛЕНИЯ ====================
+def generate_updates(args, chats: int):
+    """Каждый чат получает хотя бы одно сообщение, остальные распределяются случайно"""
+    rng = random.Random(args.seed)
+    total = chats * args.messages_per_chat
+    now = int(time.time())
+
+    for index in range(total):
+        chat_index = index if index < chats else rng.randrange(chats)
+        user_index = rng.randrange(args.users)
+        text = rng.choice(COMMANDS) if rng.random() < args.command_ratio else "сообщение"
+        yield {
+            "update_id": index + 1,
+            "message": {
+                "message_id": index + 1,
+                "date": now,
+                "chat": {"id": BENCH_CHAT_BASE - chat_index, "type": "supergroup",
+                         "title": f"Чат {chat_index}"},
+                "from": {"id": 1 + chat_index * args.users + user_index, "is_bot": False,
+                         "first_name": f"Участник {user_index}"},
+                "text": text,
+            },
+        }
+
+def percentile(sorted_values, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * (len(sorted_values) - 1) + 0.5))]
+
+def db_bytes(path: str) -> int:
+    return sum(os.path.getsize(path + suffix) for suffix in ("", "-wal") if os.path.exists(path + suffix))
+
+# ==================== ЗАМЕР ОДНОГО МАСШТАБА ====================
+async def run_scale(args, chats: int, api_url: str) -> dict:
+    import main
+
+    latencies = {}  # обработчик -> [секунды]
+
+    async def record_handler(handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            name = data["handler"].callback.__name__
+            latencies.setdefault(name, []).append(time.perf_counter() - started)
+
+    await main.init_storage()
+    await main.load_chat_registry()
+    await main.open_journal()
+    main.bot_instance = main.create_bot()
+    main.dp = main.create_dispatcher()
+    main.dp.message.middleware(record_handler)
+
+    result = {
+        "chats": chats,
+        "users_per_chat": args.users,
+        "messages": chats * args.messages_per_chat,
+        "db_bytes": {"initial": db_bytes(main.DB_PATH)},
+    }
+
+    # Подача обновлений: CONCURRENCY задач, как при обработке polling-обновлений задачами
+    updates = generate_updates(args, chats)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    fed = 0
+
+    async def feeder():
+        nonlocal fed
+        for update in updates:
+            if args.rate:
+                delay = started + fed / args.rate - loop.time()
+                fed += 1
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                fed += 1
+            await main.dp.feed_raw_update(main.bot_instance, update)
+
+    await asyncio.gather(*(feeder() for _ in range(args.concurrency)))
+    await main.flush_counters()
+    elapsed = loop.time() - started
+
+    result["wall_seconds"] = round(elapsed, 3)
+    result["messages_per_sec"] = round(result["messages"] / elapsed, 1)
+    result["handlers"] = {
+        name: {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 0.5) * 1000, 3),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+            "max_ms": round(values[-1] * 1000, 3),
+        }
+        for name, values in ((name, sorted(values)) for name, values in latencies.items())
+    }
+    result["db_bytes"]["after_messages"] = db_bytes(main.DB_PATH)
+
+    # Фоновые задачи по одной, в порядке суток
+    result["jobs"] = {}
+    for job in JOBS:
+        job_started = time.perf_counter()
+        await getattr(main, job)()
+        result["jobs"][job] = round(time.perf_counter() - job_started, 3)
+    result["db_bytes"]["after_jobs"] = db_bytes(main.DB_PATH)
+
+    async with ClientSession() as session:
+        async with session.get(f"{api_url}/stats") as response:
+            result["api_calls"] = await response.json()
+
+    await main.bot_instance.session.close()
+    await main.close_storage()
+    return result
+
+async def run_single(args):
+    port = free_port()
+    api_url = f"http://127.0.0.1:{port}"
+    api = subprocess.Popen([
+        sys.executable, os.path.abspath(__file__), "--fake-api", str(port),
+        "--api-latency-ms", str(args.api_latency_ms),
+    ])
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    try:
+        await wait_for_api(api_url)
+
+        # Настройки main читаются при импорте
+        os.environ.update({
+            "BOT_TOKEN": BENCH_TOKEN,
+            "BOT_API_URL": api_url,
+            "DB_PATH": os.path.join(workdir, "stats.db"),
+            "JOURNAL_PATH": os.path.join(workdir, "counters.journal"),
+            # У заглушки нет лимитов Telegram, измеряем сам бот
+            "SEND_GLOBAL_RATE": str(args.send_rate),
+            "SEND_PER_CHAT_RATE": str(args.send_rate),
+        })
+        random.seed(args.seed)
+        return await run_scale(args, args.chats[0], api_url)
+    finally:
+        api.terminate()
+        api.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+# ==================== ЗАПУСК ====================
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота статистики")
+    parser.add_argument("--chats", default="1000,10000,100000",
+                        type=lambda value: [int(item) for item in value.split(",")],
+                        help="масштабы через запятую")
+    parser.add_argument("--users", type=int, default=20, help="участников в чате")
+    parser.add_argument("--messages-per-chat", type=int, default=5, help="сообщений на чат в среднем")
+    parser.add_argument("--command-ratio", type=float, default=0.01, help="доля команд среди сообщений")
+    parser.add_argument("--rate", type=float, default=0, help="сообщений в секунду, 0 - без ограничения")
+    parser.add_argument("--concurrency", type=int, default=64, help="параллельно обрабатываемых обновлений")
+    parser.add_argument("--api-latency-ms", type=float, default=0, help="задержка ответа заглушки Bot API")
+    parser.add_argument("--send-rate", type=float, default=100000, help="лимит рассылок бота во время теста")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="файл для JSON, по умолчанию stdout")
+    parser.add_argument("--fake-api", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    if args.fake_api:
+        run_fake_api(args.fake_api, args.api_latency_ms)
+        return
+
+    if args.single:
+        logging.basicConfig(level=logging.WARNING)
+        print(json.dumps(asyncio.run(run_single(args))))
+        return
+
+    # Каждый масштаб в своем процессе: модуль main хранит состояние в глобальных переменных
+    results = []
+    for chats in args.chats:
+        argv = list(sys.argv[1:])
+        if "--chats" in argv:
+            index = argv.index("--chats")
+            del argv[index:index + 2]
+        argv = [arg for arg in argv if not arg.startswith("--chats=")]
+
+        print(f"Масштаб {chats} чатов...", file=sys.stderr)
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), *argv, "--chats", str(chats), "--single"],
+            stdout=subprocess.PIPE, text=True, check=True
+        )
+        results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "settings": {
+            "users_per_chat": args.users,
+            "messages_per_chat": args.messages_per_chat,
+            "command_ratio": args.command_ratio,
+            "rate": args.rate,
+            "concurrency": args.concurrency,
+            "api_latency_ms": args.api_latency_ms,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
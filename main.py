@@ -1,5 +1,5 @@
 import asyncio
-from aiohttp import web
+from aiohttp import web, ClientSession, ClientError
 import threading
 import logging
 import sqlite3
@@ -7,18 +7,139 @@ import os
 import signal
 import sys
 import random
+import bisect
+import json
+import codecs
+import re
+import hashlib
+import functools
+import secrets
+import struct
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
 from aiogram.enums import ParseMode, ChatType
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 from aiogram import F
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 # ==================== КОНСТАНТЫ ====================
 API_TOKEN = os.getenv("BOT_TOKEN", "8280794130:AAE7VgMxB0mGR2adpu8FR3SBUS-YjKUydjI")
+# Свой сервер Bot API (локальный telegram-bot-api или заглушка бенчмарка); пусто - api.telegram.org
+BOT_API_URL = os.getenv("BOT_API_URL", "")
+
+# Получение обновлений: "polling" - long polling, "webhook" - Telegram присылает
+# обновления на WEBHOOK_URL + WEBHOOK_PATH того же HTTP-сервера, что и /health
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+HTTP_HOST = os.getenv("HTTP_HOST", "0.0.0.0")
+HTTP_PORT = int(os.getenv("PORT", "10000"))
+
+# Догоняющий режим при запуске: сообщения, накопившиеся пока бот был остановлен,
+# учитываются по их собственной дате, если они не старше CATCHUP_MAX_AGE_HOURS
+# (0 - очередь обновлений отбрасывается)
+CATCHUP_MAX_AGE_HOURS = float(os.getenv("CATCHUP_MAX_AGE_HOURS", "24"))
+CATCHUP_BATCH_SIZE = 100  # максимум getUpdates
+# Координатор передает очередь воркерам порциями (каждая - одна транзакция воркера)
+# и сначала ждет, пока воркеры начнут отвечать
+CATCHUP_FORWARD_CHUNK = 2000
+CATCHUP_WORKER_WAIT = 120
+
+# Несколько процессов: координатор получает обновления и передает их воркеру,
+# которому чат назначен консистентным хешированием chat_id
+WORKER_COUNT = max(1, int(os.getenv("WORKER_COUNT", "1")))
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", str(HTTP_PORT + 1)))
+WORKER_SECRET = os.getenv("WORKER_SECRET") or secrets.token_hex(16)
+WORKER_UPDATE_PATH = "/update"
+WORKER_INTERNAL_PATH = "/internal"  # служебные запросы между процессами
+# Задачи над всей базой и импорт истории выполняет только этот воркер
+MAINTENANCE_WORKER = 0
+HASH_RING_VNODES = int(os.getenv("HASH_RING_VNODES", "160"))
+
+# Буферизация счетчиков: сброс в БД раз в N мс или после M сообщений
+COUNTER_FLUSH_INTERVAL_MS = int(os.getenv("COUNTER_FLUSH_INTERVAL_MS", "1000"))
+COUNTER_FLUSH_MAX_MESSAGES = int(os.getenv("COUNTER_FLUSH_MAX_MESSAGES", "500"))
+# Журнал учтенных, но еще не записанных в БД сообщений; пустой путь отключает журнал.
+# Файл сбрасывается на диск раз в N мс: при падении теряется не больше этого интервала
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "counters.journal")
+JOURNAL_FSYNC_INTERVAL_MS = int(os.getenv("JOURNAL_FSYNC_INTERVAL_MS", "200"))
+JOURNAL_BUFFER_SIZE = 64 * 1024
+
+# Метрики: границы корзин гистограмм в секундах
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+JOB_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600)
+
+# Хранилище: "sqlite" - файл DB_PATH, "postgres" - сервер DATABASE_URL
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+PG_POOL_MIN_SIZE = int(os.getenv("PG_POOL_MIN_SIZE", "2"))
+PG_POOL_MAX_SIZE = int(os.getenv("PG_POOL_MAX_SIZE", "10"))
+
+# База данных: один поток записи и пул потоков чтения
+DB_PATH = os.getenv("DB_PATH", "stats.db")
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "65536"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+# История сообщений: "rollup" - почасовые агрегаты, "raw" - строка на каждое сообщение
+HISTORY_STORAGE_MODE = os.getenv("HISTORY_STORAGE_MODE", "rollup")
+# Сколько часов хранить построчную историю перед сверткой (0 - сразу писать агрегаты)
+RAW_HISTORY_RETENTION_HOURS = int(os.getenv("RAW_HISTORY_RETENTION_HOURS", "0"))
+WRITE_RAW_HISTORY = HISTORY_STORAGE_MODE == "raw" or RAW_HISTORY_RETENTION_HOURS > 0
+HISTORY_COMPACTION_CHUNK = int(os.getenv("HISTORY_COMPACTION_CHUNK", "50000"))
+
+# Фоновая сверка total с историей: размер порции и строк за один запуск
+RECONCILE_INTERVAL_MINUTES = int(os.getenv("RECONCILE_INTERVAL_MINUTES", "5"))
+RECONCILE_CHUNK_SIZE = int(os.getenv("RECONCILE_CHUNK_SIZE", "500"))
+RECONCILE_ROWS_PER_RUN = int(os.getenv("RECONCILE_ROWS_PER_RUN", "10000"))
+# Сколько уже учтенных неисправимых расхождений помнить, чтобы не учитывать их повторно
+RECONCILE_TRACKED_ROWS = int(os.getenv("RECONCILE_TRACKED_ROWS", "100000"))
+
+# Кэш рейтингов чатов: лимит записей, примерный объем и время жизни без обращений
+LEADERBOARD_CACHE_MAX_CHATS = int(os.getenv("LEADERBOARD_CACHE_MAX_CHATS", "2000"))
+LEADERBOARD_CACHE_MAX_BYTES = int(os.getenv("LEADERBOARD_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+LEADERBOARD_CACHE_TTL = int(os.getenv("LEADERBOARD_CACHE_TTL", "1800"))
+USER_PROFILE_CACHE_SIZE = int(os.getenv("USER_PROFILE_CACHE_SIZE", "100000"))
+# Кэш администраторов чатов для команд только для админов; сбрасывается обновлениями chat_member
+ADMIN_CACHE_SIZE = int(os.getenv("ADMIN_CACHE_SIZE", "10000"))
+ADMIN_CACHE_TTL = int(os.getenv("ADMIN_CACHE_TTL", "600"))
+# Готовые ответы /top, /status, /yesterday: действуют, пока не изменилась статистика чата,
+# а в течение RESPONSE_COOLDOWN секунд после построения - даже если изменилась
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "20000"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "600"))
+RESPONSE_COOLDOWN = float(os.getenv("RESPONSE_COOLDOWN", "5"))
+
+# Участников на одной странице /top
+TOP_PAGE_SIZE = int(os.getenv("TOP_PAGE_SIZE", "10"))
+
+# Рассылки: общий лимит Bot API (~30 сообщ./с), лимит на чат (20 сообщ./мин в группах),
+# число параллельных отправок и окна, в которые должны уложиться упоминания и отчет
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))
+SEND_PER_CHAT_RATE = float(os.getenv("SEND_PER_CHAT_RATE", str(20 / 60)))
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "50"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+MENTION_FANOUT_WINDOW = int(os.getenv("MENTION_FANOUT_WINDOW", "1800"))
+REPORT_FANOUT_WINDOW = int(os.getenv("REPORT_FANOUT_WINDOW", "1800"))
+
+# Импорт истории из экспортов Telegram Desktop (result.json): папка с файлами,
+# сообщений на одну транзакцию и размер чтения файла
+HISTORY_IMPORT_DIR = os.getenv("HISTORY_IMPORT_DIR", "imports")
+# Импорт читает все файлы папки, поэтому /scan_history доступна только владельцам бота
+# (ID пользователей через запятую)
+BOT_OWNER_IDS = {int(item) for item in os.getenv("BOT_OWNER_IDS", "").replace(" ", "").split(",") if item}
+IMPORT_BATCH_MESSAGES = int(os.getenv("IMPORT_BATCH_MESSAGES", "50000"))
+IMPORT_READ_CHUNK = int(os.getenv("IMPORT_READ_CHUNK", str(1024 * 1024)))
 
 # Настройка логирования
 logging.basicConfig(
@@ -32,12 +153,47 @@ bot_instance = None
 dp = None
 scheduler_instance = None
 is_shutting_down = False
-polling_task = None
-conn = None
-cursor = None
-user_cache = {}
-cache_timeout = 300  # 5 минут
+polling_task = None  # в режиме webhook - future, которая ждет завершения работы
+http_runner = None
+worker_id = None  # номер воркера; None - единственный процесс или координатор
+worker_processes = {}  # номер воркера -> процесс (только в координаторе)
+forward_session = None  # HTTP-сессия для передачи обновлений и служебных запросов воркерам
+storage = None  # выбранная реализация Storage
+conn = None  # соединение для записи, используется только потоком db_writer
+db_writer = None
+db_readers = None
+db_reader_local = threading.local()
+db_reader_connections = []
+flush_seq = 0  # номер последней отправленной на запись пачки счетчиков
+counter_journal = None  # CounterJournal процесса, который ведет буфер счетчиков
+flush_lock = asyncio.Lock()  # запись пачек счетчиков по очереди
 current_mention_type = 0  # 0=предсказание, 1=пожелание, 2=комплимент
+# (chat_id, user_id, day) -> [count, username, first_time, last_time]
+pending_counters = {}
+# Строки для all_messages_history, ожидающие записи
+pending_history = []
+# Настройки чатов в памяти: chat_id -> {'title', 'type', 'is_active', 'enable_mentions'}
+chat_registry = {}
+# chat_id -> время последней активности, ожидающее записи
+pending_chat_activity = {}
+# user_id -> (username, full_name, updated_at), ожидающие записи
+pending_profiles = {}
+# Позиция и результаты фоновой сверки счетчиков
+reconcile_position = None  # позиция сверки, ее формат зависит от хранилища
+reconcile_stats = {
+    "checked_rows": 0,
+    "drift_rows": 0,
+    "drift_messages": 0,
+    "fixed_rows": 0,
+    "full_passes": 0,
+    "last_run": None,
+}
+
+# Импорт истории выполняется строго по одному файлу за раз
+import_lock = asyncio.Lock()
+# Фоновые задачи: ссылки держим до завершения, иначе задачу может собрать сборщик мусора
+background_tasks = set()
+METRICS = []  # все зарегистрированные метрики в порядке вывода
 
 # ==================== СМЕШНЫЕ ПРЕДСКАЗАНИЯ ====================
 FUNNY_PREDICTIONS = [
@@ -89,207 +245,2316 @@ COMPLIMENTS = [
     "Ты делаешь этот чат лучше! Серьезно!",
 ]
 
+# ==================== МЕТРИКИ ====================
+class Counter:
+    """Счетчик в формате Prometheus с необязательными метками"""
+    
+    kind = "counter"
+    
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}  # значения меток -> число
+        self.lock = threading.Lock()
+        METRICS.append(self)
+    
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+    
+    def samples(self):
+        for label_values, value in list(self.values.items()):
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+class Histogram:
+    """Гистограмма: наблюдение стоит один bisect и пару сложений под блокировкой"""
+    
+    kind = "histogram"
+    
+    def __init__(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # значения меток -> [счетчики по корзинам, сумма, количество]
+        self.lock = threading.Lock()
+        METRICS.append(self)
+    
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+    
+    def samples(self):
+        for label_values, (counts, total, count) in list(self.series.items()):
+            labels = dict(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", {**labels, "le": f"{bound:g}"}, cumulative
+            yield f"{self.name}_bucket", {**labels, "le": "+Inf"}, count
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+class CallbackGauge:
+    """Показатель, который вычисляется в момент запроса /metrics"""
+    
+    kind = "gauge"
+    
+    def __init__(self, name: str, help_text: str, callback):
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback  # -> [(метки, значение)]
+        METRICS.append(self)
+    
+    def samples(self):
+        for labels, value in self.callback():
+            yield self.name, labels, value
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+def render_metrics(extra_labels: dict = None) -> str:
+    """Все метрики процесса в текстовом формате Prometheus"""
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            if extra_labels:
+                labels = {**extra_labels, **labels}
+            lines.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+def merge_metrics(texts) -> str:
+    """Объединить выводы нескольких процессов: у каждой метрики один заголовок"""
+    families = {}  # имя метрики -> [строки заголовка, образцы]
+    current = None
+    for text in texts:
+        for line in text.splitlines():
+            if line.startswith("# HELP "):
+                name = line.split()[2]
+                current = families.setdefault(name, [[], []])
+                if not current[0]:
+                    current[0].append(line)
+            elif line.startswith("# TYPE "):
+                if len(current[0]) == 1:
+                    current[0].append(line)
+            elif line and current is not None:
+                current[1].append(line)
+    return "\n".join(
+        line for header, samples in families.values() for line in header + samples
+    ) + "\n"
+
+def cache_samples():
+    samples = []
+    for name, cache in CACHES.items():
+        stats = cache.stats()
+        samples.append(({"cache": name, "stat": "hit_ratio"}, stats["hit_ratio"] or 0.0))
+        for stat in ("entries", "bytes", "hits", "misses", "evictions", "expirations"):
+            samples.append(({"cache": name, "stat": stat}, stats[stat]))
+    return samples
+
+updates_total = Counter("bot_updates_total", "Обработанные обновления Telegram", ("type",))
+update_seconds = Histogram("bot_update_seconds", "Время обработки обновления", ("type",))
+handler_seconds = Histogram("bot_handler_seconds", "Время работы обработчика", ("handler",))
+handler_errors_total = Counter("bot_handler_errors_total", "Исключения в обработчиках", ("handler",))
+db_query_seconds = Histogram("bot_db_query_seconds", "Время запросов к БД без фиксации", ("kind",))
+db_commit_seconds = Histogram("bot_db_commit_seconds", "Время фиксации транзакций записи")
+job_seconds = Histogram("bot_job_seconds", "Длительность фоновых задач", ("job",), buckets=JOB_BUCKETS)
+job_errors_total = Counter("bot_job_errors_total", "Фоновые задачи, завершившиеся исключением", ("job",))
+api_seconds = Histogram("bot_api_seconds", "Время вызовов Bot API", ("method",))
+api_errors_total = Counter("bot_api_errors_total", "Ошибки вызовов Bot API", ("method", "error"))
+# direction: "history" - в истории больше сообщений, чем в total; "total" - наоборот
+reconcile_drift_rows_total = Counter(
+    "bot_reconcile_drift_rows_total", "Расхождения total с историей, найденные сверкой", ("direction",)
+)
+reconcile_drift_messages_total = Counter(
+    "bot_reconcile_drift_messages_total", "Сообщения в найденных расхождениях", ("direction",)
+)
+reconcile_fixed_rows_total = Counter("bot_reconcile_fixed_rows_total", "Строки, исправленные сверкой")
+CallbackGauge("bot_cache", "Состояние кэшей", cache_samples)
+
+async def measure_update(handler, update: types.Update, data: dict):
+    """Внешний middleware диспетчера: поток обновлений и время их обработки"""
+    update_type = update.event_type
+    started = time.perf_counter()
+    try:
+        return await handler(update, data)
+    finally:
+        update_seconds.observe(time.perf_counter() - started, update_type)
+        updates_total.inc(update_type)
+
+async def measure_handler(handler, event, data: dict):
+    """Внутренний middleware: время конкретного обработчика"""
+    name = data["handler"].callback.__name__
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        handler_errors_total.inc(name)
+        raise
+    finally:
+        handler_seconds.observe(time.perf_counter() - started, name)
+
+async def measure_api_call(make_request, bot, method):
+    """Middleware сессии бота: задержки и ошибки Bot API"""
+    name = method.__api_method__
+    started = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    except Exception as e:
+        api_errors_total.inc(name, type(e).__name__)
+        raise
+    finally:
+        api_seconds.observe(time.perf_counter() - started, name)
+
+def timed_job(func):
+    """Обертка задачи планировщика, которая измеряет ее длительность"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            job_errors_total.inc(func.__name__)
+            raise
+        finally:
+            job_seconds.observe(time.perf_counter() - started, func.__name__)
+    return wrapper
+
+async def metrics_handler(request):
+    """Метрики в формате Prometheus; координатор добавляет метрики воркеров"""
+    if worker_id is not None:
+        text = render_metrics({"worker": str(worker_id)})
+    elif worker_processes:
+        texts = [render_metrics({"worker": "coordinator"})]
+        for index in sorted(worker_processes):
+            url = f"http://127.0.0.1:{WORKER_BASE_PORT + index}/metrics"
+            try:
+                async with forward_session.get(url) as response:
+                    texts.append(await response.text())
+            except ClientError as e:
+                logger.warning(f"Не удалось получить метрики воркера {index}: {e}")
+        text = merge_metrics(texts)
+    else:
+        text = render_metrics()
+    return web.Response(text=text, content_type="text/plain", charset="utf-8")
+
 # ==================== HTTP СЕРВЕР ====================
 async def health_check(request):
     """Проверка здоровья сервера"""
     status = {
         "status": "running",
+        "mode": BOT_MODE,
+        "role": process_role(),
+        "workers": {
+            index: "running" if process.returncode is None else "stopped"
+            for index, process in worker_processes.items()
+        },
         "bot_status": "active" if not is_shutting_down else "shutting_down",
-        "database": "connected" if conn else "disconnected",
+        "database": "connected" if storage else "disconnected",
+        "storage": STORAGE_BACKEND,
         "scheduler": "running" if scheduler_instance and scheduler_instance.running else "stopped",
-        "current_mention_type": ["предсказание", "пожелание", "комплимент"][current_mention_type]
+        "current_mention_type": ["предсказание", "пожелание", "комплимент"][current_mention_type],
+        "reconciliation": reconcile_stats,
+        "caches": {name: cache.stats() for name, cache in CACHES.items()}
     }
     return web.json_response(status)
 
-def run_http_server():
-    """Запуск HTTP-сервера в отдельном потоке"""
+def create_http_app():
+    """HTTP-приложение: проверка здоровья и, в режиме webhook, прием обновлений"""
     app = web.Application()
     app.router.add_get('/', health_check)
     app.router.add_get('/health', health_check)
+    app.router.add_get('/metrics', metrics_handler)
+    
+    if worker_id is not None:
+        # Воркер принимает обновления только от координатора
+        SimpleRequestHandler(
+            dispatcher=dp, bot=bot_instance, secret_token=WORKER_SECRET
+        ).register(app, path=WORKER_UPDATE_PATH)
+        app.router.add_post(WORKER_INTERNAL_PATH + "/{action}", internal_handler)
+    elif BOT_MODE == "webhook":
+        SimpleRequestHandler(
+            dispatcher=dp, bot=bot_instance, secret_token=WEBHOOK_SECRET
+        ).register(app, path=WEBHOOK_PATH)
+    
+    return app
+
+async def start_http_server():
+    """Запуск HTTP-сервера в основном event loop"""
+    global http_runner
+    
+    http_runner = web.AppRunner(create_http_app())
+    await http_runner.setup()
     
-    web.run_app(app, host='0.0.0.0', port=10000)
+    if worker_id is not None:
+        await web.TCPSite(http_runner, host="127.0.0.1", port=WORKER_BASE_PORT + worker_id).start()
+    else:
+        await web.TCPSite(http_runner, host=HTTP_HOST, port=HTTP_PORT).start()
 
 # ==================== БАЗА ДАННЫХ ====================
+# Миграции схемы: (версия, список запросов). Номер примененной версии
+# хранится в PRAGMA user_version, поэтому старые базы обновляются на месте
+# Заполнение user_totals из messages: today берется только из строк самого позднего дня
+USER_TOTALS_BACKFILL = """
+    INSERT INTO user_totals (user_id, total, today, day, chats_count, first_seen, last_updated)
+    SELECT user_id, SUM(total), SUM(CASE WHEN day = max_day THEN today ELSE 0 END),
+           max_day, COUNT(*), MIN(first_seen), MAX(last_updated)
+    FROM (
+        SELECT user_id, total, today, day, first_seen, last_updated,
+               MAX(day) OVER (PARTITION BY user_id) AS max_day
+        FROM messages
+    ) AS member_rows
+    GROUP BY user_id, max_day
+"""
+
+SCHEMA_MIGRATIONS = [
+    (1, [
+        # Основная таблица сообщений
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            user_id INTEGER,
+            chat_id INTEGER,
+            username TEXT,
+            today INTEGER DEFAULT 0,
+            yesterday INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            last_updated TIMESTAMP,
+            first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, chat_id)
+        )
+        """,
+        # Ежедневная статистика
+        """
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            date DATE PRIMARY KEY,
+            total_messages INTEGER DEFAULT 0,
+            active_users INTEGER DEFAULT 0,
+            top_user_id INTEGER,
+            top_user_count INTEGER
+        )
+        """,
+        # Настройки чатов
+        """
+        CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id INTEGER PRIMARY KEY,
+            chat_title TEXT,
+            chat_type TEXT DEFAULT 'private',
+            is_active BOOLEAN DEFAULT 1,
+            enable_mentions BOOLEAN DEFAULT 1,
+            last_mention_time TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_activity TIMESTAMP,
+            total_messages_before_bot INTEGER DEFAULT 0
+        )
+        """,
+        # Таблица для хранения упоминаний
+        """
+        CREATE TABLE IF NOT EXISTS mentions_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            user_id INTEGER,
+            username TEXT,
+            mention_time TIMESTAMP,
+            mention_type TEXT,
+            message TEXT
+        )
+        """,
+        # Таблица для подсчета всех сообщений
+        """
+        CREATE TABLE IF NOT EXISTS all_messages_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            user_id INTEGER,
+            username TEXT,
+            message_date TIMESTAMP,
+            message_count INTEGER DEFAULT 1
+        )
+        """,
+    ]),
+    (2, [
+        # Индексы для подсчета истории пользователя, топа чата и выборки активных чатов
+        """
+        CREATE INDEX IF NOT EXISTS idx_history_chat_user
+        ON all_messages_history (chat_id, user_id, message_count)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_chat_rank
+        ON messages (chat_id, today DESC, total DESC)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_user_total
+        ON messages (user_id, total)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_chat_settings_active
+        ON chat_settings (chat_type, is_active, enable_mentions)
+        """,
+    ]),
+    (3, [
+        # Почасовые агрегаты истории: размер зависит от числа активных
+        # пользователей и часов, а не от количества сообщений
+        """
+        CREATE TABLE IF NOT EXISTS message_rollup (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            hour_bucket TEXT NOT NULL,
+            message_count INTEGER DEFAULT 0,
+            PRIMARY KEY (chat_id, user_id, hour_bucket)
+        ) WITHOUT ROWID
+        """,
+        # Вся история: еще не свернутые строки и почасовые агрегаты
+        """
+        CREATE VIEW IF NOT EXISTS message_history AS
+        SELECT chat_id, user_id, message_count FROM all_messages_history
+        UNION ALL
+        SELECT chat_id, user_id, message_count FROM message_rollup
+        """,
+    ]),
+    (4, [
+        # Профили пользователей для упоминаний, заполняются из входящих сообщений
+        """
+        CREATE TABLE IF NOT EXISTS user_profiles (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            full_name TEXT,
+            updated_at TIMESTAMP
+        )
+        """,
+    ]),
+    (5, [
+        # День, к которому относится today: yesterday - это предыдущий день.
+        # Смена суток применяется лениво при записи и чтении, без UPDATE всей таблицы.
+        # Существующие строки относятся к дню своего последнего сообщения
+        """
+        ALTER TABLE messages ADD COLUMN day TEXT
+        """,
+        """
+        UPDATE messages SET day = COALESCE(date(last_updated), date('now', 'localtime'))
+        """,
+        # Строки прошлых дней приводим к дню миграции до заполнения дневной статистики.
+        # Полночный сброс прежних версий переносил today в yesterday, не меняя
+        # last_updated: у вчерашней строки с today = 0 вчерашние сообщения уже в yesterday
+        """
+        UPDATE messages
+        SET yesterday = CASE
+                WHEN day = date('now', 'localtime', '-1 day')
+                THEN CASE WHEN today > 0 THEN today ELSE yesterday END
+                ELSE 0
+            END,
+            today = 0,
+            day = date('now', 'localtime')
+        WHERE day < date('now', 'localtime')
+        """,
+    ]),
+    (6, [
+        # Дневная статистика по каждому чату и участнику, ключи подходят для выборки диапазонов
+        """
+        CREATE TABLE IF NOT EXISTS chat_daily_stats (
+            chat_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            total_messages INTEGER DEFAULT 0,
+            active_users INTEGER DEFAULT 0,
+            top_user_id INTEGER,
+            top_user_count INTEGER DEFAULT 0,
+            PRIMARY KEY (chat_id, date)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_chat_daily_date ON chat_daily_stats (date)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_daily_stats (
+            chat_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            message_count INTEGER DEFAULT 0,
+            PRIMARY KEY (chat_id, date, user_id)
+        ) WITHOUT ROWID
+        """,
+        # Заполняем из текущих счетчиков: сегодня и вчера для каждой строки
+        """
+        INSERT OR IGNORE INTO user_daily_stats (chat_id, date, user_id, message_count)
+        SELECT chat_id, day, user_id, today FROM messages
+        WHERE today > 0 AND day IS NOT NULL
+        """,
+        """
+        INSERT OR IGNORE INTO user_daily_stats (chat_id, date, user_id, message_count)
+        SELECT chat_id, date(day, '-1 day'), user_id, yesterday FROM messages
+        WHERE yesterday > 0 AND day IS NOT NULL
+        """,
+        """
+        INSERT OR IGNORE INTO chat_daily_stats
+        (chat_id, date, total_messages, active_users, top_user_id, top_user_count)
+        SELECT chat_id, date, SUM(message_count), COUNT(*), user_id, MAX(message_count)
+        FROM user_daily_stats
+        GROUP BY chat_id, date
+        """,
+    ]),
+    (7, [
+        # Прогресс импорта файлов экспорта: позиция в файле для продолжения после прерывания
+        """
+        CREATE TABLE IF NOT EXISTS history_imports (
+            source TEXT PRIMARY KEY,
+            file_size INTEGER,
+            byte_offset INTEGER DEFAULT 0,
+            chat_id INTEGER,
+            messages_imported INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'running',
+            started_at TIMESTAMP,
+            updated_at TIMESTAMP
+        )
+        """,
+        # Последнее импортированное сообщение каждого чата: повторный импорт
+        # или пересекающиеся экспорты не учитывают сообщения дважды
+        """
+        CREATE TABLE IF NOT EXISTS imported_chats (
+            chat_id INTEGER PRIMARY KEY,
+            last_message_id INTEGER DEFAULT 0,
+            last_message_date TEXT,
+            messages_imported INTEGER DEFAULT 0
+        )
+        """,
+    ]),
+    (8, [
+        # Итоги пользователя по всем чатам, обновляются вместе со счетчиками чатов.
+        # today относится к дню day, как и в messages
+        """
+        CREATE TABLE IF NOT EXISTS user_totals (
+            user_id INTEGER PRIMARY KEY,
+            total INTEGER DEFAULT 0,
+            today INTEGER DEFAULT 0,
+            day TEXT,
+            chats_count INTEGER DEFAULT 0,
+            first_seen TIMESTAMP,
+            last_updated TIMESTAMP
+        )
+        """,
+        USER_TOTALS_BACKFILL,
+    ]),
+    (9, [
+        # Последний сегмент журнала счетчиков, записанный в БД, для каждого процесса
+        """
+        CREATE TABLE IF NOT EXISTS journal_checkpoints (
+            journal TEXT PRIMARY KEY,
+            segment INTEGER NOT NULL
+        )
+        """,
+    ]),
+    (10, [
+        # Сообщения, учтенные в total до появления истории: время их неизвестно,
+        # поэтому они попадают в нулевой час, как строки истории без даты при свертке.
+        # Без этого сверка считала бы их расхождением
+        """
+        INSERT INTO message_rollup (chat_id, user_id, hour_bucket, message_count)
+        SELECT m.chat_id, m.user_id, '1970-01-01T00:00:00', m.total - COALESCE(h.message_count, 0)
+        FROM messages m
+        LEFT JOIN (
+            SELECT chat_id, user_id, SUM(message_count) AS message_count
+            FROM message_history
+            GROUP BY chat_id, user_id
+        ) h ON h.chat_id = m.chat_id AND h.user_id = m.user_id
+        WHERE m.total > COALESCE(h.message_count, 0)
+        ON CONFLICT (chat_id, user_id, hour_bucket) DO UPDATE SET
+            message_count = message_count + excluded.message_count
+        """,
+    ]),
+]
+
+def _get_reader_connection():
+    """Соединение только для чтения, свое для каждого потока пула"""
+    reader = getattr(db_reader_local, "conn", None)
+    if reader is None:
+        uri = Path(DB_PATH).absolute().as_uri() + "?mode=ro"
+        reader = sqlite3.connect(uri, uri=True, check_same_thread=False, timeout=10)
+        apply_connection_pragmas(reader)
+        db_reader_local.conn = reader
+        db_reader_connections.append(reader)
+    return reader
+
+def _run_read(query, params, fetch_all):
+    started = time.perf_counter()
+    reader_cursor = _get_reader_connection().execute(query, params)
+    rows = reader_cursor.fetchall() if fetch_all else reader_cursor.fetchone()
+    db_query_seconds.observe(time.perf_counter() - started, "read")
+    return rows
+
+def _run_read_func(func, args):
+    started = time.perf_counter()
+    result = func(_get_reader_connection(), *args)
+    db_query_seconds.observe(time.perf_counter() - started, "read")
+    return result
+
+def _run_write(func, args, durable=False):
+    if durable:
+        # WAL с synchronous = NORMAL не переживает отключение питания до контрольной
+        # точки; транзакция, после которой удаляются данные вне БД, ждет fsync WAL
+        conn.execute("PRAGMA synchronous = FULL")
+    try:
+        started = time.perf_counter()
+        result = func(conn, *args)
+        committing = time.perf_counter()
+        conn.commit()
+        db_commit_seconds.observe(time.perf_counter() - committing)
+        db_query_seconds.observe(committing - started, "write")
+        return result
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if durable:
+            conn.execute("PRAGMA synchronous = NORMAL")
+
+async def db_fetchall(query: str, params=()):
+    """Выполнить SELECT в пуле чтения и вернуть все строки"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_readers, _run_read, query, params, True)
+
+async def db_fetchone(query: str, params=()):
+    """Выполнить SELECT в пуле чтения и вернуть первую строку"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_readers, _run_read, query, params, False)
+
+async def db_read(func, *args):
+    """Выполнить func(reader, *args) в пуле чтения"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_readers, _run_read_func, func, args)
+
+async def db_write(func, *args):
+    """Выполнить func(conn, *args) в потоке записи одной транзакцией"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_writer, _run_write, func, args)
+
+async def db_write_durable(func, *args):
+    """Как db_write, но коммит сбрасывается на диск до возврата"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_writer, _run_write, func, args, True)
+
+async def db_execute(query: str, params=()):
+    """Выполнить изменяющий запрос в потоке записи"""
+    return await db_write(lambda db: db.execute(query, params).rowcount)
+
+async def db_executemany(query: str, seq_of_params):
+    """Выполнить изменяющий запрос для набора параметров в потоке записи"""
+    return await db_write(lambda db: db.executemany(query, seq_of_params).rowcount)
+
+def close_database():
+    """Остановить потоки БД и закрыть все соединения"""
+    global conn
+    
+    for executor in (db_writer, db_readers):
+        if executor:
+            executor.shutdown(wait=True)
+    
+    for reader in db_reader_connections:
+        reader.close()
+    db_reader_connections.clear()
+    
+    if conn:
+        conn.execute("PRAGMA optimize")
+        conn.close()
+        conn = None
+
+def apply_connection_pragmas(db):
+    """Настройки производительности, действующие для одного соединения"""
+    db.execute("PRAGMA synchronous = NORMAL")
+    db.execute(f"PRAGMA cache_size = {-DB_CACHE_SIZE_KB}")
+    db.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+    db.execute("PRAGMA temp_store = MEMORY")
+
+def migrate_database(db):
+    """Применить недостающие миграции схемы"""
+    current_version = db.execute("PRAGMA user_version").fetchone()[0]
+    
+    for version, statements in SCHEMA_MIGRATIONS:
+        if version <= current_version:
+            continue
+        
+        try:
+            db.execute("BEGIN")
+            for statement in statements:
+                db.execute(statement)
+            db.execute(f"PRAGMA user_version = {version}")
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        
+        logger.info(f"Схема БД обновлена до версии {version}")
+
 def init_database():
     """Инициализация базы данных"""
-    global conn, cursor
-    conn = sqlite3.connect("stats.db", check_same_thread=False, timeout=10)
-    cursor = conn.cursor()
+    global conn, db_writer, db_readers
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=10)
+    
+    # WAL сохраняется в файле БД и позволяет читать параллельно с записью
+    journal_mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+    if journal_mode.lower() != "wal":
+        logger.warning(f"Не удалось включить WAL, режим журнала: {journal_mode}")
+    apply_connection_pragmas(conn)
+    # Фоновые задачи воркера обрабатывают только свои чаты
+    conn.create_function("owns_chat", 1, owns_chat, deterministic=True)
+    
+    migrate_database(conn)
+    
+    db_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+    db_readers = ThreadPoolExecutor(max_workers=DB_READ_POOL_SIZE, thread_name_prefix="db-reader")
+    logger.info("База данных инициализирована")
+
+# ==================== ХРАНИЛИЩЕ ====================
+class Storage:
+    """Операции бота с хранилищем; обработчики работают только через этот интерфейс"""
+    
+    name = None
+    
+    async def open(self):
+        """Подключиться и привести схему к актуальной версии"""
+        raise NotImplementedError
+    
+    async def close(self):
+        """Закрыть все соединения"""
+        raise NotImplementedError
+    
+    # Чаты
+    async def load_chats(self):
+        """Все чаты: (chat_id, chat_title, chat_type, is_active, enable_mentions)"""
+        raise NotImplementedError
+    
+    async def insert_chat(self, chat_id, chat_title, chat_type, current_time):
+        """Добавить новый чат, если его еще нет"""
+        raise NotImplementedError
+    
+    async def update_chat(self, chat_id, changes: dict, current_time):
+        """Обновить поля чата (chat_title, chat_type) и время активности"""
+        raise NotImplementedError
+    
+    async def estimate_messages_before_bot(self, chat_id, cutoff):
+        """Сохранить и вернуть число сообщений чата в истории раньше cutoff (ISO),
+        времени появления бота"""
+        raise NotImplementedError
+    
+    async def get_messages_before_bot(self, chat_id):
+        """Сохраненная оценка сообщений до появления бота"""
+        raise NotImplementedError
+    
+    async def active_group_chats(self, mentions_only=False):
+        """Активные группы: (chat_id, chat_title)"""
+        raise NotImplementedError
+    
+    # Счетчики
+    async def write_counters(self, counters, history, chat_activity, profiles, checkpoint=None):
+        """Записать пачку буфера счетчиков одной транзакцией; checkpoint - (журнал, сегмент),
+        все записи которого вошли в пачку"""
+        raise NotImplementedError
+    
+    async def get_journal_checkpoint(self, journal):
+        """Последний сегмент журнала, записанный в БД, или 0"""
+        raise NotImplementedError
+    
+    async def read_leaderboard(self, chat_id):
+        """Строки рейтинга чата после всех ранее отправленных записей"""
+        raise NotImplementedError
+    
+    async def get_user_profile(self, user_id):
+        """(username, full_name) или None"""
+        raise NotImplementedError
+    
+    async def get_user_stats(self, chat_id, user_id, today_day):
+        """(username, today, yesterday, total, first_seen, всего во всех чатах,
+        сегодня во всех чатах, число чатов) участника чата или None"""
+        raise NotImplementedError
+    
+    async def yesterday_top(self, chat_id, today_day, limit):
+        """Топ за вчера [(username, count)] и сумма за вчера по чату"""
+        raise NotImplementedError
+    
+    async def reset_today(self, chat_id, today_day):
+        """Сбросить сегодняшние счетчики чата, вернуть сброшенные (сообщений, участников)"""
+        raise NotImplementedError
+    
+    # Дневная статистика
+    async def period_stats(self, chat_id, start_day, end_day):
+        """[(date, total_messages, active_users)] чата за период, новые дни первыми"""
+        raise NotImplementedError
+    
+    async def day_totals(self, day):
+        """(сообщений, участников) за день по всем чатам"""
+        raise NotImplementedError
+    
+    async def daily_report_rows(self, today_day, limit, chat_ids=None):
+        """Топ-limit каждой активной группы за день одним запросом:
+        [(chat_id, chat_title, username, today, участников, сообщений за день, активных)].
+        chat_ids ограничивает отчет указанными чатами"""
+        raise NotImplementedError
+    
+    # Упоминания
+    async def save_mention(self, chat_id, user_id, username, mention_type, message):
+        """Записать упоминание в историю"""
+        raise NotImplementedError
+    
+    # Обслуживание
+    async def reconcile_chunk(self, position, limit):
+        """Сверить порцию счетчиков с историей: (строк, следующая позиция, расхождения)"""
+        raise NotImplementedError
+    
+    async def compact_history(self, cutoff):
+        """Свернуть построчную историю старше cutoff, вернуть число строк"""
+        raise NotImplementedError
+    
+    async def vacuum(self):
+        """Вернуть освободившееся место"""
+        raise NotImplementedError
+    
+    # Импорт истории
+    async def get_import_state(self, source):
+        """(file_size, byte_offset, chat_id, messages_imported, status) файла или None"""
+        raise NotImplementedError
+    
+    async def start_import(self, source, file_size, byte_offset, messages_imported):
+        raise NotImplementedError
+    
+    async def load_import_chat(self, chat_id):
+        """(последний импортированный ID сообщения, начало живого подсчета)"""
+        raise NotImplementedError
+    
+    async def write_import_batch(self, source, chat_id, batch, byte_offset, messages_imported):
+        """Записать пачку импорта вместе с позицией в файле"""
+        raise NotImplementedError
+    
+    async def finish_import(self, source):
+        raise NotImplementedError
+    
+    async def list_imports(self, limit):
+        """[(source, file_size, byte_offset, messages_imported, status)]"""
+        raise NotImplementedError
+
+class SQLiteStorage(Storage):
+    """Один файл SQLite: поток записи и пул потоков чтения"""
     
-    # Основная таблица сообщений
-    cursor.execute("""
+    name = "sqlite"
+    
+    async def open(self):
+        init_database()
+    
+    async def close(self):
+        close_database()
+    
+    async def load_chats(self):
+        return await db_fetchall("""
+            SELECT chat_id, chat_title, chat_type, is_active, enable_mentions
+            FROM chat_settings
+        """)
+    
+    async def insert_chat(self, chat_id, chat_title, chat_type, current_time):
+        await db_write(_insert_chat_settings, chat_id, chat_title, chat_type, current_time)
+    
+    async def update_chat(self, chat_id, changes: dict, current_time):
+        update_fields = [f"{column} = ?" for column in changes] + ["last_activity = ?"]
+        await db_execute(
+            f"UPDATE chat_settings SET {', '.join(update_fields)} WHERE chat_id = ?",
+            (*changes.values(), current_time, chat_id)
+        )
+    
+    async def estimate_messages_before_bot(self, chat_id, cutoff):
+        return await db_write(_estimate_messages_before_bot, chat_id, cutoff)
+    
+    async def get_messages_before_bot(self, chat_id):
+        row = await db_fetchone("SELECT total_messages_before_bot FROM chat_settings WHERE chat_id = ?", (chat_id,))
+        return row[0] if row else 0
+    
+    async def active_group_chats(self, mentions_only=False):
+        return await db_fetchall(f"""
+            SELECT chat_id, chat_title FROM chat_settings 
+            WHERE chat_type IN ('group', 'supergroup') 
+            AND is_active = 1
+            {"AND enable_mentions = 1" if mentions_only else ""}
+        """)
+    
+    async def write_counters(self, counters, history, chat_activity, profiles, checkpoint=None):
+        # После записи отметки сегменты журнала удаляются: коммит должен быть на диске
+        write = db_write_durable if checkpoint else db_write
+        await write(_write_counter_batch, counters, history, chat_activity, profiles, checkpoint)
+    
+    async def get_journal_checkpoint(self, journal):
+        row = await db_fetchone("SELECT segment FROM journal_checkpoints WHERE journal = ?", (journal,))
+        return row[0] if row else 0
+    
+    async def read_leaderboard(self, chat_id):
+        # Чтение через поток записи идет строго после уже отправленных пачек
+        return await db_write(_read_leaderboard_rows, chat_id)
+    
+    async def get_user_profile(self, user_id):
+        return await db_fetchone(
+            "SELECT username, full_name FROM user_profiles WHERE user_id = ?", (user_id,)
+        )
+    
+    async def get_user_stats(self, chat_id, user_id, today_day):
+        # Две выборки по первичному ключу вместо суммирования по всем чатам
+        return await db_fetchone("""
+            SELECT m.username,
+                   CASE WHEN m.day = ? THEN m.today ELSE 0 END,
+                   CASE WHEN m.day = ? THEN m.yesterday WHEN m.day = ? THEN m.today ELSE 0 END,
+                   m.total, m.first_seen,
+                   COALESCE(u.total, m.total),
+                   CASE WHEN u.day = ? THEN u.today ELSE 0 END,
+                   COALESCE(u.chats_count, 1)
+            FROM messages m LEFT JOIN user_totals u ON u.user_id = m.user_id
+            WHERE m.user_id = ? AND m.chat_id = ?
+        """, (today_day, today_day, shift_day(today_day, -1), today_day, user_id, chat_id))
+    
+    async def yesterday_top(self, chat_id, today_day, limit):
+        # Вчерашнее значение: yesterday сегодняшних строк или today вчерашних
+        yesterday_params = (today_day, shift_day(today_day, -1), chat_id)
+        rows = await db_fetchall(f"""
+            SELECT username, count FROM (
+                SELECT username,
+                       CASE WHEN day = ? THEN yesterday WHEN day = ? THEN today ELSE 0 END as count
+                FROM messages 
+                WHERE chat_id = ?
+            )
+            WHERE count > 0 
+            ORDER BY count DESC 
+            LIMIT {int(limit)}
+        """, yesterday_params)
+        
+        total = (await db_fetchone("""
+            SELECT SUM(CASE WHEN day = ? THEN yesterday WHEN day = ? THEN today ELSE 0 END)
+            FROM messages WHERE chat_id = ?
+        """, yesterday_params))[0] or 0
+        
+        return rows, total
+    
+    async def reset_today(self, chat_id, today_day):
+        return await db_write(reset_today_counters, chat_id, today_day)
+    
+    async def period_stats(self, chat_id, start_day, end_day):
+        return await db_fetchall("""
+            SELECT date, total_messages, active_users 
+            FROM chat_daily_stats 
+            WHERE chat_id = ? AND date BETWEEN ? AND ?
+            ORDER BY date DESC
+        """, (chat_id, start_day, end_day))
+    
+    async def day_totals(self, day):
+        return await db_fetchone("""
+            SELECT SUM(total_messages), SUM(active_users) FROM chat_daily_stats WHERE date = ?
+        """, (day,))
+    
+    async def daily_report_rows(self, today_day, limit, chat_ids=None):
+        # Тот же порядок и те же итоги, что у ChatLeaderboard, но для всех чатов за один проход
+        params = [today_day]
+        chat_filter = ""
+        if chat_ids is not None:
+            chat_filter = "AND m.chat_id IN (SELECT value FROM json_each(?))"
+            params.append(json.dumps(list(chat_ids)))
+        params.append(limit)
+        
+        return await db_fetchall(f"""
+            SELECT chat_id, chat_title, username, today, members, today_sum, active_count
+            FROM (
+                SELECT chat_id, chat_title, username, today,
+                       ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY today DESC, total DESC, user_id) AS place,
+                       COUNT(*) OVER (PARTITION BY chat_id) AS members,
+                       SUM(today) OVER (PARTITION BY chat_id) AS today_sum,
+                       SUM(today > 0) OVER (PARTITION BY chat_id) AS active_count
+                FROM (
+                    SELECT m.chat_id, c.chat_title, m.user_id, m.username, m.total,
+                           CASE WHEN m.day = ? THEN m.today ELSE 0 END AS today
+                    FROM messages m
+                    JOIN chat_settings c ON c.chat_id = m.chat_id
+                    WHERE c.chat_type IN ('group', 'supergroup')
+                    AND c.is_active = 1
+                    AND (m.today > 0 OR m.yesterday > 0 OR m.total > 0)
+                    {chat_filter}
+                )
+            )
+            WHERE place <= ?
+            ORDER BY chat_id, place
+        """, params)
+    
+    async def save_mention(self, chat_id, user_id, username, mention_type, message):
+        await db_write(save_mention, chat_id, user_id, username, mention_type, message)
+    
+    async def reconcile_chunk(self, position, limit):
+        return await db_write(_reconcile_chunk, position or 0, limit)
+    
+    async def compact_history(self, cutoff):
+        bounds = await db_fetchone("SELECT MIN(id), MAX(id) FROM all_messages_history")
+        if not bounds or bounds[0] is None:
+            return 0
+        
+        first_id, max_id = bounds
+        compacted = 0
+        
+        while first_id <= max_id and not is_shutting_down:
+            last_id = min(first_id + HISTORY_COMPACTION_CHUNK - 1, max_id)
+            compacted += await db_write(_compact_history_chunk, first_id, last_id, cutoff)
+            first_id = last_id + 1
+        
+        return compacted
+    
+    async def vacuum(self):
+        await db_write(lambda db: db.execute("VACUUM"))
+    
+    async def get_import_state(self, source):
+        return await db_fetchone("""
+            SELECT file_size, byte_offset, chat_id, messages_imported, status
+            FROM history_imports WHERE source = ?
+        """, (source,))
+    
+    async def start_import(self, source, file_size, byte_offset, messages_imported):
+        await db_write(_start_import, source, file_size, byte_offset, messages_imported)
+    
+    async def load_import_chat(self, chat_id):
+        return await db_fetchone("""
+            SELECT
+                (SELECT last_message_id FROM imported_chats WHERE chat_id = ?),
+                (SELECT replace(created_at, ' ', 'T') FROM chat_settings WHERE chat_id = ?)
+        """, (chat_id, chat_id))
+    
+    async def write_import_batch(self, source, chat_id, batch, byte_offset, messages_imported):
+        await db_write(_write_import_batch, source, chat_id, batch, byte_offset, messages_imported)
+    
+    async def finish_import(self, source):
+        await db_execute("""
+            UPDATE history_imports SET status = 'done', updated_at = ? WHERE source = ?
+        """, (datetime.now().isoformat(), source))
+    
+    async def list_imports(self, limit):
+        return await db_fetchall("""
+            SELECT source, file_size, byte_offset, messages_imported, status
+            FROM history_imports ORDER BY started_at DESC LIMIT ?
+        """, (limit,))
+
+# Схема PostgreSQL: соответствует последней версии SCHEMA_MIGRATIONS.
+# Даты и время хранятся строками ISO, как и в SQLite, поэтому сравнения совпадают
+POSTGRES_SCHEMA = [
+    """
     CREATE TABLE IF NOT EXISTS messages (
-        user_id INTEGER,
-        chat_id INTEGER,
+        user_id BIGINT,
+        chat_id BIGINT,
         username TEXT,
         today INTEGER DEFAULT 0,
         yesterday INTEGER DEFAULT 0,
-        total INTEGER DEFAULT 0,
-        last_updated TIMESTAMP,
-        first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        total BIGINT DEFAULT 0,
+        last_updated TEXT,
+        first_seen TEXT,
+        day TEXT,
         PRIMARY KEY (user_id, chat_id)
     )
-    """)
-    
-    # Ежедневная статистика
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS daily_stats (
-        date DATE PRIMARY KEY,
-        total_messages INTEGER DEFAULT 0,
-        active_users INTEGER DEFAULT 0,
-        top_user_id INTEGER,
-        top_user_count INTEGER
-    )
-    """)
-    
-    # Настройки чатов
-    cursor.execute("""
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_messages_chat_rank ON messages (chat_id, today DESC, total DESC)
+    """,
+    """
     CREATE TABLE IF NOT EXISTS chat_settings (
-        chat_id INTEGER PRIMARY KEY,
+        chat_id BIGINT PRIMARY KEY,
         chat_title TEXT,
         chat_type TEXT DEFAULT 'private',
-        is_active BOOLEAN DEFAULT 1,
-        enable_mentions BOOLEAN DEFAULT 1,
-        last_mention_time TIMESTAMP,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        last_activity TIMESTAMP,
-        total_messages_before_bot INTEGER DEFAULT 0
+        is_active INTEGER DEFAULT 1,
+        enable_mentions INTEGER DEFAULT 1,
+        last_mention_time TEXT,
+        created_at TEXT,
+        last_activity TEXT,
+        total_messages_before_bot BIGINT DEFAULT 0
     )
-    """)
-    
-    # Таблица для хранения упоминаний
-    cursor.execute("""
+    """,
+    """
     CREATE TABLE IF NOT EXISTS mentions_history (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        chat_id INTEGER,
-        user_id INTEGER,
+        id BIGSERIAL PRIMARY KEY,
+        chat_id BIGINT,
+        user_id BIGINT,
         username TEXT,
-        mention_time TIMESTAMP,
+        mention_time TEXT,
         mention_type TEXT,
         message TEXT
     )
-    """)
-    
-    # Таблица для подсчета всех сообщений
-    cursor.execute("""
+    """,
+    """
     CREATE TABLE IF NOT EXISTS all_messages_history (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        chat_id INTEGER,
-        user_id INTEGER,
+        id BIGSERIAL PRIMARY KEY,
+        chat_id BIGINT,
+        user_id BIGINT,
         username TEXT,
-        message_date TIMESTAMP,
+        message_date TEXT,
         message_count INTEGER DEFAULT 1
     )
-    """)
-    
-    conn.commit()
-    logger.info("База данных инициализирована")
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_history_chat_user
+    ON all_messages_history (chat_id, user_id, message_count)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS message_rollup (
+        chat_id BIGINT NOT NULL,
+        user_id BIGINT NOT NULL,
+        hour_bucket TEXT NOT NULL,
+        message_count BIGINT DEFAULT 0,
+        PRIMARY KEY (chat_id, user_id, hour_bucket)
+    )
+    """,
+    """
+    CREATE OR REPLACE VIEW message_history AS
+    SELECT chat_id, user_id, message_count::BIGINT AS message_count FROM all_messages_history
+    UNION ALL
+    SELECT chat_id, user_id, message_count FROM message_rollup
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_profiles (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT,
+        full_name TEXT,
+        updated_at TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS chat_daily_stats (
+        chat_id BIGINT NOT NULL,
+        date TEXT NOT NULL,
+        total_messages BIGINT DEFAULT 0,
+        active_users INTEGER DEFAULT 0,
+        top_user_id BIGINT,
+        top_user_count BIGINT DEFAULT 0,
+        PRIMARY KEY (chat_id, date)
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_chat_daily_date ON chat_daily_stats (date)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_daily_stats (
+        chat_id BIGINT NOT NULL,
+        date TEXT NOT NULL,
+        user_id BIGINT NOT NULL,
+        message_count BIGINT DEFAULT 0,
+        PRIMARY KEY (chat_id, date, user_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS history_imports (
+        source TEXT PRIMARY KEY,
+        file_size BIGINT,
+        byte_offset BIGINT DEFAULT 0,
+        chat_id BIGINT,
+        messages_imported BIGINT DEFAULT 0,
+        status TEXT DEFAULT 'running',
+        started_at TEXT,
+        updated_at TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS imported_chats (
+        chat_id BIGINT PRIMARY KEY,
+        last_message_id BIGINT DEFAULT 0,
+        last_message_date TEXT,
+        messages_imported BIGINT DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_totals (
+        user_id BIGINT PRIMARY KEY,
+        total BIGINT DEFAULT 0,
+        today INTEGER DEFAULT 0,
+        day TEXT,
+        chats_count INTEGER DEFAULT 0,
+        first_seen TEXT,
+        last_updated TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS journal_checkpoints (
+        journal TEXT PRIMARY KEY,
+        segment BIGINT NOT NULL
+    )
+    """,
+]
 
-def update_chat_settings(chat_id: int, chat_title: str = None, chat_type: str = None):
-    """Обновить настройки чата"""
-    try:
-        # Проверяем, существует ли уже запись
-        cursor.execute("SELECT chat_id FROM chat_settings WHERE chat_id = ?", (chat_id,))
-        existing = cursor.fetchone()
-        
-        current_time = datetime.now().isoformat()
+# Заполнение новых таблиц по уже накопленным данным: выполняется, только если таблицы не было
+POSTGRES_BACKFILLS = {
+    "user_totals": USER_TOTALS_BACKFILL,
+}
+
+class PostgresStorage(Storage):
+    """PostgreSQL через пул соединений asyncpg"""
+    
+    name = "postgres"
+    
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.pool = None
+        self.write_lock = None
+    
+    async def open(self):
+        try:
+            import asyncpg
+        except ImportError:
+            raise RuntimeError("Для STORAGE_BACKEND=postgres нужен пакет asyncpg")
         
-        if existing:
-            # Обновляем существующую запись
-            update_fields = []
-            params = []
-            
-            if chat_title:
-                update_fields.append("chat_title = ?")
-                params.append(chat_title)
-            
-            if chat_type:
-                update_fields.append("chat_type = ?")
-                params.append(chat_type)
-            
-            update_fields.append("last_activity = ?")
-            params.append(current_time)
-            
-            params.append(chat_id)
-            
-            if update_fields:
-                query = f"UPDATE chat_settings SET {', '.join(update_fields)} WHERE chat_id = ?"
-                cursor.execute(query, params)
-        else:
-            # Создаем новую запись
-            # Пытаемся оценить количество сообщений до добавления бота
-            cursor.execute("""
-                SELECT COUNT(*) FROM all_messages_history WHERE chat_id = ?
-            """, (chat_id,))
-            count_result = cursor.fetchone()
-            messages_before = count_result[0] if count_result else 0
-            
-            cursor.execute("""
-                INSERT INTO chat_settings 
-                (chat_id, chat_title, chat_type, is_active, enable_mentions, created_at, last_activity, total_messages_before_bot)
-                VALUES (?, ?, ?, 1, 1, ?, ?, ?)
-            """, (
-                chat_id, 
-                chat_title or f"Chat {chat_id}", 
-                chat_type or "private",
-                current_time,
-                current_time,
-                messages_before
-            ))
+        self.pool = await asyncpg.create_pool(
+            self.dsn, min_size=PG_POOL_MIN_SIZE, max_size=PG_POOL_MAX_SIZE
+        )
+        # Записи выполняются по очереди, как в потоке записи SQLite:
+        # рейтинг, прочитанный после пачки, гарантированно ее видит
+        self.write_lock = asyncio.Lock()
         
-        conn.commit()
+        async with self.pool.acquire() as db:
+            async with db.transaction():
+                # Воркеры могут стартовать одновременно
+                await db.execute("SELECT pg_advisory_xact_lock(hashtext('telegram-stats-schema'))")
+                missing = [table for table in POSTGRES_BACKFILLS
+                           if await db.fetchval("SELECT to_regclass($1) IS NULL", table)]
+                for statement in POSTGRES_SCHEMA:
+                    await db.execute(statement)
+                for table in missing:
+                    await db.execute(POSTGRES_BACKFILLS[table])
         
-    except Exception as e:
-        logger.error(f"Ошибка обновления настроек чата {chat_id}: {e}")
-
-# ==================== GRACEFUL SHUTDOWN ====================
-async def shutdown():
-    """Корректное завершение работы бота"""
-    global is_shutting_down
+        logger.info("Подключение к PostgreSQL установлено")
     
-    if is_shutting_down:
-        return
-        
-    is_shutting_down = True
-    logger.info("Начинаем корректное завершение работы...")
+    async def close(self):
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
     
-    try:
-        # Останавливаем polling
-        if dp and hasattr(dp, '_stopped') and not dp._stopped:
-            await dp.stop_polling()
-            logger.info("Polling остановлен")
-    except Exception as e:
-        logger.error(f"Ошибка при остановке polling: {e}")
+    async def _write(self, func, *args):
+        """Выполнить func(db, *args) одной транзакцией в порядке вызова"""
+        async with self.write_lock:
+            async with self.pool.acquire() as db:
+                transaction = db.transaction()
+                await transaction.start()
+                try:
+                    started = time.perf_counter()
+                    result = await func(db, *args)
+                except Exception:
+                    await transaction.rollback()
+                    raise
+                committing = time.perf_counter()
+                await transaction.commit()
+                db_commit_seconds.observe(time.perf_counter() - committing)
+                db_query_seconds.observe(committing - started, "write")
+                return result
     
-    try:
-        # Отменяем задачу polling
-        global polling_task
-        if polling_task and not polling_task.done():
-            polling_task.cancel()
-            logger.info("Задача polling отменена")
-    except Exception as e:
-        logger.error(f"Ошибка при отмене задачи polling: {e}")
+    async def load_chats(self):
+        return await self.pool.fetch("""
+            SELECT chat_id, chat_title, chat_type, is_active, enable_mentions
+            FROM chat_settings
+        """)
     
-    try:
-        # Останавливаем планировщик
-        if scheduler_instance and scheduler_instance.running:
-            scheduler_instance.shutdown(wait=False)
-            logger.info("Планировщик остановлен")
-    except Exception as e:
-        logger.error(f"Ошибка при остановке планировщика: {e}")
+    async def insert_chat(self, chat_id, chat_title, chat_type, current_time):
+        await self._write(lambda db: db.execute("""
+            INSERT INTO chat_settings 
+            (chat_id, chat_title, chat_type, is_active, enable_mentions, created_at, last_activity, total_messages_before_bot)
+            VALUES ($1, $2, $3, 1, 1, $4, $4, 0)
+            ON CONFLICT (chat_id) DO NOTHING
+        """, chat_id, chat_title, chat_type, current_time))
     
-    try:
-        # Закрываем сессию бота
-        if bot_instance:
-            await bot_instance.session.close()
-            logger.info("Сессия бота закрыта")
-    except Exception as e:
-        logger.error(f"Ошибка при закрытии сессии бота: {e}")
+    async def update_chat(self, chat_id, changes: dict, current_time):
+        update_fields = [f"{column} = ${index}" for index, column in enumerate(changes, 1)]
+        update_fields.append(f"last_activity = ${len(changes) + 1}")
+        await self._write(lambda db: db.execute(
+            f"UPDATE chat_settings SET {', '.join(update_fields)} WHERE chat_id = ${len(changes) + 2}",
+            *changes.values(), current_time, chat_id
+        ))
     
-    try:
-        # Закрываем соединение с базой данных
-        if conn:
-            conn.close()
+    async def estimate_messages_before_bot(self, chat_id, cutoff):
+        async def estimate(db):
+            if await db.fetchval("SELECT 1 FROM imported_chats WHERE chat_id = $1", chat_id):
+                return 0
+            
+            # Сообщения, записанные после регистрации чата, уже посчитаны ботом
+            messages_before = await db.fetchval("""
+                SELECT ((SELECT COALESCE(SUM(message_count), 0) FROM all_messages_history
+                         WHERE chat_id = $1 AND message_date < $2)
+                      + (SELECT COALESCE(SUM(message_count), 0) FROM message_rollup
+                         WHERE chat_id = $1 AND hour_bucket < $3))::BIGINT
+            """, chat_id, cutoff, history_hour_bucket(cutoff))
+            if messages_before:
+                await db.execute("""
+                    UPDATE chat_settings SET total_messages_before_bot = $1 WHERE chat_id = $2
+                """, messages_before, chat_id)
+            return messages_before
+        
+        return await self._write(estimate)
+    
+    async def get_messages_before_bot(self, chat_id):
+        return await self.pool.fetchval(
+            "SELECT total_messages_before_bot FROM chat_settings WHERE chat_id = $1", chat_id
+        ) or 0
+    
+    async def active_group_chats(self, mentions_only=False):
+        return await self.pool.fetch(f"""
+            SELECT chat_id, chat_title FROM chat_settings 
+            WHERE chat_type IN ('group', 'supergroup') 
+            AND is_active = 1
+            {"AND enable_mentions = 1" if mentions_only else ""}
+        """)
+    
+    async def _write_counter_batch(self, db, counters, history, chat_activity, profiles, checkpoint=None):
+        if checkpoint:
+            await db.execute("""
+                INSERT INTO journal_checkpoints (journal, segment) VALUES ($1, $2)
+                ON CONFLICT (journal) DO UPDATE SET
+                    segment = GREATEST(journal_checkpoints.segment, excluded.segment)
+            """, *checkpoint)
+        
+        if chat_activity:
+            await db.executemany(
+                "UPDATE chat_settings SET last_activity = $1 WHERE chat_id = $2",
+                [(activity_time, chat_id) for chat_id, activity_time in chat_activity.items()]
+            )
+        
+        if profiles:
+            await db.executemany("""
+                INSERT INTO user_profiles (user_id, username, full_name, updated_at)
+                VALUES ($1, $2, $3, $4)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    username = excluded.username,
+                    full_name = excluded.full_name,
+                    updated_at = excluded.updated_at
+            """, [(user_id, *profile) for user_id, profile in profiles.items()])
+        
+        if WRITE_RAW_HISTORY and history:
+            await db.executemany("""
+                INSERT INTO all_messages_history 
+                (chat_id, user_id, username, message_date, message_count)
+                VALUES ($1, $2, $3, $4, 1)
+            """, history)
+        elif history:
+            await db.executemany("""
+                INSERT INTO message_rollup (chat_id, user_id, hour_bucket, message_count)
+                VALUES ($1, $2, $3, $4)
+                ON CONFLICT (chat_id, user_id, hour_bucket) DO UPDATE SET
+                    message_count = message_rollup.message_count + excluded.message_count
+            """, [(chat_id, user_id, bucket, count)
+                  for (chat_id, user_id, bucket), count in rollup_history(history).items()])
+        
+        if not counters:
+            return
+        
+        # Новые пары чат-участник определяем до вставки строк в messages
+        pairs = list({(chat_id, user_id) for chat_id, user_id, _ in counters})
+        existing = await db.fetch("""
+            SELECT m.chat_id, m.user_id FROM messages m
+            JOIN unnest($1::BIGINT[], $2::BIGINT[]) AS p(chat_id, user_id)
+            ON m.chat_id = p.chat_id AND m.user_id = p.user_id
+        """, [chat_id for chat_id, _ in pairs], [user_id for _, user_id in pairs])
+        new_members = set(pairs) - {(chat_id, user_id) for chat_id, user_id in existing}
+        
+        # Та же смена суток по полю day, что и в _write_counter_batch для SQLite
+        await db.executemany("""
+            INSERT INTO messages (user_id, chat_id, username, today, total, first_seen, last_updated, day)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+            ON CONFLICT (user_id, chat_id) DO UPDATE SET
+                yesterday = CASE WHEN messages.day = excluded.day THEN messages.yesterday
+                                 WHEN messages.day = $9 THEN messages.today
+                                 WHEN messages.day = $10 THEN messages.yesterday + excluded.today
+                                 WHEN messages.day > excluded.day THEN messages.yesterday
+                                 ELSE 0 END,
+                today = CASE WHEN messages.day = excluded.day THEN messages.today + excluded.today
+                             WHEN messages.day > excluded.day THEN messages.today
+                             ELSE excluded.today END,
+                day = GREATEST(COALESCE(messages.day, ''), excluded.day),
+                total = messages.total + excluded.total,
+                username = CASE WHEN excluded.day >= COALESCE(messages.day, '') THEN excluded.username
+                                ELSE messages.username END,
+                first_seen = LEAST(COALESCE(messages.first_seen, excluded.first_seen), excluded.first_seen),
+                last_updated = GREATEST(COALESCE(messages.last_updated, ''), excluded.last_updated)
+        """, [
+            (user_id, chat_id, username, count, count, first_time, last_time, day,
+             shift_day(day, -1), shift_day(day, 1))
+            for (chat_id, user_id, day), (count, username, first_time, last_time)
+            in sorted(counters.items(), key=lambda item: item[0][2])
+        ])
+        
+        await db.executemany("""
+            INSERT INTO user_totals (user_id, total, today, day, chats_count, first_seen, last_updated)
+            VALUES ($1, $2, $3, $4, $5, $6, $7)
+            ON CONFLICT (user_id) DO UPDATE SET
+                today = CASE WHEN user_totals.day = excluded.day THEN user_totals.today + excluded.today
+                             WHEN user_totals.day > excluded.day THEN user_totals.today
+                             ELSE excluded.today END,
+                day = GREATEST(COALESCE(user_totals.day, ''), excluded.day),
+                total = user_totals.total + excluded.total,
+                chats_count = user_totals.chats_count + excluded.chats_count,
+                first_seen = LEAST(COALESCE(user_totals.first_seen, excluded.first_seen), excluded.first_seen),
+                last_updated = GREATEST(COALESCE(user_totals.last_updated, ''), excluded.last_updated)
+        """, user_totals_rows(counters, new_members))
+        
+        # Дневная статистика участников одним запросом; новые значения нужны для итогов чата
+        keys = list(counters)
+        user_counts = await db.fetch("""
+            INSERT INTO user_daily_stats (chat_id, date, user_id, message_count)
+            SELECT * FROM unnest($1::BIGINT[], $2::TEXT[], $3::BIGINT[], $4::BIGINT[])
+            ON CONFLICT (chat_id, date, user_id) DO UPDATE SET
+                message_count = user_daily_stats.message_count + excluded.message_count
+            RETURNING chat_id, date, user_id, message_count
+        """, [key[0] for key in keys], [key[2] for key in keys], [key[1] for key in keys],
+            [counters[key][0] for key in keys])
+        
+        await db.executemany("""
+            INSERT INTO chat_daily_stats
+            (chat_id, date, total_messages, active_users, top_user_id, top_user_count)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            ON CONFLICT (chat_id, date) DO UPDATE SET
+                total_messages = chat_daily_stats.total_messages + excluded.total_messages,
+                active_users = chat_daily_stats.active_users + excluded.active_users,
+                top_user_id = CASE WHEN excluded.top_user_count > chat_daily_stats.top_user_count
+                                   THEN excluded.top_user_id ELSE chat_daily_stats.top_user_id END,
+                top_user_count = GREATEST(chat_daily_stats.top_user_count, excluded.top_user_count)
+        """, chat_daily_rows(counters, user_counts))
+    
+    async def write_counters(self, counters, history, chat_activity, profiles, checkpoint=None):
+        await self._write(self._write_counter_batch, counters, history, chat_activity, profiles, checkpoint)
+    
+    async def get_journal_checkpoint(self, journal):
+        return await self.pool.fetchval(
+            "SELECT segment FROM journal_checkpoints WHERE journal = $1", journal
+        ) or 0
+    
+    async def read_leaderboard(self, chat_id):
+        return await self._write(lambda db: db.fetch("""
+            SELECT user_id, username, today, yesterday, total, day
+            FROM messages 
+            WHERE chat_id = $1
+            AND (today > 0 OR yesterday > 0 OR total > 0)
+        """, chat_id))
+    
+    async def get_user_profile(self, user_id):
+        return await self.pool.fetchrow(
+            "SELECT username, full_name FROM user_profiles WHERE user_id = $1", user_id
+        )
+    
+    async def get_user_stats(self, chat_id, user_id, today_day):
+        return await self.pool.fetchrow("""
+            SELECT m.username,
+                   CASE WHEN m.day = $1 THEN m.today ELSE 0 END,
+                   CASE WHEN m.day = $1 THEN m.yesterday WHEN m.day = $2 THEN m.today ELSE 0 END,
+                   m.total, m.first_seen,
+                   COALESCE(u.total, m.total),
+                   CASE WHEN u.day = $1 THEN u.today ELSE 0 END,
+                   COALESCE(u.chats_count, 1)
+            FROM messages m LEFT JOIN user_totals u ON u.user_id = m.user_id
+            WHERE m.user_id = $3 AND m.chat_id = $4
+        """, today_day, shift_day(today_day, -1), user_id, chat_id)
+    
+    async def yesterday_top(self, chat_id, today_day, limit):
+        yesterday_params = (today_day, shift_day(today_day, -1), chat_id)
+        rows = await self.pool.fetch("""
+            SELECT username, count FROM (
+                SELECT username,
+                       CASE WHEN day = $1 THEN yesterday WHEN day = $2 THEN today ELSE 0 END AS count
+                FROM messages 
+                WHERE chat_id = $3
+            ) AS yesterday_counts
+            WHERE count > 0 
+            ORDER BY count DESC 
+            LIMIT $4
+        """, *yesterday_params, limit)
+        
+        total = await self.pool.fetchval("""
+            SELECT COALESCE(SUM(CASE WHEN day = $1 THEN yesterday WHEN day = $2 THEN today ELSE 0 END), 0)::BIGINT
+            FROM messages WHERE chat_id = $3
+        """, *yesterday_params)
+        
+        return rows, total
+    
+    async def reset_today(self, chat_id, today_day):
+        async def reset(db):
+            # Итоги берем из самих счетчиков: дневная статистика не учитывает прошлые сбросы
+            day_stats = await db.fetchrow("""
+                SELECT COALESCE(SUM(today), 0)::BIGINT, COUNT(*) FROM messages
+                WHERE chat_id = $1 AND day = $2 AND today > 0
+            """, chat_id, today_day)
+            
+            await db.execute("""
+                UPDATE user_totals u
+                SET today = GREATEST(0, u.today - m.today)
+                FROM messages m
+                WHERE m.chat_id = $1 AND m.day = $2 AND m.today > 0
+                AND u.user_id = m.user_id AND u.day = $2
+            """, chat_id, today_day)
+            
+            await db.execute("""
+                UPDATE messages
+                SET yesterday = CASE WHEN day = $1 THEN today ELSE 0 END,
+                    today = 0,
+                    day = $1
+                WHERE chat_id = $2
+            """, today_day, chat_id)
+            
+            return tuple(day_stats)
+        
+        return await self._write(reset)
+    
+    async def period_stats(self, chat_id, start_day, end_day):
+        return await self.pool.fetch("""
+            SELECT date, total_messages, active_users 
+            FROM chat_daily_stats 
+            WHERE chat_id = $1 AND date BETWEEN $2 AND $3
+            ORDER BY date DESC
+        """, chat_id, start_day, end_day)
+    
+    async def day_totals(self, day):
+        return await self.pool.fetchrow("""
+            SELECT SUM(total_messages)::BIGINT, SUM(active_users)::BIGINT FROM chat_daily_stats WHERE date = $1
+        """, day)
+    
+    async def daily_report_rows(self, today_day, limit, chat_ids=None):
+        chat_filter = "AND m.chat_id = ANY($3::BIGINT[])" if chat_ids is not None else ""
+        params = (today_day, limit) if chat_ids is None else (today_day, limit, list(chat_ids))
+        
+        return await self.pool.fetch(f"""
+            SELECT chat_id, chat_title, username, today, members, today_sum, active_count
+            FROM (
+                SELECT chat_id, chat_title, username, today,
+                       ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY today DESC, total DESC, user_id) AS place,
+                       COUNT(*) OVER (PARTITION BY chat_id) AS members,
+                       SUM(today) OVER (PARTITION BY chat_id)::BIGINT AS today_sum,
+                       COUNT(*) FILTER (WHERE today > 0) OVER (PARTITION BY chat_id) AS active_count
+                FROM (
+                    SELECT m.chat_id, c.chat_title, m.user_id, m.username, m.total,
+                           CASE WHEN m.day = $1 THEN m.today ELSE 0 END AS today
+                    FROM messages m
+                    JOIN chat_settings c ON c.chat_id = m.chat_id
+                    WHERE c.chat_type IN ('group', 'supergroup')
+                    AND c.is_active = 1
+                    AND (m.today > 0 OR m.yesterday > 0 OR m.total > 0)
+                    {chat_filter}
+                ) AS member_rows
+            ) AS ranked
+            WHERE place <= $2
+            ORDER BY chat_id, place
+        """, *params)
+    
+    async def save_mention(self, chat_id, user_id, username, mention_type, message):
+        mention_time = datetime.now().isoformat()
+        
+        async def save(db):
+            await db.execute("""
+                INSERT INTO mentions_history 
+                (chat_id, user_id, username, mention_time, mention_type, message)
+                VALUES ($1, $2, $3, $4, $5, $6)
+            """, chat_id, user_id, username, mention_time, mention_type, message)
+            await db.execute("""
+                UPDATE chat_settings SET last_mention_time = $1 WHERE chat_id = $2
+            """, mention_time, chat_id)
+        
+        await self._write(save)
+    
+    async def reconcile_chunk(self, position, limit):
+        async def reconcile(db):
+            # Позиция - ключ (user_id, chat_id) последней проверенной строки
+            user_after, chat_after = position or (None, None)
+            rows = await db.fetch("""
+                SELECT m.user_id, m.chat_id, m.total, (
+                    SELECT COALESCE(SUM(message_count), 0)::BIGINT FROM message_history h
+                    WHERE h.chat_id = m.chat_id AND h.user_id = m.user_id
+                )
+                FROM messages m
+                WHERE $1::BIGINT IS NULL OR (m.user_id, m.chat_id) > ($1, $2)
+                ORDER BY m.user_id, m.chat_id
+                LIMIT $3
+            """, user_after, chat_after, limit)
+            
+            drift = [((user_id, chat_id), user_id, chat_id, total, history_count)
+                     for user_id, chat_id, total, history_count in rows
+                     if total != history_count and owns_chat(chat_id)]
+            
+            fixes = [(history_count, user_id, chat_id)
+                     for _, user_id, chat_id, total, history_count in drift if history_count > total]
+            if fixes:
+                await db.executemany("""
+                    UPDATE messages SET total = $1 WHERE user_id = $2 AND chat_id = $3 AND total < $1
+                """, fixes)
+                await db.executemany("""
+                    UPDATE user_totals SET total = total + $1 WHERE user_id = $2
+                """, [(history_count - total, user_id)
+                      for _, user_id, chat_id, total, history_count in drift if history_count > total])
+            
+            last_key = (rows[-1][0], rows[-1][1]) if rows else None
+            return len(rows), last_key, drift
+        
+        return await self._write(reconcile)
+    
+    async def compact_history(self, cutoff):
+        bounds = await self.pool.fetchrow("SELECT MIN(id), MAX(id) FROM all_messages_history")
+        if not bounds or bounds[0] is None:
+            return 0
+        
+        first_id, max_id = bounds
+        compacted = 0
+        
+        async def compact_chunk(db, first_id, last_id):
+            await db.execute("""
+                INSERT INTO message_rollup (chat_id, user_id, hour_bucket, message_count)
+                SELECT chat_id, user_id,
+                       COALESCE(replace(substr(message_date, 1, 13), ' ', 'T') || ':00:00', '1970-01-01T00:00:00'),
+                       SUM(message_count)
+                FROM all_messages_history
+                WHERE id BETWEEN $1 AND $2 AND (message_date < $3 OR message_date IS NULL)
+                GROUP BY 1, 2, 3
+                ON CONFLICT (chat_id, user_id, hour_bucket) DO UPDATE SET
+                    message_count = message_rollup.message_count + excluded.message_count
+            """, first_id, last_id, cutoff)
+            
+            status = await db.execute("""
+                DELETE FROM all_messages_history
+                WHERE id BETWEEN $1 AND $2 AND (message_date < $3 OR message_date IS NULL)
+            """, first_id, last_id, cutoff)
+            return int(status.split()[-1])
+        
+        while first_id <= max_id and not is_shutting_down:
+            last_id = min(first_id + HISTORY_COMPACTION_CHUNK - 1, max_id)
+            compacted += await self._write(compact_chunk, first_id, last_id)
+            first_id = last_id + 1
+        
+        return compacted
+    
+    async def vacuum(self):
+        await self.pool.execute("VACUUM ANALYZE")
+    
+    async def get_import_state(self, source):
+        return await self.pool.fetchrow("""
+            SELECT file_size, byte_offset, chat_id, messages_imported, status
+            FROM history_imports WHERE source = $1
+        """, source)
+    
+    async def start_import(self, source, file_size, byte_offset, messages_imported):
+        current_time = datetime.now().isoformat()
+        await self._write(lambda db: db.execute("""
+            INSERT INTO history_imports
+            (source, file_size, byte_offset, messages_imported, status, started_at, updated_at)
+            VALUES ($1, $2, $3, $4, 'running', $5, $5)
+            ON CONFLICT (source) DO UPDATE SET
+                file_size = excluded.file_size,
+                byte_offset = excluded.byte_offset,
+                messages_imported = excluded.messages_imported,
+                status = 'running',
+                updated_at = excluded.updated_at
+        """, source, file_size, byte_offset, messages_imported, current_time))
+    
+    async def load_import_chat(self, chat_id):
+        return await self.pool.fetchrow("""
+            SELECT
+                (SELECT last_message_id FROM imported_chats WHERE chat_id = $1),
+                (SELECT replace(created_at, ' ', 'T') FROM chat_settings WHERE chat_id = $1)
+        """, chat_id)
+    
+    async def write_import_batch(self, source, chat_id, batch, byte_offset, messages_imported):
+        async def write(db):
+            await self._write_counter_batch(db, batch['counters'], batch['history'], {}, {})
+            
+            if batch['history']:
+                await db.execute("""
+                    INSERT INTO imported_chats (chat_id, last_message_id, last_message_date, messages_imported)
+                    VALUES ($1, $2, $3, $4)
+                    ON CONFLICT (chat_id) DO UPDATE SET
+                        last_message_id = GREATEST(imported_chats.last_message_id, excluded.last_message_id),
+                        last_message_date = GREATEST(imported_chats.last_message_date, excluded.last_message_date),
+                        messages_imported = imported_chats.messages_imported + excluded.messages_imported
+                """, chat_id, batch['last_message_id'], batch['last_message_date'], len(batch['history']))
+                await db.execute(
+                    "UPDATE chat_settings SET total_messages_before_bot = 0 WHERE chat_id = $1", chat_id
+                )
+            
+            await db.execute("""
+                UPDATE history_imports
+                SET byte_offset = $1, chat_id = $2, messages_imported = $3, updated_at = $4
+                WHERE source = $5
+            """, byte_offset, None if batch['finished'] else chat_id, messages_imported,
+                 datetime.now().isoformat(), source)
+        
+        await self._write(write)
+    
+    async def finish_import(self, source):
+        await self._write(lambda db: db.execute("""
+            UPDATE history_imports SET status = 'done', updated_at = $1 WHERE source = $2
+        """, datetime.now().isoformat(), source))
+    
+    async def list_imports(self, limit):
+        return await self.pool.fetch("""
+            SELECT source, file_size, byte_offset, messages_imported, status
+            FROM history_imports ORDER BY started_at DESC LIMIT $1
+        """, limit)
+
+async def init_storage():
+    """Открыть хранилище, выбранное STORAGE_BACKEND"""
+    global storage
+    
+    if STORAGE_BACKEND == "postgres":
+        storage = PostgresStorage(DATABASE_URL)
+    else:
+        storage = SQLiteStorage()
+    await storage.open()
+
+async def close_storage():
+    """Закрыть хранилище"""
+    global storage
+    
+    if storage:
+        await storage.close()
+        storage = None
+
+# ==================== РЕЕСТР ЧАТОВ ====================
+async def load_chat_registry():
+    """Загрузить настройки всех чатов в память"""
+    rows = await storage.load_chats()
+    
+    chat_registry.clear()
+    for chat_id, chat_title, chat_type, is_active, enable_mentions in rows:
+        chat_registry[chat_id] = {
+            'title': chat_title,
+            'type': chat_type,
+            'is_active': is_active,
+            'enable_mentions': enable_mentions,
+        }
+    
+    logger.info(f"Загружены настройки {len(chat_registry)} чатов")
+
+def _insert_chat_settings(db, chat_id, chat_title, chat_type, current_time):
+    db.execute("""
+        INSERT OR IGNORE INTO chat_settings 
+        (chat_id, chat_title, chat_type, is_active, enable_mentions, created_at, last_activity, total_messages_before_bot)
+        VALUES (?, ?, ?, 1, 1, ?, ?, 0)
+    """, (chat_id, chat_title, chat_type, current_time, current_time))
+
+def history_hour_bucket(cutoff: str) -> str:
+    """Часовая корзина message_rollup, с которой начинается час cutoff"""
+    return cutoff[:13] + ":00:00"
+
+def _estimate_messages_before_bot(db, chat_id, cutoff):
+    # Импортированная история уже входит в счетчики участников
+    if db.execute("SELECT 1 FROM imported_chats WHERE chat_id = ?", (chat_id,)).fetchone():
+        return 0
+    
+    # Сообщения, записанные после регистрации чата, уже посчитаны ботом
+    messages_before = db.execute("""
+        SELECT (SELECT COALESCE(SUM(message_count), 0) FROM all_messages_history
+                WHERE chat_id = ? AND message_date < ?)
+             + (SELECT COALESCE(SUM(message_count), 0) FROM message_rollup
+                WHERE chat_id = ? AND hour_bucket < ?)
+    """, (chat_id, cutoff, chat_id, history_hour_bucket(cutoff))).fetchone()[0]
+    
+    if messages_before:
+        db.execute("""
+            UPDATE chat_settings SET total_messages_before_bot = ? WHERE chat_id = ?
+        """, (messages_before, chat_id))
+    return messages_before
+
+async def estimate_messages_before_bot(chat_id: int, cutoff: str):
+    """Оценить количество сообщений чата до добавления бота (вне обработки сообщений)"""
+    try:
+        await storage.estimate_messages_before_bot(chat_id, cutoff)
+    except Exception as e:
+        logger.error(f"Ошибка оценки истории чата {chat_id}: {e}")
+
+async def update_chat_settings(chat_id: int, chat_title: str = None, chat_type: str = None):
+    """Обновить настройки чата"""
+    try:
+        current_time = datetime.now().isoformat()
+        entry = chat_registry.get(chat_id)
+        
+        if entry is None:
+            # Создаем новую запись
+            entry = {
+                'title': chat_title or f"Chat {chat_id}",
+                'type': chat_type or "private",
+                'is_active': 1,
+                'enable_mentions': 1,
+            }
+            chat_registry[chat_id] = entry
+            await storage.insert_chat(chat_id, entry['title'], entry['type'], current_time)
+            
+            # Пытаемся оценить количество сообщений до добавления бота; граница -
+            # время до регистрации, поэтому записанные позже сообщения в оценку не попадут
+            run_in_background(estimate_messages_before_bot(chat_id, current_time))
+            return
+        
+        # В БД пишем только реальные изменения названия или типа
+        changes = {}
+        
+        if chat_title and chat_title != entry['title']:
+            changes['chat_title'] = chat_title
+            entry['title'] = chat_title
+        
+        if chat_type and chat_type != entry['type']:
+            changes['chat_type'] = chat_type
+            entry['type'] = chat_type
+        
+        if changes:
+            await storage.update_chat(chat_id, changes, current_time)
+        else:
+            # Время активности копится в памяти и пишется вместе со счетчиками
+            pending_chat_activity[chat_id] = current_time
+        
+    except Exception as e:
+        logger.error(f"Ошибка обновления настроек чата {chat_id}: {e}")
+
+# ==================== БУФЕР СЧЕТЧИКОВ ====================
+def current_day() -> str:
+    """Текущий день в формате YYYY-MM-DD, к которому относятся счетчики today"""
+    return datetime.now().strftime('%Y-%m-%d')
+
+def shift_day(day: str, days: int) -> str:
+    """День, отстоящий от day на days дней"""
+    return (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=days)).strftime('%Y-%m-%d')
+
+def buffer_message(chat_id: int, user_id: int, username: str, message_time: datetime):
+    """Учесть сообщение в буфере счетчиков, не обращаясь к БД"""
+    message_time_str = message_time.isoformat()
+    key = (chat_id, user_id, message_time.strftime('%Y-%m-%d'))
+    
+    entry = pending_counters.get(key)
+    if entry:
+        entry[0] += 1
+        entry[1] = username
+        entry[3] = message_time_str
+    else:
+        pending_counters[key] = [1, username, message_time_str, message_time_str]
+    
+    pending_history.append((chat_id, user_id, username, message_time_str))
+
+def restore_pending(counters: dict, history: list):
+    """Вернуть несохраненные данные в буфер после ошибки записи"""
+    for key, (count, username, first_time, last_time) in counters.items():
+        entry = pending_counters.get(key)
+        if entry:
+            entry[0] += count
+            entry[2] = min(entry[2], first_time)
+            entry[3] = max(entry[3], last_time)
+        else:
+            pending_counters[key] = [count, username, first_time, last_time]
+    
+    pending_history[:0] = history
+
+def history_bucket(message_time_str: str) -> str:
+    """Час, к которому относится сообщение, в формате YYYY-MM-DDTHH:00:00"""
+    return message_time_str[:13] + ":00:00"
+
+def rollup_history(history) -> dict:
+    """Свернуть строки истории в {(chat_id, user_id, час): количество}"""
+    buckets = {}
+    for chat_id, user_id, username, message_time_str in history:
+        key = (chat_id, user_id, history_bucket(message_time_str))
+        buckets[key] = buckets.get(key, 0) + 1
+    return buckets
+
+def write_history(db, history):
+    """Записать историю сообщений построчно или сразу в почасовые агрегаты"""
+    if WRITE_RAW_HISTORY:
+        db.executemany("""
+            INSERT INTO all_messages_history 
+            (chat_id, user_id, username, message_date, message_count)
+            VALUES (?, ?, ?, ?, 1)
+        """, history)
+        return
+    
+    buckets = rollup_history(history)
+    
+    db.executemany("""
+        INSERT INTO message_rollup (chat_id, user_id, hour_bucket, message_count)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (chat_id, user_id, hour_bucket) DO UPDATE SET
+            message_count = message_count + excluded.message_count
+    """, [(chat_id, user_id, bucket, count) for (chat_id, user_id, bucket), count in buckets.items()])
+
+def _write_counter_batch(db, counters, history, chat_activity, profiles, checkpoint=None):
+    # Сегмент журнала отмечается в той же транзакции: после сбоя он не будет применен повторно
+    if checkpoint:
+        db.execute("""
+            INSERT INTO journal_checkpoints (journal, segment) VALUES (?, ?)
+            ON CONFLICT (journal) DO UPDATE SET
+                segment = MAX(journal_checkpoints.segment, excluded.segment)
+        """, checkpoint)
+    
+    db.executemany(
+        "UPDATE chat_settings SET last_activity = ? WHERE chat_id = ?",
+        [(activity_time, chat_id) for chat_id, activity_time in chat_activity.items()]
+    )
+    
+    db.executemany("""
+        INSERT INTO user_profiles (user_id, username, full_name, updated_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            username = excluded.username,
+            full_name = excluded.full_name,
+            updated_at = excluded.updated_at
+    """, [(user_id, *profile) for user_id, profile in profiles.items()])
+    
+    # Сортируем по дню, чтобы смена суток применялась в правильном порядке
+    rows = [
+        (user_id, chat_id, username, count, count, first_time, last_time, day,
+         shift_day(day, -1), shift_day(day, 1))
+        for (chat_id, user_id, day), (count, username, first_time, last_time)
+        in sorted(counters.items(), key=lambda item: item[0][2])
+    ]
+    
+    write_history(db, history)
+    
+    # Новые пары чат-участник определяем до вставки строк в messages
+    new_members = {
+        (chat_id, user_id) for chat_id, user_id, _ in counters
+        if db.execute(
+            "SELECT 1 FROM messages WHERE user_id = ? AND chat_id = ?", (user_id, chat_id)
+        ).fetchone() is None
+    }
+    
+    # История и total меняются на одну и ту же величину в одной транзакции,
+    # поэтому пересчитывать историю пользователя здесь не нужно.
+    # Смена суток: если строка относится к предыдущему дню, today становится
+    # yesterday; если к более старому - оба обнуляются. Сообщения за прошедший
+    # день (после перезапуска) попадают в yesterday или только в total.
+    db.executemany("""
+        INSERT INTO messages (user_id, chat_id, username, today, total, first_seen, last_updated, day)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, chat_id) DO UPDATE SET
+            yesterday = CASE WHEN messages.day = excluded.day THEN messages.yesterday
+                             WHEN messages.day = ? THEN messages.today
+                             WHEN messages.day = ? THEN messages.yesterday + excluded.today
+                             WHEN messages.day > excluded.day THEN messages.yesterday
+                             ELSE 0 END,
+            today = CASE WHEN messages.day = excluded.day THEN messages.today + excluded.today
+                         WHEN messages.day > excluded.day THEN messages.today
+                         ELSE excluded.today END,
+            day = MAX(COALESCE(messages.day, ''), excluded.day),
+            total = messages.total + excluded.total,
+            username = CASE WHEN excluded.day >= COALESCE(messages.day, '') THEN excluded.username
+                            ELSE messages.username END,
+            first_seen = MIN(COALESCE(messages.first_seen, excluded.first_seen), excluded.first_seen),
+            last_updated = MAX(COALESCE(messages.last_updated, ''), excluded.last_updated)
+    """, rows)
+    
+    # Итоги по всем чатам: та же смена суток, что и у строк messages
+    db.executemany("""
+        INSERT INTO user_totals (user_id, total, today, day, chats_count, first_seen, last_updated)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            today = CASE WHEN user_totals.day = excluded.day THEN user_totals.today + excluded.today
+                         WHEN user_totals.day > excluded.day THEN user_totals.today
+                         ELSE excluded.today END,
+            day = MAX(COALESCE(user_totals.day, ''), excluded.day),
+            total = user_totals.total + excluded.total,
+            chats_count = user_totals.chats_count + excluded.chats_count,
+            first_seen = MIN(COALESCE(user_totals.first_seen, excluded.first_seen), excluded.first_seen),
+            last_updated = MAX(COALESCE(user_totals.last_updated, ''), excluded.last_updated)
+    """, user_totals_rows(counters, new_members))
+    
+    write_daily_stats(db, counters)
+
+def chat_daily_rows(counters, user_counts):
+    """Строки chat_daily_stats по пачке: (chat_id, date, сообщений, новых активных,
+    лучший участник, его сообщений за день); user_counts - [(chat_id, date, user_id, всего за день)]"""
+    chat_days = {}  # (chat_id, date) -> [сообщений, новых активных, top_user_id, top_user_count]
+    for chat_id, day, user_id, user_count in user_counts:
+        count = counters[(chat_id, user_id, day)][0]
+        entry = chat_days.setdefault((chat_id, day), [0, 0, None, 0])
+        entry[0] += count
+        # Участник активен впервые за день, если за день у него только сообщения этой пачки
+        if user_count == count:
+            entry[1] += 1
+        if user_count > entry[3]:
+            entry[2], entry[3] = user_id, user_count
+    return [(chat_id, day, *entry) for (chat_id, day), entry in chat_days.items()]
+
+def user_totals_rows(counters, new_members):
+    """Строки для user_totals: по одной на пользователя и день, в порядке дней"""
+    totals = {}  # (user_id, day) -> [сообщений, первое, последнее]
+    for (chat_id, user_id, day), (count, _, first_time, last_time) in counters.items():
+        entry = totals.get((user_id, day))
+        if entry is None:
+            totals[(user_id, day)] = [count, first_time, last_time]
+        else:
+            entry[0] += count
+            entry[1] = min(entry[1], first_time)
+            entry[2] = max(entry[2], last_time)
+    
+    new_chats = {}
+    for _, user_id in new_members:
+        new_chats[user_id] = new_chats.get(user_id, 0) + 1
+    
+    # Новые чаты учитываются в первой строке пользователя
+    return [
+        (user_id, count, count, day, new_chats.pop(user_id, 0), first_time, last_time)
+        for (user_id, day), (count, first_time, last_time)
+        in sorted(totals.items(), key=lambda item: item[0][1])
+    ]
+
+def write_daily_stats(db, counters):
+    """Добавить пачку счетчиков в дневную статистику участников и чатов"""
+    for (chat_id, user_id, day), (count, _, _, _) in counters.items():
+        user_count = db.execute("""
+            INSERT INTO user_daily_stats (chat_id, date, user_id, message_count)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (chat_id, date, user_id) DO UPDATE SET
+                message_count = message_count + excluded.message_count
+            RETURNING message_count
+        """, (chat_id, day, user_id, count)).fetchone()[0]
+        
+        # Участник стал активным за день, если его строка только что создана
+        db.execute("""
+            INSERT INTO chat_daily_stats
+            (chat_id, date, total_messages, active_users, top_user_id, top_user_count)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (chat_id, date) DO UPDATE SET
+                total_messages = total_messages + excluded.total_messages,
+                active_users = active_users + excluded.active_users,
+                top_user_id = CASE WHEN excluded.top_user_count > top_user_count
+                                   THEN excluded.top_user_id ELSE top_user_id END,
+                top_user_count = MAX(top_user_count, excluded.top_user_count)
+        """, (chat_id, day, count, 1 if user_count == count else 0, user_id, user_count))
+
+async def flush_counters():
+    """Записать накопленные счетчики в БД одной транзакцией"""
+    global pending_counters, pending_history, pending_chat_activity, pending_profiles, flush_seq
+    
+    if not pending_counters and not pending_chat_activity and not pending_profiles:
+        return
+    
+    counters, history = pending_counters, pending_history
+    chat_activity, profiles = pending_chat_activity, pending_profiles
+    pending_counters, pending_history, pending_chat_activity, pending_profiles = {}, [], {}, {}
+    flush_seq += 1
+    batch_seq = flush_seq
+    # Записи пачки закрывают текущий сегмент журнала, новые сообщения идут в следующий
+    checkpoint = counter_journal.rotate() if counter_journal else None
+    
+    # Пачки фиксируются в порядке закрытия сегментов: отметка более поздней
+    # пачки не должна попасть в БД раньше более ранней, пока та сбрасывает сегмент
+    async with flush_lock:
+        try:
+            if counter_journal:
+                await counter_journal.sync_closed()
+            await storage.write_counters(counters, history, chat_activity, profiles, checkpoint)
+        except Exception as e:
+            logger.error(f"Ошибка записи буфера счетчиков: {e}")
+            restore_pending(counters, history)
+            if counter_journal:
+                await counter_journal.requeue(checkpoint[1], history)
+            for chat_id, activity_time in chat_activity.items():
+                pending_chat_activity.setdefault(chat_id, activity_time)
+            for user_id, profile in profiles.items():
+                pending_profiles.setdefault(user_id, profile)
+            return
+        
+        # Отметка записана с полной синхронизацией, сегменты больше не нужны
+        if counter_journal:
+            counter_journal.release(checkpoint[1])
+    
+    apply_to_leaderboards(batch_seq, counters)
+    
+    logger.debug(f"Записано {len(history)} сообщений ({len(counters)} счетчиков)")
+
+# ==================== ЖУРНАЛ СЧЕТЧИКОВ ====================
+class CounterJournal:
+    """Журнал сообщений, попавших в буфер счетчиков, но еще не записанных в БД.
+    
+    Записи добавляются в конец файла текущего сегмента через буфер и периодически
+    сбрасываются на диск. Каждая запись буфера в БД закрывает сегмент и отмечает
+    его номер в journal_checkpoints той же транзакцией; при запуске сегменты
+    после отметки применяются заново.
+    """
+    
+    # chat_id, user_id, время сообщения (unix), длина имени; затем имя в UTF-8
+    RECORD = struct.Struct("<qqdH")
+    
+    def __init__(self, path: str, name: str):
+        self.path = path
+        self.name = name  # ключ в journal_checkpoints
+        self.segment = 0  # номер текущего сегмента
+        self.file = None  # открывается при первой записи в сегмент
+        self.closed = []  # закрытые сегменты, ожидающие записи в БД
+        self.unsynced = []  # файлы закрытых сегментов, еще не сброшенные на диск
+        self.dirty = False
+    
+    def segment_path(self, segment: int) -> str:
+        return f"{self.path}.{segment}"
+    
+    def list_segments(self):
+        """Номера сегментов, оставшихся на диске"""
+        directory, prefix = os.path.split(os.path.abspath(self.path))
+        segments = []
+        for filename in os.listdir(directory):
+            suffix = filename[len(prefix) + 1:]
+            if filename.startswith(prefix + ".") and suffix.isdigit():
+                segments.append(int(suffix))
+        return sorted(segments)
+    
+    def read_segment(self, segment: int):
+        """Записи сегмента: (chat_id, user_id, username, время); оборванный хвост пропускается"""
+        with open(self.segment_path(segment), "rb") as journal_file:
+            data = journal_file.read()
+        
+        offset = 0
+        while offset + self.RECORD.size <= len(data):
+            chat_id, user_id, timestamp, name_length = self.RECORD.unpack_from(data, offset)
+            offset += self.RECORD.size
+            if offset + name_length > len(data):
+                break
+            username = data[offset:offset + name_length].decode("utf-8", errors="replace")
+            offset += name_length
+            yield chat_id, user_id, username, datetime.fromtimestamp(timestamp)
+        
+        if offset < len(data):
+            logger.warning(f"Журнал {self.segment_path(segment)}: оборванная запись в конце пропущена")
+    
+    def start(self, segment: int):
+        """Начать запись с сегмента segment"""
+        self.segment = segment
+    
+    def append(self, chat_id: int, user_id: int, username: str, message_time: datetime):
+        if self.file is None:
+            self.file = open(self.segment_path(self.segment), "ab", buffering=JOURNAL_BUFFER_SIZE)
+        name = username.encode("utf-8")[:0xFFFF]
+        self.file.write(self.RECORD.pack(chat_id, user_id, message_time.timestamp(), len(name)) + name)
+        self.dirty = True
+    
+    def sync_directory(self):
+        """Сбросить на диск каталог журнала: создание и удаление сегментов"""
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    
+    def take_closed(self, segment: int):
+        """Убрать из списка закрытые сегменты до segment включительно и вернуть их"""
+        taken = [closed for closed in self.closed if closed <= segment]
+        self.closed = [closed for closed in self.closed if closed > segment]
+        return taken
+    
+    def remove_segments(self, segments):
+        for segment in segments:
+            try:
+                os.remove(self.segment_path(segment))
+            except FileNotFoundError:
+                pass
+    
+    def _persist_requeue(self, fd, segments):
+        if fd is not None:
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.remove_segments(segments)
+        self.sync_directory()
+    
+    async def requeue(self, segment: int, history):
+        """Перенести сообщения незаписанной пачки в текущий сегмент.
+        
+        Следующая пачка отметит более поздний сегмент, и закрытый сегмент
+        перестал бы применяться при запуске, хотя его сообщения еще в буфере.
+        Закрытые сегменты до segment включительно либо уже записаны в БД, либо
+        их сообщения входят в пачку (в том числе примененные при запуске), поэтому
+        после переноса они удаляются, иначе при следующем запуске сообщения
+        применились бы дважды.
+        """
+        for chat_id, user_id, username, message_time_str in history:
+            self.append(chat_id, user_id, username, datetime.fromisoformat(message_time_str))
+        
+        fd = None
+        if self.file is not None:
+            self.file.flush()
+            self.dirty = False
+            fd = os.dup(self.file.fileno())
+        # Старые сегменты удаляются только после fsync их копии
+        await asyncio.to_thread(self._persist_requeue, fd, self.take_closed(segment))
+    
+    def rotate(self):
+        """Закрыть текущий сегмент, вернуть отметку (журнал, сегмент) для пачки.
+        
+        Новые сообщения сразу идут в следующий сегмент; закрытый сбрасывает
+        на диск sync_closed() до записи отметки в БД.
+        """
+        if self.file is not None:
+            self.unsynced.append(self.file)
+            self.file = None
+            self.dirty = False
+            self.closed.append(self.segment)
+        
+        checkpoint = (self.name, self.segment)
+        self.segment += 1
+        return checkpoint
+    
+    def _close_files(self, files):
+        try:
+            for journal_file in files:
+                try:
+                    journal_file.flush()
+                    os.fsync(journal_file.fileno())
+                finally:
+                    journal_file.close()
+        finally:
+            self.sync_directory()
+    
+    async def sync_closed(self):
+        """Сбросить на диск закрытые сегменты и каталог в отдельном потоке.
+        
+        Вызывается до записи отметки в БД: иначе после сбоя отметка могла бы
+        указывать на сегмент, которого нет на диске.
+        """
+        if not self.unsynced:
+            return
+        files, self.unsynced = self.unsynced, []
+        await asyncio.to_thread(self._close_files, files)
+    
+    def release(self, segment: int):
+        """Удалить сегменты, записанные в БД до segment включительно"""
+        self.remove_segments(self.take_closed(segment))
+    
+    async def sync(self):
+        """Сбросить буфер текущего сегмента на диск"""
+        if self.file is None or not self.dirty:
+            return
+        
+        self.file.flush()
+        self.dirty = False
+        # fsync в отдельном потоке; копия дескриптора переживет закрытие сегмента
+        fd = os.dup(self.file.fileno())
+        try:
+            await asyncio.to_thread(os.fsync, fd)
+        finally:
+            os.close(fd)
+    
+    def close(self):
+        for journal_file in self.unsynced:
+            journal_file.close()
+        self.unsynced = []
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+async def open_journal():
+    """Применить оставшиеся после сбоя сегменты журнала и начать новый"""
+    global counter_journal
+    
+    if not JOURNAL_PATH:
+        return
+    
+    if worker_id is None:
+        journal = CounterJournal(JOURNAL_PATH, "main")
+    else:
+        journal = CounterJournal(f"{JOURNAL_PATH}.worker{worker_id}", f"worker-{worker_id}")
+    
+    started = time.monotonic()
+    checkpoint = await storage.get_journal_checkpoint(journal.name)
+    segments = journal.list_segments()
+    replayed = 0
+    
+    for segment in segments:
+        if segment > checkpoint:
+            for chat_id, user_id, username, message_time in journal.read_segment(segment):
+                buffer_message(chat_id, user_id, username, message_time)
+                replayed += 1
+        # Уже записанные сегменты удаляются с первой же пачкой
+        journal.closed.append(segment)
+    
+    journal.start(max(segments + [checkpoint]) + 1)
+    counter_journal = journal
+    
+    if replayed:
+        rows = len(pending_counters)
+        await flush_counters()
+        logger.info(
+            f"Из журнала восстановлено {replayed} сообщений ({rows} строк счетчиков) "
+            f"за {time.monotonic() - started:.1f} с"
+        )
+    else:
+        journal.release(checkpoint)
+
+async def sync_journal():
+    """Периодический сброс журнала на диск"""
+    if counter_journal:
+        await counter_journal.sync()
+
+# ==================== GRACEFUL SHUTDOWN ====================
+async def shutdown():
+    """Корректное завершение работы бота"""
+    global is_shutting_down
+    
+    if is_shutting_down:
+        return
+        
+    is_shutting_down = True
+    logger.info("Начинаем корректное завершение работы...")
+    
+    try:
+        # Останавливаем polling
+        if dp and hasattr(dp, '_stopped') and not dp._stopped:
+            await dp.stop_polling()
+            logger.info("Polling остановлен")
+    except Exception as e:
+        logger.error(f"Ошибка при остановке polling: {e}")
+    
+    try:
+        # Отменяем задачу polling
+        global polling_task
+        if polling_task and not polling_task.done():
+            polling_task.cancel()
+            logger.info("Задача polling отменена")
+    except Exception as e:
+        logger.error(f"Ошибка при отмене задачи polling: {e}")
+    
+    try:
+        # Останавливаем HTTP-сервер: новые обновления webhook больше не принимаются
+        if http_runner:
+            await http_runner.cleanup()
+            logger.info("HTTP сервер остановлен")
+    except Exception as e:
+        logger.error(f"Ошибка при остановке HTTP сервера: {e}")
+    
+    try:
+        # Координатор дожидается, пока воркеры запишут свои буферы
+        if worker_processes:
+            await stop_workers()
+            logger.info("Воркеры остановлены")
+        if forward_session:
+            await forward_session.close()
+    except Exception as e:
+        logger.error(f"Ошибка при остановке воркеров: {e}")
+    
+    try:
+        # Останавливаем планировщик
+        if scheduler_instance and scheduler_instance.running:
+            scheduler_instance.shutdown(wait=False)
+            logger.info("Планировщик остановлен")
+    except Exception as e:
+        logger.error(f"Ошибка при остановке планировщика: {e}")
+    
+    try:
+        # Записываем накопленные счетчики, чтобы не потерять их при перезапуске
+        if storage:
+            await flush_counters()
+            logger.info("Буфер счетчиков записан в БД")
+        if counter_journal:
+            counter_journal.close()
+    except Exception as e:
+        logger.error(f"Ошибка при записи буфера счетчиков: {e}")
+    
+    try:
+        # Закрываем сессию бота
+        if bot_instance:
+            await bot_instance.session.close()
+            logger.info("Сессия бота закрыта")
+    except Exception as e:
+        logger.error(f"Ошибка при закрытии сессии бота: {e}")
+    
+    try:
+        # Останавливаем потоки БД и закрываем соединения
+        if storage:
+            await close_storage()
             logger.info("Соединение с БД закрыто")
     except Exception as e:
         logger.error(f"Ошибка при закрытии БД: {e}")
@@ -302,59 +2567,690 @@ def signal_handler(signum, frame):
     logger.info(f"Получен сигнал {signum}, инициируем shutdown...")
     asyncio.create_task(shutdown())
 
+# ==================== КЭШ ====================
+class LRUCache:
+    """Кэш с ограничением по числу записей и объему, вытеснением LRU и TTL"""
+    
+    def __init__(self, max_entries: int, max_bytes: int = None, ttl: float = None,
+                 sliding: bool = False, sizeof=sys.getsizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sliding = sliding  # продлевать ли TTL при чтении
+        self.sizeof = sizeof
+        self.entries = OrderedDict()  # key -> [value, size, expires_at]
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def __contains__(self, key):
+        return self.peek(key) is not None
+    
+    def _expires_at(self):
+        return time.monotonic() + self.ttl if self.ttl else None
+    
+    def _remove(self, key):
+        value, size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+        return value
+    
+    def _is_expired(self, entry):
+        return entry[2] is not None and entry[2] <= time.monotonic()
+    
+    def get(self, key, default=None):
+        """Получить значение, обновив его позицию LRU"""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        
+        if self._is_expired(entry):
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return default
+        
+        self.entries.move_to_end(key)
+        if self.sliding:
+            entry[2] = self._expires_at()
+        self.hits += 1
+        return entry[0]
+    
+    def peek(self, key, default=None):
+        """Получить значение без учета в статистике и без обновления LRU"""
+        entry = self.entries.get(key)
+        if entry is None or self._is_expired(entry):
+            return default
+        return entry[0]
+    
+    def set(self, key, value):
+        """Сохранить значение и вытеснить старые записи сверх лимитов"""
+        if key in self.entries:
+            self._remove(key)
+        
+        size = self.sizeof(value)
+        self.entries[key] = [value, size, self._expires_at()]
+        self.total_bytes += size
+        
+        while self.entries and (
+            len(self.entries) > self.max_entries
+            or (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+        ):
+            oldest_key = next(iter(self.entries))
+            if oldest_key == key and len(self.entries) == 1:
+                break
+            self._remove(oldest_key)
+            self.evictions += 1
+    
+    def pop(self, key, default=None):
+        if key not in self.entries:
+            return default
+        return self._remove(key)
+    
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+    
+    def purge_expired(self):
+        """Удалить все просроченные записи"""
+        expired = [key for key, entry in self.entries.items() if self._is_expired(entry)]
+        for key in expired:
+            self._remove(key)
+        self.expirations += len(expired)
+        return len(expired)
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+async def purge_caches():
+    """Периодическая очистка просроченных записей всех кэшей"""
+    for cache in CACHES.values():
+        cache.purge_expired()
+
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
-def clear_chat_cache(chat_id):
-    """Очистить кэш для чата"""
-    cache_key = f"sorted_members_{chat_id}"
-    if cache_key in user_cache:
-        del user_cache[cache_key]
+def _background_task_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Фоновая задача {task.get_name()} завершилась ошибкой: {task.exception()!r}")
 
-async def get_sorted_members(chat_id, force_update=False):
-    """Получить отсортированный список участников"""
-    try:
-        cache_key = f"sorted_members_{chat_id}"
-        current_time = time.time()
-        
-        # Проверяем кэш
-        if not force_update and cache_key in user_cache:
-            cached_data, timestamp = user_cache[cache_key]
-            if current_time - timestamp < cache_timeout:
-                return cached_data
-        
-        # Получаем участников из базы данных
-        cursor.execute("""
-            SELECT user_id, username, today, yesterday, total 
-            FROM messages 
-            WHERE chat_id = ?
-            AND (today > 0 OR yesterday > 0 OR total > 0)
-            ORDER BY today DESC, total DESC
-            LIMIT 50
-        """, (chat_id,))
+def run_in_background(coro) -> asyncio.Task:
+    """Запустить задачу в фоне, сохранив ссылку на нее и записав в лог ее ошибку"""
+    task = asyncio.create_task(coro, name=coro.__qualname__)
+    background_tasks.add(task)
+    task.add_done_callback(_background_task_done)
+    return task
+
+class OrderIndex:
+    """Упорядоченный набор ключей с позициями: вставка, удаление, место ключа
+    и выборка диапазона за O(log n).
+    
+    Ключи лежат в отсортированных блоках до 2 * load элементов; дерево Фенвика
+    над длинами блоков дает позицию блока без прохода по всем предыдущим.
+    """
+    
+    load = 256
+    
+    def __init__(self, keys=()):
+        keys = sorted(keys)
+        self.blocks = [keys[start:start + self.load] for start in range(0, len(keys), self.load)]
+        self.maxes = [block[-1] for block in self.blocks]
+        self.size = len(keys)
+        self._build_tree()
+    
+    def __len__(self):
+        return self.size
+    
+    def _build_tree(self):
+        tree = [0] * (len(self.blocks) + 1)
+        for index, block in enumerate(self.blocks, 1):
+            tree[index] += len(block)
+            parent = index + (index & -index)
+            if parent < len(tree):
+                tree[parent] += tree[index]
+        self.tree = tree
+    
+    def _tree_add(self, block_index: int, delta: int):
+        index = block_index + 1
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+    
+    def _blocks_before(self, block_index: int) -> int:
+        """Число ключей в блоках до block_index"""
+        total = 0
+        index = block_index
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+    
+    def _locate(self, position: int):
+        """(номер блока, смещение в блоке) для позиции position"""
+        block_index = 0
+        step = 1 << (len(self.tree).bit_length() - 1)
+        while step:
+            next_index = block_index + step
+            if next_index < len(self.tree) and self.tree[next_index] <= position:
+                block_index = next_index
+                position -= self.tree[next_index]
+            step >>= 1
+        return block_index, position
+    
+    def add(self, key):
+        if not self.blocks:
+            self.blocks = [[key]]
+            self.maxes = [key]
+            self.size = 1
+            self._build_tree()
+            return
         
-        rows = cursor.fetchall()
-        members_with_stats = []
+        block_index = min(bisect.bisect_left(self.maxes, key), len(self.blocks) - 1)
+        block = self.blocks[block_index]
+        bisect.insort(block, key)
+        self.maxes[block_index] = block[-1]
+        self.size += 1
         
-        for row in rows:
-            user_id, username, today, yesterday, total = row
-            members_with_stats.append({
+        if len(block) > 2 * self.load:
+            # Делим переполненный блок пополам
+            self.blocks[block_index:block_index + 1] = [block[:self.load], block[self.load:]]
+            self.maxes[block_index:block_index + 1] = [block[self.load - 1], block[-1]]
+            self._build_tree()
+        else:
+            self._tree_add(block_index, 1)
+    
+    def remove(self, key):
+        block_index = bisect.bisect_left(self.maxes, key)
+        block = self.blocks[block_index]
+        del block[bisect.bisect_left(block, key)]
+        self.size -= 1
+        
+        if block:
+            self.maxes[block_index] = block[-1]
+            self._tree_add(block_index, -1)
+        else:
+            del self.blocks[block_index]
+            del self.maxes[block_index]
+            self._build_tree()
+    
+    def index(self, key) -> int:
+        """Позиция ключа (с 0); для отсутствующего - позиция, куда он встал бы"""
+        block_index = bisect.bisect_left(self.maxes, key)
+        if block_index == len(self.blocks):
+            return self.size
+        return self._blocks_before(block_index) + bisect.bisect_left(self.blocks[block_index], key)
+    
+    def slice(self, start: int, stop: int):
+        """Ключи с позициями [start, stop)"""
+        stop = min(stop, self.size)
+        if start >= stop:
+            return []
+        
+        keys = []
+        block_index, offset = self._locate(start)
+        while len(keys) < stop - start:
+            block = self.blocks[block_index]
+            keys.extend(block[offset:offset + stop - start - len(keys)])
+            block_index += 1
+            offset = 0
+        return keys
+
+class ChatLeaderboard:
+    """Участники чата, упорядоченные по (today DESC, total DESC) и обновляемые по месту"""
+    
+    def __init__(self, loaded_after_seq: int):
+        self.members = {}  # user_id -> данные участника
+        self.order = OrderIndex()  # ключи (-today, -total, user_id)
+        self.today_sum = 0
+        self.total_sum = 0
+        self.active_count = 0  # писавшие сегодня; в рейтинге они идут первыми
+        self.day = None  # последний день, к которому приведены счетчики рейтинга
+        self.loaded_after_seq = loaded_after_seq
+        self.ready = asyncio.Event()
+        self.loading = None  # загрузка из БД, общая для всех ожидающих; ошибка получат все
+        self.backlog = []  # пачки, записанные в БД до окончания загрузки
+    
+    @staticmethod
+    def _key(member):
+        return (-member['today'], -member['total'], member['user_id'])
+    
+    def load(self, rows, today_day: str):
+        yesterday_day = shift_day(today_day, -1)
+        for user_id, username, today, yesterday, total, day in rows:
+            # Приводим значения строки к текущему дню
+            if day != today_day:
+                yesterday = today if day == yesterday_day else 0
+                today = 0
+                day = today_day
+            self.members[user_id] = {
                 'user_id': user_id,
                 'username': username,
                 'today': today,
                 'yesterday': yesterday,
                 'total': total,
+                'day': day,
+                'is_new': False
+            }
+        self.day = today_day
+        self.order = OrderIndex(self._key(member) for member in self.members.values())
+        self.today_sum = sum(member['today'] for member in self.members.values())
+        self.total_sum = sum(member['total'] for member in self.members.values())
+        self.active_count = sum(1 for member in self.members.values() if member['today'] > 0)
+        self.ready.set()
+        
+        backlog, self.backlog = self.backlog, []
+        for user_id, username, count, day in backlog:
+            self.apply(user_id, username, count, day)
+    
+    def apply(self, user_id: int, username: str, count: int, day: str):
+        """Учесть count новых сообщений пользователя за день day"""
+        if not self.ready.is_set():
+            self.backlog.append((user_id, username, count, day))
+            return False
+        
+        member = self.members.get(user_id)
+        is_new = member is None
+        if is_new:
+            # Новый участник начинает с нулей на текущий день рейтинга, а сообщения
+            # прошлых дней попадают только в yesterday/total, как у остальных
+            member = {
+                'user_id': user_id,
+                'username': username,
+                'today': 0,
+                'yesterday': 0,
+                'total': 0,
+                'day': self.day or day,
                 'is_new': False
-            })
+            }
+            self.members[user_id] = member
+        else:
+            self.order.remove(self._key(member))
+            self._count(member, -1)
+        
+        # Та же смена суток, что и при записи в messages
+        if member['day'] == day:
+            member['today'] += count
+        elif member['day'] < day:
+            member['yesterday'] = member['today'] if member['day'] == shift_day(day, -1) else 0
+            member['today'] = count
+            member['day'] = day
+        elif member['day'] == shift_day(day, 1):
+            member['yesterday'] += count
+        member['total'] += count
+        member['username'] = username
+        if self.day is None or self.day < member['day']:
+            self.day = member['day']
+        
+        self.order.add(self._key(member))
+        self._count(member, 1)
+        return is_new
+    
+    def _count(self, member, sign: int):
+        """Добавить участника в итоги чата (sign=1) или убрать из них (sign=-1)"""
+        self.today_sum += sign * member['today']
+        self.total_sum += sign * member['total']
+        if member['today'] > 0:
+            self.active_count += sign
+    
+    def page(self, start: int, stop: int):
+        """Участники с местами [start + 1, stop] без обращения к БД"""
+        return [self.members[user_id] for _, _, user_id in self.order.slice(start, stop)]
+    
+    def top(self, limit: int):
+        """Первые limit участников без обращения к БД"""
+        return self.page(0, limit)
+    
+    def rank(self, user_id: int):
+        """Место участника в рейтинге /top (с 1) или None, если его нет"""
+        member = self.members.get(user_id)
+        if member is None:
+            return None
+        return self.order.index(self._key(member)) + 1
+
+    def approx_size(self):
+        """Примерный объем в байтах для учета в кэше"""
+        return 1024 + len(self.members) * 400
+
+# Рейтинги чатов: chat_id -> ChatLeaderboard. Затихшие чаты вытесняются по TTL
+leaderboards = LRUCache(
+    LEADERBOARD_CACHE_MAX_CHATS,
+    max_bytes=LEADERBOARD_CACHE_MAX_BYTES,
+    ttl=LEADERBOARD_CACHE_TTL,
+    sliding=True,
+    sizeof=lambda board: board.approx_size()
+)
+
+# Профили пользователей: user_id -> (username, full_name)
+user_profiles = LRUCache(USER_PROFILE_CACHE_SIZE)
+
+# Администраторы чатов: chat_id -> frozenset(user_id)
+chat_admins = LRUCache(ADMIN_CACHE_SIZE, ttl=ADMIN_CACHE_TTL)
+admin_requests = {}  # chat_id -> запрос к Bot API, который уже выполняется
+
+# Версия статистики чата: меняется при каждой записи счетчиков чата и сбросе его кэша.
+# Сброс кэша (/reset_today, импорт, сверка) меняет и номер сброса: такие изменения
+# показываются сразу, без ожидания RESPONSE_COOLDOWN. Номера берутся из общего
+# счетчика и не повторяются, поэтому вытеснение чата из кэша версий лишь заставит
+# перестроить его готовые ответы
+chat_versions = LRUCache(RESPONSE_CACHE_SIZE)  # chat_id -> (версия, номер сброса)
+chat_version_seq = 0
+
+# Готовые ответы команд: (chat_id, команда, вариант) -> (версия, номер сброса, день, время построения, ответ)
+rendered_responses = LRUCache(RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+render_requests = {}  # (ключ ответа, (номер сброса, день)) -> построение, которое уже выполняется
+
+# Кэши, статистика которых показывается на /health
+CACHES = {
+    "leaderboards": leaderboards,
+    "user_profiles": user_profiles,
+    "chat_admins": chat_admins,
+    "rendered_responses": rendered_responses,
+    "chat_versions": chat_versions,
+}
+
+def _read_leaderboard_rows(db, chat_id):
+    return db.execute("""
+        SELECT user_id, username, today, yesterday, total, day
+        FROM messages 
+        WHERE chat_id = ?
+        AND (today > 0 OR yesterday > 0 OR total > 0)
+    """, (chat_id,)).fetchall()
+
+async def _load_leaderboard(chat_id, board):
+    try:
+        rows = await storage.read_leaderboard(chat_id)
+    except Exception:
+        # Следующий запрос начнет загрузку заново
+        if leaderboards.peek(chat_id) is board:
+            leaderboards.pop(chat_id)
+        raise
+    board.load(rows, current_day())
+    if leaderboards.peek(chat_id) is board:
+        leaderboards.set(chat_id, board)
+    return board
+
+async def get_leaderboard(chat_id):
+    """Получить рейтинг чата, при необходимости построив его из БД"""
+    board = leaderboards.get(chat_id)
+    if board is None:
+        # Чтение идет после всех уже отправленных пачек,
+        # более поздние пачки board применит сам
+        board = ChatLeaderboard(flush_seq)
+        leaderboards.set(chat_id, board)
+        board.loading = asyncio.ensure_future(_load_leaderboard(chat_id, board))
+    
+    # Одновременные запросы ждут одну загрузку
+    return await asyncio.shield(board.loading)
+
+def bump_chat_version(chat_id, reset: bool = False):
+    """Статистика чата изменилась: готовые ответы устарели"""
+    global chat_version_seq
+    
+    chat_version_seq += 1
+    _, reset_seq = chat_versions.peek(chat_id, (0, 0))
+    chat_versions.set(chat_id, (chat_version_seq, chat_version_seq if reset else reset_seq))
+
+async def _render_response(key, stamp, render):
+    response = await render()
+    rendered_responses.set(key, (*stamp, time.monotonic(), response))
+    return response
+
+async def cached_response(chat_id, command: str, variant, render):
+    """Ответ команды (text, reply_markup) из кэша или построенный render()"""
+    key = (chat_id, command, variant)
+    version, reset_seq = chat_versions.get(chat_id, (0, 0))
+    stamp = (version, reset_seq, current_day())
+    
+    entry = rendered_responses.get(key)
+    if entry is not None and entry[1:3] == stamp[1:] and (
+        entry[0] == version or time.monotonic() - entry[3] < RESPONSE_COOLDOWN
+    ):
+        return entry[4]
+    
+    # Одновременные запросы одного ответа ждут одно построение. После сброса
+    # или смены суток построение по старым данным не подходит: начинаем новое
+    request_key = (key, stamp[1:])
+    request = render_requests.get(request_key)
+    if request is None:
+        request = asyncio.ensure_future(_render_response(key, stamp, render))
+        render_requests[request_key] = request
+        request.add_done_callback(lambda _: render_requests.pop(request_key, None))
+    return await asyncio.shield(request)
+
+def apply_to_leaderboards(batch_seq: int, counters: dict):
+    """Применить записанную пачку счетчиков к загруженным рейтингам"""
+    for chat_id in {chat_id for chat_id, _, _ in counters}:
+        bump_chat_version(chat_id)
+    
+    for (chat_id, user_id, day), (count, username, _, _) in sorted(counters.items(), key=lambda item: item[0][2]):
+        board = leaderboards.peek(chat_id)
+        if board is not None and batch_seq > board.loaded_after_seq:
+            if board.apply(user_id, username, count, day):
+                # Новый участник: обновляем учтенный объем рейтинга
+                leaderboards.set(chat_id, board)
+
+def remember_user(user: types.User):
+    """Запомнить username и имя пользователя из входящего сообщения"""
+    profile = (user.username, user.full_name)
+    if user_profiles.peek(user.id) != profile:
+        user_profiles.set(user.id, profile)
+        pending_profiles[user.id] = (*profile, datetime.now().isoformat())
+
+async def get_user_profile(user_id: int):
+    """Профиль пользователя (username, full_name) из кэша или БД"""
+    profile = user_profiles.get(user_id)
+    if profile is None:
+        row = await storage.get_user_profile(user_id)
+        # Неизвестного пользователя тоже кэшируем, чтобы не спрашивать БД повторно
+        profile = (row[0], row[1]) if row else (None, None)
+        user_profiles.set(user_id, profile)
+    return profile
+
+async def _load_chat_admins(chat_id: int) -> frozenset:
+    members = await bot_instance.get_chat_administrators(chat_id)
+    admins = frozenset(member.user.id for member in members)
+    chat_admins.set(chat_id, admins)
+    return admins
+
+async def get_chat_admins(chat_id: int) -> frozenset:
+    """ID администраторов чата из кэша; при промахе один запрос к Bot API на чат"""
+    admins = chat_admins.get(chat_id)
+    if admins is not None:
+        return admins
+    
+    # Одновременные команды в одном чате ждут один и тот же запрос
+    request = admin_requests.get(chat_id)
+    if request is None:
+        request = asyncio.ensure_future(_load_chat_admins(chat_id))
+        admin_requests[chat_id] = request
+        request.add_done_callback(lambda _: admin_requests.pop(chat_id, None))
+    return await asyncio.shield(request)
+
+async def is_chat_admin(chat_id: int, user_id: int) -> bool:
+    return user_id in await get_chat_admins(chat_id)
+
+async def format_mention(user_id: int, username: str):
+    """Упоминание пользователя без обращения к Bot API"""
+    profile = await get_user_profile(user_id)
+    if profile and profile[0]:
+        return f"@{profile[0]}"
+    return f"<a href='tg://user?id={user_id}'>{username}</a>"
+
+def clear_chat_cache(chat_id):
+    """Очистить кэш для чата"""
+    leaderboards.pop(chat_id, None)
+    bump_chat_version(chat_id, reset=True)
+
+async def get_sorted_members(chat_id, force_update=False):
+    """Получить отсортированный список участников"""
+    try:
+        if force_update:
+            await flush_counters()
+        
+        board = await get_leaderboard(chat_id)
+        return board.top(50)
+        
+    except Exception as e:
+        logger.error(f"Error getting sorted members for chat {chat_id}: {e}")
+        return []
+
+# ==================== РАССЫЛКА ====================
+class TokenBucket:
+    """Ограничение частоты: rate токенов в секунду, запас до capacity"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    async def acquire(self):
+        """Занять токен; при нехватке ждать своей очереди"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        
+        # Токен резервируется сразу, поэтому конкурентные вызовы встают в очередь
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+    
+    def pause(self, seconds: float):
+        """Запретить выдачу токенов на seconds секунд (после RetryAfter)"""
+        now = time.monotonic()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+        self.updated = now
+
+# Общий лимит Bot API (делится между воркерами) и отдельные лимиты для каждого чата
+global_send_bucket = TokenBucket(SEND_GLOBAL_RATE / WORKER_COUNT, SEND_GLOBAL_RATE / WORKER_COUNT)
+chat_send_buckets = LRUCache(10000, ttl=600, sliding=True)
+CACHES["chat_send_buckets"] = chat_send_buckets
+
+def get_chat_bucket(chat_id):
+    bucket = chat_send_buckets.peek(chat_id)
+    if bucket is None:
+        bucket = TokenBucket(SEND_PER_CHAT_RATE, 1)
+        chat_send_buckets.set(chat_id, bucket)
+    return bucket
+
+async def send_limited(chat_id, text, deadline=None):
+    """Отправить сообщение с учетом лимитов и повтором после RetryAfter"""
+    loop = asyncio.get_running_loop()
+    chat_bucket = get_chat_bucket(chat_id)
+    
+    for attempt in range(SEND_MAX_RETRIES):
+        await chat_bucket.acquire()
+        await global_send_bucket.acquire()
+        
+        try:
+            return await bot_instance.send_message(chat_id, text)
+        except TelegramRetryAfter as e:
+            if attempt == SEND_MAX_RETRIES - 1 or (deadline and loop.time() + e.retry_after > deadline):
+                raise
+            logger.warning(f"RetryAfter {e.retry_after} с для чата {chat_id}")
+            # Ожидание действует на весь бот: остальные чаты тоже ждут, а не тратят попытки
+            chat_bucket.pause(e.retry_after)
+            global_send_bucket.pause(e.retry_after)
+
+async def fan_out(job_name, chats, window, send_to_chat):
+    """Параллельная рассылка по чатам, которая укладывается в window секунд"""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + window
+    
+    # Каждый воркер рассылает по своим чатам со своей долей общего лимита
+    expected = len(chats) / global_send_bucket.rate
+    if expected > window:
+        logger.warning(
+            f"{job_name}: {len(chats)} чатов при лимите {global_send_bucket.rate:g} сообщ./с "
+            f"займут ~{expected:.0f} с, окно {window} с - часть чатов будет пропущена"
+        )
+    
+    pending = iter(chats)
+    processed = 0
+    
+    async def worker():
+        nonlocal processed
+        for chat_id, chat_title in pending:
+            if is_shutting_down or loop.time() >= deadline:
+                return
+            await send_to_chat(chat_id, chat_title, deadline)
+            processed += 1
+    
+    workers = [asyncio.create_task(worker()) for _ in range(min(SEND_CONCURRENCY, len(chats)))]
+    try:
+        await asyncio.wait_for(asyncio.gather(*workers), timeout=window)
+    except asyncio.TimeoutError:
+        logger.warning(f"{job_name}: окно рассылки {window} с истекло")
+    
+    logger.info(
+        f"{job_name}: обработано {processed} из {len(chats)} чатов "
+        f"за {loop.time() - started:.1f} с"
+    )
+
+# ==================== АВТОМАТИЧЕСКИЕ ФУНКЦИИ ====================
+async def send_mention_to_chat(chat_id, chat_title, mention_type_index, deadline):
+    """Упоминание случайного участника в одном чате"""
+    try:
+        # Получаем участников чата
+        board = await get_leaderboard(chat_id)
+        if not board.members:
+            logger.debug(f"Нет участников в чате {chat_id} для упоминания")
+            return
+        
+        # Писавшие сегодня стоят в начале рейтинга; если никто не писал, берем всех
+        candidates = board.active_count or len(board.members)
+        
+        # Выбираем случайного пользователя
+        position = random.randrange(candidates)
+        random_user = board.page(position, position + 1)[0]
+        user_id = random_user['user_id']
+        username = random_user['username']
+        
+        # Выбираем сообщение в зависимости от текущего типа
+        if mention_type_index == 0:  # предсказание
+            message = random.choice(FUNNY_PREDICTIONS)
+            message_type_text = "🔮 Предсказание часа"
+            mention_type = "prediction"
+        elif mention_type_index == 1:  # пожелание
+            message = random.choice(FUNNY_WISHES)
+            message_type_text = "✨ Пожелание часа"
+            mention_type = "wish"
+        else:  # комплимент
+            message = random.choice(COMPLIMENTS)
+            message_type_text = "💝 Комплимент часа"
+            mention_type = "compliment"
+        
+        # Формируем упоминание
+        mention = await format_mention(user_id, username)
+        
+        # Отправляем сообщение
+        text = f"{message_type_text} для {mention}:\n\n"
+        text += f"<i>{message}</i>"
         
-        # Сохраняем в кэш
-        user_cache[cache_key] = (members_with_stats, current_time)
+        await send_limited(chat_id, text, deadline)
         
-        return members_with_stats
+        # Сохраняем в историю и обновляем время последнего упоминания
+        await storage.save_mention(chat_id, user_id, username, mention_type, message)
+        
+        logger.info(f"Упомянут пользователь {username} в чате {chat_title or chat_id}")
         
     except Exception as e:
-        logger.error(f"Error getting sorted members for chat {chat_id}: {e}")
-        return []
+        logger.error(f"Ошибка при упоминании в чате {chat_id} ({chat_title}): {e}")
 
-# ==================== АВТОМАТИЧЕСКИЕ ФУНКЦИИ ====================
 async def send_hourly_mention():
     """Отправка упоминания каждый час с ротацией типа"""
     global current_mention_type
@@ -366,14 +3262,8 @@ async def send_hourly_mention():
         logger.info(f"Запуск функции упоминания пользователя... Тип: {current_mention_type}")
         
         # Получаем все активные группы и супергруппы
-        cursor.execute("""
-            SELECT chat_id, chat_title, chat_type FROM chat_settings 
-            WHERE chat_type IN ('group', 'supergroup') 
-            AND is_active = 1 
-            AND enable_mentions = 1
-        """)
-        
-        active_chats = cursor.fetchall()
+        active_chats = await storage.active_group_chats(mentions_only=True)
+        active_chats = [chat for chat in active_chats if owns_chat(chat[0])]
         
         if not active_chats:
             logger.info("Нет активных чатов для упоминаний")
@@ -381,90 +3271,14 @@ async def send_hourly_mention():
         
         logger.info(f"Найдено {len(active_chats)} активных чатов для упоминаний")
         
-        for chat_id, chat_title, chat_type in active_chats:
-            try:
-                # Получаем участников чата
-                members = await get_sorted_members(chat_id)
-                if not members:
-                    logger.debug(f"Нет участников в чате {chat_id} для упоминания")
-                    continue
-                
-                # Фильтруем пользователей, которые писали сегодня
-                active_members = [m for m in members if m['today'] > 0]
-                if not active_members:
-                    active_members = members  # Берем всех если никто не писал
-                
-                if not active_members:
-                    logger.debug(f"Нет активных участников в чате {chat_id}")
-                    continue
-                
-                # Выбираем случайного пользователя
-                random_user = random.choice(active_members)
-                user_id = random_user['user_id']
-                username = random_user['username']
-                
-                # Выбираем сообщение в зависимости от текущего типа
-                if current_mention_type == 0:  # предсказание
-                    message = random.choice(FUNNY_PREDICTIONS)
-                    message_type_text = "🔮 Предсказание часа"
-                    mention_type = "prediction"
-                elif current_mention_type == 1:  # пожелание
-                    message = random.choice(FUNNY_WISHES)
-                    message_type_text = "✨ Пожелание часа"
-                    mention_type = "wish"
-                else:  # комплимент
-                    message = random.choice(COMPLIMENTS)
-                    message_type_text = "💝 Комплимент часа"
-                    mention_type = "compliment"
-                
-                # Формируем упоминание
-                try:
-                    # Пробуем получить информацию о пользователе для корректного упоминания
-                    user_info = await bot_instance.get_chat(user_id)
-                    if user_info.username:
-                        mention = f"@{user_info.username}"
-                    else:
-                        mention = f"<a href='tg://user?id={user_id}'>{username}</a>"
-                except:
-                    mention = f"<a href='tg://user?id={user_id}'>{username}</a>"
-                
-                # Отправляем сообщение
-                text = f"{message_type_text} для {mention}:\n\n"
-                text += f"<i>{message}</i>"
-                
-                await bot_instance.send_message(chat_id, text)
-                
-                # Сохраняем в историю
-                cursor.execute("""
-                    INSERT INTO mentions_history 
-                    (chat_id, user_id, username, mention_time, mention_type, message)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (
-                    chat_id, 
-                    user_id, 
-                    username,
-                    datetime.now().isoformat(), 
-                    mention_type, 
-                    message
-                ))
-                
-                # Обновляем время последнего упоминания
-                cursor.execute("""
-                    UPDATE chat_settings 
-                    SET last_mention_time = ?
-                    WHERE chat_id = ?
-                """, (datetime.now().isoformat(), chat_id))
-                
-                conn.commit()
-                
-                logger.info(f"Упомянут пользователь {username} в чате {chat_title or chat_id}")
-                
-                # Пауза между отправками, чтобы не спамить
-                await asyncio.sleep(1)
-                
-            except Exception as e:
-                logger.error(f"Ошибка при упоминании в чате {chat_id} ({chat_title}): {e}")
-                continue
+        # Тип фиксируем на весь проход, чтобы все чаты получили одинаковый
+        mention_type_index = current_mention_type
+        await fan_out(
+            "send_hourly_mention", active_chats, MENTION_FANOUT_WINDOW,
+            lambda chat_id, chat_title, deadline: send_mention_to_chat(
+                chat_id, chat_title, mention_type_index, deadline
+            )
+        )
         
         # Меняем тип для следующего часа
         current_mention_type = (current_mention_type + 1) % 3
@@ -473,6 +3287,58 @@ async def send_hourly_mention():
     except Exception as e:
         logger.error(f"Ошибка в send_hourly_mention: {e}")
 
+def save_mention(db, chat_id, user_id, username, mention_type, message):
+    """Записать упоминание в историю"""
+    mention_time = datetime.now().isoformat()
+    
+    db.execute("""
+        INSERT INTO mentions_history 
+        (chat_id, user_id, username, mention_time, mention_type, message)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (
+        chat_id, 
+        user_id, 
+        username,
+        mention_time, 
+        mention_type, 
+        message
+    ))
+    
+    db.execute("""
+        UPDATE chat_settings 
+        SET last_mention_time = ?
+        WHERE chat_id = ?
+    """, (mention_time, chat_id))
+
+def render_daily_report(top, members: int, today_sum: int, active_count: int) -> str:
+    """Текст ежедневного отчета чата; top - [(username, сообщений за день)]"""
+    text = "📊 <b>Ежедневный отчет</b>\n\n"
+    
+    # Топ-3 за день
+    for i, (username, today_count) in enumerate(top, 1):
+        emoji = "👑" if i == 1 else "🥈" if i == 2 else "🥉"
+        text += f"{emoji} <b>{username}:</b> {today_count} сообщ.\n"
+    
+    # Общая статистика по всему чату
+    if members > 3:
+        text += f"\n...и еще {members - 3} участников\n"
+    
+    text += f"\n<b>📈 Итоги дня:</b>\n"
+    text += f"📨 Сообщений: <b>{today_sum}</b>\n"
+    text += f"👥 Активных: <b>{active_count}</b>\n\n"
+    text += "Статистика обнулится в полночь! ✨"
+    return text
+
+async def send_report_to_chat(chat_id, chat_title, text, deadline):
+    """Отправить готовый ежедневный отчет в один чат"""
+    try:
+        await send_limited(chat_id, text, deadline)
+        
+        logger.info(f"Отчет отправлен в чат {chat_title or chat_id}")
+        
+    except Exception as e:
+        logger.error(f"Ошибка отправки отчета в чат {chat_id} ({chat_title}): {e}")
+
 async def daily_report():
     """Ежедневный отчет"""
     if is_shutting_down:
@@ -481,200 +3347,562 @@ async def daily_report():
     try:
         logger.info(f"Генерация ежедневного отчета...")
         
-        cursor.execute("""
-            SELECT chat_id, chat_title FROM chat_settings 
-            WHERE chat_type IN ('group', 'supergroup') 
-            AND is_active = 1
-        """)
+        await flush_counters()
+        
+        # Топ-3 и итоги всех чатов одним запросом; тексты готовы до начала рассылки.
+        # Воркер читает только свои чаты: их счетчики он только что записал
+        started = time.perf_counter()
+        chat_ids = None
+        if worker_id is not None:
+            chat_ids = [chat_id for chat_id in chat_registry if owns_chat(chat_id)]
+        rows = await storage.daily_report_rows(current_day(), 3, chat_ids)
+        
+        reports = {}  # chat_id -> [название, топ, участников, сообщений, активных]
+        for chat_id, chat_title, username, today, members, today_sum, active_count in rows:
+            report = reports.get(chat_id)
+            if report is None:
+                report = reports[chat_id] = [chat_title, [], members, today_sum, active_count]
+            report[1].append((username, today))
         
-        active_chats = cursor.fetchall()
+        texts = {
+            chat_id: render_daily_report(top, members, today_sum, active_count)
+            for chat_id, (_, top, members, today_sum, active_count) in reports.items()
+        }
+        active_chats = [(chat_id, report[0]) for chat_id, report in reports.items()]
         
         if not active_chats:
             logger.info("Нет активных чатов для отчета")
             return
         
-        logger.info(f"Найдено {len(active_chats)} чатов для ежедневного отчета")
+        logger.info(
+            f"Найдено {len(active_chats)} чатов для ежедневного отчета, "
+            f"отчеты подготовлены за {time.perf_counter() - started:.2f} с"
+        )
         
-        for chat_id, chat_title in active_chats:
-            try:
-                members_with_stats = await get_sorted_members(chat_id, force_update=True)
-                
-                if not members_with_stats:
-                    continue
-                
-                # Создаем отчет
-                text = "📊 <b>Ежедневный отчет</b>\n\n"
-                
-                # Топ-3 за день
-                for i, member in enumerate(members_with_stats[:3], 1):
-                    username = member['username']
-                    today_count = member['today']
-                    
-                    emoji = "👑" if i == 1 else "🥈" if i == 2 else "🥉"
-                    text += f"{emoji} <b>{username}:</b> {today_count} сообщ.\n"
-                
-                # Общая статистика
-                total_today = sum(member['today'] for member in members_with_stats)
-                active_today = sum(1 for member in members_with_stats if member['today'] > 0)
-                
-                if len(members_with_stats) > 3:
-                    text += f"\n...и еще {len(members_with_stats) - 3} участников\n"
-                
-                text += f"\n<b>📈 Итоги дня:</b>\n"
-                text += f"📨 Сообщений: <b>{total_today}</b>\n"
-                text += f"👥 Активных: <b>{active_today}</b>\n\n"
-                text += "Статистика обнулится в полночь! ✨"
-                
-                await bot_instance.send_message(chat_id, text)
-                
-                # Сохраняем статистику дня
-                today_date = datetime.now().strftime('%Y-%m-%d')
-                cursor.execute("""
-                    INSERT OR REPLACE INTO daily_stats 
-                    (date, total_messages, active_users, top_user_id, top_user_count)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (
-                    today_date,
-                    total_today,
-                    active_today,
-                    members_with_stats[0]['user_id'] if members_with_stats else None,
-                    members_with_stats[0]['today'] if members_with_stats else 0
-                ))
-                
-                conn.commit()
-                
-                logger.info(f"Отчет отправлен в чат {chat_title or chat_id}")
-                
-                # Пауза между отправками
-                await asyncio.sleep(1)
-                
-            except Exception as e:
-                logger.error(f"Ошибка отправки отчета в чат {chat_id} ({chat_title}): {e}")
-                continue
+        await fan_out(
+            "daily_report", active_chats, REPORT_FANOUT_WINDOW,
+            lambda chat_id, chat_title, deadline: send_report_to_chat(
+                chat_id, chat_title, texts[chat_id], deadline
+            )
+        )
                 
     except Exception as e:
         logger.error(f"Ошибка в daily_report: {e}")
 
+def reset_today_counters(db, chat_id, today_day):
+    """Сбросить сегодняшние счетчики чата и вернуть сброшенные итоги дня"""
+    # Итоги берем из самих счетчиков: дневная статистика не учитывает прошлые сбросы
+    day_stats = db.execute("""
+        SELECT COALESCE(SUM(today), 0), COUNT(*) FROM messages
+        WHERE chat_id = ? AND day = ? AND today > 0
+    """, (chat_id, today_day)).fetchone()
+    
+    # Сегодняшние сообщения в этом чате больше не входят в today по всем чатам
+    db.execute("""
+        UPDATE user_totals
+        SET today = MAX(0, today - (
+            SELECT m.today FROM messages m WHERE m.user_id = user_totals.user_id AND m.chat_id = ?
+        ))
+        WHERE day = ? AND user_id IN (
+            SELECT user_id FROM messages WHERE chat_id = ? AND day = ? AND today > 0
+        )
+    """, (chat_id, today_day, chat_id, today_day))
+    
+    # Сбрасываем счетчики: сегодняшнее значение становится вчерашним
+    db.execute("""
+        UPDATE messages
+        SET yesterday = CASE WHEN day = ? THEN today ELSE 0 END,
+            today = 0,
+            day = ?
+        WHERE chat_id = ?
+    """, (today_day, today_day, chat_id))
+    
+    return day_stats
+
 async def auto_reset_counters():
-    """Автоматический сброс счетчиков в полночь"""
+    """Смена суток в полночь: счетчики строк сбрасываются лениво по полю day"""
     if is_shutting_down:
         return
         
     try:
         logger.info("Автоматический сброс счетчиков...")
         
-        # Сохраняем статистику перед сбросом
-        cursor.execute("SELECT SUM(today) FROM messages")
-        total_today = cursor.fetchone()[0] or 0
+        await flush_counters()
         
-        if total_today > 0:
-            cursor.execute("SELECT COUNT(DISTINCT user_id) FROM messages WHERE today > 0")
-            active_today = cursor.fetchone()[0] or 0
-            
-            cursor.execute("SELECT user_id, today FROM messages WHERE today > 0 ORDER BY today DESC LIMIT 1")
-            top_user = cursor.fetchone()
-            
-            today_date = datetime.now().strftime('%Y-%m-%d')
-            cursor.execute("""
-                INSERT OR REPLACE INTO daily_stats 
-                (date, total_messages, active_users, top_user_id, top_user_count)
-                VALUES (?, ?, ?, ?, ?)
-            """, (
-                today_date,
-                total_today,
-                active_today,
-                top_user[0] if top_user else None,
-                top_user[1] if top_user else 0
-            ))
-        
-        # Сбрасываем счетчики
-        cursor.execute("UPDATE messages SET yesterday = today, today = 0")
-        conn.commit()
+        # Итоги завершившегося дня уже накоплены в chat_daily_stats
+        finished_day = shift_day(current_day(), -1)
+        total_today, active_today = await storage.day_totals(finished_day)
         
-        # Очищаем кэш
-        user_cache.clear()
+        # Рейтинги перестроятся уже для нового дня
+        leaderboards.clear()
         
-        logger.info(f"Счетчики сброшены. Сегодня было {total_today} сообщений от {active_today} пользователей")
+        logger.info(f"Счетчики сброшены. Вчера было {total_today or 0} сообщений от {active_today or 0} пользователей")
         
     except Exception as e:
         logger.error(f"Ошибка в auto_reset_counters: {e}")
 
+def start_history_import() -> bool:
+    """Запустить импорт в фоне; False, если он уже выполняется"""
+    if import_lock.locked():
+        return False
+    
+    run_in_background(scan_all_messages())
+    return True
+
 async def scan_all_messages():
-    """Сканирование всех сообщений в чате для подсчета истории"""
+    """Импорт истории из экспортов Telegram Desktop, сложенных в HISTORY_IMPORT_DIR"""
     if is_shutting_down:
         return
-        
+    
+    # Bot API не отдает историю чата, поэтому она берется из файлов экспорта
+    if import_lock.locked():
+        logger.info("Импорт истории уже выполняется")
+        return
+    
+    async with import_lock:
+        try:
+            files = sorted(Path(HISTORY_IMPORT_DIR).glob("*.json"))
+            
+            if not files:
+                logger.info(f"Нет файлов экспорта для импорта в {HISTORY_IMPORT_DIR}")
+                return
+            
+            for path in files:
+                if is_shutting_down:
+                    break
+                
+                try:
+                    await import_history_file(path)
+                except Exception as e:
+                    logger.error(f"Ошибка импорта истории из {path}: {e}")
+                    
+        except Exception as e:
+            logger.error(f"Ошибка в scan_all_messages: {e}")
+
+# Расхождения total > история, уже учтенные сверкой: (chat_id, user_id) -> разница
+reconcile_unresolved = LRUCache(RECONCILE_TRACKED_ROWS)
+
+def _reconcile_chunk(db, after_rowid, limit):
+    rows = db.execute("""
+        SELECT m.rowid, m.user_id, m.chat_id, m.total, (
+            SELECT COALESCE(SUM(message_count), 0) FROM message_history h
+            WHERE h.chat_id = m.chat_id AND h.user_id = m.user_id
+        )
+        FROM messages m
+        WHERE m.rowid > ? AND owns_chat(m.chat_id)
+        ORDER BY m.rowid
+        LIMIT ?
+    """, (after_rowid, limit)).fetchall()
+    
+    drift = [(rowid, user_id, chat_id, total, history_count)
+             for rowid, user_id, chat_id, total, history_count in rows
+             if total != history_count]
+    
+    # Если история показывает больше сообщений, поднимаем total до нее
+    fixes = [row for row in drift if row[4] > row[3]]
+    db.executemany(
+        "UPDATE messages SET total = ? WHERE rowid = ? AND total < ?",
+        [(history_count, rowid, history_count) for rowid, _, _, total, history_count in fixes]
+    )
+    db.executemany(
+        "UPDATE user_totals SET total = total + ? WHERE user_id = ?",
+        [(history_count - total, user_id) for _, user_id, _, total, history_count in fixes]
+    )
+    
+    last_rowid = rows[-1][0] if rows else None
+    return len(rows), last_rowid, drift
+
+async def reconcile_counters():
+    """Сверить total с историей очередной порцией строк messages"""
+    global reconcile_position
+    
+    if is_shutting_down:
+        return
+    
     try:
-        logger.info("Сканирование истории сообщений...")
-        
-        # Получаем все активные чаты
-        cursor.execute("""
-            SELECT chat_id, chat_title FROM chat_settings 
-            WHERE is_active = 1
-        """)
-        
-        active_chats = cursor.fetchall()
+        checked = 0
+        while checked < RECONCILE_ROWS_PER_RUN and not is_shutting_down:
+            count, last_position, drift = await storage.reconcile_chunk(
+                reconcile_position, RECONCILE_CHUNK_SIZE
+            )
+            checked += count
+            
+            for _, user_id, chat_id, total, history_count in drift:
+                key = (chat_id, user_id)
+                if history_count > total:
+                    # total уже поднят до истории
+                    direction = "history"
+                    reconcile_unresolved.pop(key)
+                    reconcile_stats["fixed_rows"] += 1
+                    reconcile_fixed_rows_total.inc()
+                elif reconcile_unresolved.peek(key) != total - history_count:
+                    # Сообщений без истории восстановить нельзя: расхождение только
+                    # учитывается, повторно - лишь если оно изменилось
+                    direction = "total"
+                    reconcile_unresolved.set(key, total - history_count)
+                else:
+                    continue
+                
+                logger.warning(
+                    f"Расхождение счетчиков: пользователь {user_id}, чат {chat_id}, "
+                    f"total={total}, история={history_count}"
+                )
+                reconcile_stats["drift_rows"] += 1
+                reconcile_stats["drift_messages"] += abs(history_count - total)
+                reconcile_drift_rows_total.inc(direction)
+                reconcile_drift_messages_total.inc(direction, amount=abs(history_count - total))
+            
+            # Рейтинги чатов с исправленными total перестроятся из БД
+            for chat_id in {row[2] for row in drift if row[4] > row[3]}:
+                clear_chat_cache(chat_id)
+            
+            if last_position is None or count < RECONCILE_CHUNK_SIZE:
+                # Дошли до конца таблицы, следующий запуск начнет сначала
+                reconcile_position = None
+                reconcile_stats["full_passes"] += 1
+                break
+            reconcile_position = last_position
         
-        if not active_chats:
-            return
+        reconcile_stats["checked_rows"] += checked
+        reconcile_stats["last_run"] = datetime.now().isoformat()
         
-        for chat_id, chat_title in active_chats:
-            try:
-                # Получаем информацию о чате
-                chat = await bot_instance.get_chat(chat_id)
-                
-                if chat.type in [ChatType.GROUP, ChatType.SUPERGROUP]:
-                    try:
-                        # Пробуем получить историю сообщений (ограниченное количество)
-                        # В реальном боте эта функция может быть ограничена правами
-                        logger.info(f"Сканирование истории для чата {chat_title or chat_id}")
-                        
-                        # Здесь можно добавить логику для сканирования истории
-                        # Например, через get_chat_history, но это требует прав
-                        
-                    except Exception as e:
-                        logger.warning(f"Не удалось сканировать историю чата {chat_id}: {e}")
-                        
-            except Exception as e:
-                logger.error(f"Ошибка при сканировании чата {chat_id}: {e}")
-                continue
-                
     except Exception as e:
-        logger.error(f"Ошибка в scan_all_messages: {e}")
+        logger.error(f"Ошибка в reconcile_counters: {e}")
+
+def _compact_history_chunk(db, first_id, last_id, cutoff):
+    # Перенос и удаление в одной транзакции, поэтому суммы не меняются
+    db.execute("""
+        INSERT INTO message_rollup (chat_id, user_id, hour_bucket, message_count)
+        SELECT chat_id, user_id,
+               COALESCE(strftime('%Y-%m-%dT%H:00:00', message_date), '1970-01-01T00:00:00'),
+               SUM(message_count)
+        FROM all_messages_history
+        WHERE id BETWEEN ? AND ? AND (message_date < ? OR message_date IS NULL)
+        GROUP BY 1, 2, 3
+        ON CONFLICT (chat_id, user_id, hour_bucket) DO UPDATE SET
+            message_count = message_count + excluded.message_count
+    """, (first_id, last_id, cutoff))
+    
+    return db.execute("""
+        DELETE FROM all_messages_history
+        WHERE id BETWEEN ? AND ? AND (message_date < ? OR message_date IS NULL)
+    """, (first_id, last_id, cutoff)).rowcount
+
+async def compact_history(cutoff: str = None):
+    """Свернуть построчную историю старше cutoff в почасовые агрегаты"""
+    # Без cutoff сворачиваем все; строки без даты попадают в нулевой час
+    return await storage.compact_history(cutoff or "9999-12-31")
+
+async def compact_history_job():
+    """Периодическая свертка истории старше окна хранения"""
+    if is_shutting_down or HISTORY_STORAGE_MODE != "rollup":
+        return
+    
+    try:
+        cutoff = (datetime.now() - timedelta(hours=RAW_HISTORY_RETENTION_HOURS)).isoformat()
+        compacted = await compact_history(cutoff)
+        if compacted:
+            logger.info(f"Свернуто {compacted} строк истории в почасовые агрегаты")
+    except Exception as e:
+        logger.error(f"Ошибка в compact_history_job: {e}")
 
-async def update_total_count_for_user(user_id: int, chat_id: int, username: str):
-    """Обновить общее количество сообщений пользователя с учетом истории"""
+async def compact_history_command():
+    """Разовая свертка всей построчной истории: python main.py --compact-history"""
+    await init_storage()
     try:
-        # Получаем текущее общее количество из базы
-        cursor.execute("""
-            SELECT total FROM messages WHERE user_id = ? AND chat_id = ?
-        """, (user_id, chat_id))
+        started = time.time()
+        compacted = await compact_history()
+        logger.info(f"Свертка истории завершена: {compacted} строк за {time.time() - started:.1f} с")
+        
+        # Возвращаем освободившееся место на диске
+        await storage.vacuum()
+    finally:
+        await close_storage()
+
+# ==================== ИМПОРТ ИСТОРИИ ====================
+# Ключ массива сообщений чата в экспорте; внутри строк кавычки экранированы
+EXPORT_MESSAGES_RE = re.compile(r'"messages"\s*:\s*\[')
+EXPORT_SEPARATOR_RE = re.compile(r'[\s,]*')
+EXPORT_HEADER_RE = {
+    'name': re.compile(r'"name"\s*:\s*("(?:[^"\\]|\\.)*"|null)'),
+    'type': re.compile(r'"type"\s*:\s*"(\w+)"'),
+    'id': re.compile(r'"id"\s*:\s*(-?\d+)'),
+}
+# Заголовок чата стоит прямо перед массивом сообщений
+EXPORT_HEADER_WINDOW = 64 * 1024
+EXPORT_MAX_ELEMENT = 64 * 1024 * 1024
+
+class ExportReader:
+    """Потоковое чтение result.json: в памяти только текущий фрагмент файла"""
+    
+    def __init__(self, path, offset=0):
+        self.file = open(path, 'rb')
+        self.file.seek(offset)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        # Смещение в байтах, соответствующее self.pos
+        self.offset = offset
+        self.eof = False
+    
+    def close(self):
+        self.file.close()
+    
+    def _fill(self):
+        if self.eof:
+            return False
         
-        row = cursor.fetchone()
+        data = self.file.read(IMPORT_READ_CHUNK)
+        self.eof = not data
+        self.buffer = self.buffer[self.pos:] + self.decoder.decode(data, final=self.eof)
+        self.pos = 0
         
-        if row:
-            current_total = row[0]
+        if len(self.buffer) > EXPORT_MAX_ELEMENT:
+            raise ValueError(f"Слишком большой элемент в файле экспорта (позиция {self.offset})")
+        return True
+    
+    def _advance(self, end):
+        self.offset += len(self.buffer[self.pos:end].encode('utf-8'))
+        self.pos = end
+    
+    def next_chat(self):
+        """Перейти к следующему массиву сообщений, вернуть заголовок чата или None в конце файла"""
+        while True:
+            match = EXPORT_MESSAGES_RE.search(self.buffer, self.pos)
+            if match:
+                header = self.buffer[self.pos:match.start()]
+                self._advance(match.end())
+                return parse_export_header(header)
             
-            # Получаем количество сообщений из истории
-            cursor.execute("""
-                SELECT SUM(message_count) FROM all_messages_history 
-                WHERE user_id = ? AND chat_id = ?
-            """, (user_id, chat_id))
+            # Хвост оставляем: в нем может быть заголовок или начало ключа
+            self._advance(max(self.pos, len(self.buffer) - EXPORT_HEADER_WINDOW))
+            if not self._fill():
+                return None
+    
+    def next_message(self):
+        """Следующее сообщение текущего массива или None после его конца"""
+        while True:
+            pos = EXPORT_SEPARATOR_RE.match(self.buffer, self.pos).end()
             
-            history_result = cursor.fetchone()
-            history_count = history_result[0] if history_result and history_result[0] else 0
+            if pos < len(self.buffer):
+                if self.buffer[pos] == ']':
+                    self._advance(pos + 1)
+                    return None
+                
+                try:
+                    message, end = self.json_decoder.raw_decode(self.buffer, pos)
+                    self._advance(end)
+                    return message
+                except json.JSONDecodeError:
+                    # Сообщение еще не дочитано целиком
+                    pass
             
-            # Если история показывает больше сообщений, обновляем
-            if history_count > current_total:
-                cursor.execute("""
-                    UPDATE messages SET total = ?, username = ? 
-                    WHERE user_id = ? AND chat_id = ?
-                """, (history_count, username, user_id, chat_id))
-                conn.commit()
-                logger.debug(f"Обновлено общее количество сообщений для пользователя {username}: {history_count}")
+            if not self._fill():
+                raise ValueError(f"Неожиданный конец файла экспорта (позиция {self.offset})")
+
+def parse_export_header(header: str) -> dict:
+    """Последние name/type/id перед массивом сообщений - это поля самого чата"""
+    fields = {}
+    for field, pattern in EXPORT_HEADER_RE.items():
+        matches = pattern.findall(header)
+        fields[field] = matches[-1] if matches else None
+    
+    if fields['name']:
+        fields['name'] = json.loads(fields['name'])
+    return fields
+
+def export_chat_id(chat_type, raw_id):
+    """ID чата в Bot API по типу и ID из экспорта; None для чатов, которые бот не считает"""
+    if raw_id is None:
+        return None
+    
+    raw_id = int(raw_id)
+    if chat_type == 'private_group':
+        return -raw_id
+    if chat_type in ('private_supergroup', 'public_supergroup'):
+        return -1000000000000 - raw_id
+    return None
+
+async def load_import_chat(chat_id):
+    """Граница импорта чата: уже импортированные сообщения и момент начала живого подсчета"""
+    row = await storage.load_import_chat(chat_id)
+    
+    return {
+        'chat_id': chat_id,
+        'last_message_id': row[0] or 0,
+        # Сообщения после появления бота в чате уже посчитаны вживую
+        'cutoff': row[1],
+    }
+
+def collect_import_batch(reader: ExportReader, chat: dict) -> dict:
+    """Прочитать до IMPORT_BATCH_MESSAGES сообщений и свернуть их по (чат, участник, день)"""
+    chat_id = chat['chat_id']
+    counters = {}
+    history = []
+    batch = {'counters': counters, 'history': history, 'last_message_id': None,
+             'last_message_date': None, 'finished': False}
+    
+    for _ in range(IMPORT_BATCH_MESSAGES):
+        message = reader.next_message()
+        if message is None:
+            batch['finished'] = True
+            break
+        
+        # Служебные записи, посты от имени каналов и уже учтенные сообщения пропускаем
+        if message.get('type') != 'message':
+            continue
+        
+        message_id = message.get('id') or 0
+        sender = str(message.get('from_id') or '')
+        message_time_str = message.get('date')
+        
+        if message_id <= chat['last_message_id'] or not sender.startswith('user') or not message_time_str:
+            continue
+        if chat['cutoff'] and message_time_str >= chat['cutoff']:
+            continue
+        
+        user_id = int(sender[4:])
+        username = message.get('from') or f"User {user_id}"
+        key = (chat_id, user_id, message_time_str[:10])
+        
+        entry = counters.get(key)
+        if entry:
+            entry[0] += 1
+            entry[3] = max(entry[3], message_time_str)
+        else:
+            counters[key] = [1, username, message_time_str, message_time_str]
+        
+        history.append((chat_id, user_id, username, message_time_str))
+        batch['last_message_id'] = message_id
+        batch['last_message_date'] = message_time_str
+    
+    return batch
+
+def _start_import(db, source, file_size, byte_offset, messages_imported):
+    current_time = datetime.now().isoformat()
+    db.execute("""
+        INSERT INTO history_imports
+        (source, file_size, byte_offset, messages_imported, status, started_at, updated_at)
+        VALUES (?, ?, ?, ?, 'running', ?, ?)
+        ON CONFLICT (source) DO UPDATE SET
+            file_size = excluded.file_size,
+            byte_offset = excluded.byte_offset,
+            messages_imported = excluded.messages_imported,
+            status = 'running',
+            updated_at = excluded.updated_at
+    """, (source, file_size, byte_offset, messages_imported, current_time, current_time))
+
+def _write_import_batch(db, source, chat_id, batch, byte_offset, messages_imported):
+    # Счетчики, история, дневная статистика и позиция в файле фиксируются одной транзакцией
+    _write_counter_batch(db, batch['counters'], batch['history'], {}, {})
+    
+    if batch['history']:
+        db.execute("""
+            INSERT INTO imported_chats (chat_id, last_message_id, last_message_date, messages_imported)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (chat_id) DO UPDATE SET
+                last_message_id = MAX(last_message_id, excluded.last_message_id),
+                last_message_date = MAX(last_message_date, excluded.last_message_date),
+                messages_imported = messages_imported + excluded.messages_imported
+        """, (chat_id, batch['last_message_id'], batch['last_message_date'], len(batch['history'])))
+        
+        # Оценка истории до бота больше не нужна: она теперь в счетчиках
+        db.execute("UPDATE chat_settings SET total_messages_before_bot = 0 WHERE chat_id = ?", (chat_id,))
+    
+    db.execute("""
+        UPDATE history_imports
+        SET byte_offset = ?, chat_id = ?, messages_imported = ?, updated_at = ?
+        WHERE source = ?
+    """, (byte_offset, None if batch['finished'] else chat_id, messages_imported,
+          datetime.now().isoformat(), source))
+
+def skip_export_chat(reader: ExportReader):
+    while reader.next_message() is not None:
+        pass
+
+async def import_history_file(path) -> int:
+    """Импортировать экспорт Telegram Desktop, продолжая с сохраненной позиции"""
+    path = Path(path)
+    source = str(path.resolve())
+    file_size = path.stat().st_size
+    
+    state = await storage.get_import_state(source)
+    
+    # Если файл изменился, читаем его заново: учтенные сообщения отсекаются по ID
+    if state and state[0] == file_size:
+        if state[4] == 'done':
+            logger.info(f"Экспорт {path.name} уже импортирован")
+            return 0
+        byte_offset, chat_id, messages_imported = state[1], state[2], state[3]
+    else:
+        byte_offset, chat_id, messages_imported = 0, None, 0
+    
+    await storage.start_import(source, file_size, byte_offset, messages_imported)
+    
+    if byte_offset:
+        logger.info(f"Продолжаю импорт {path.name} с {byte_offset / max(file_size, 1):.1%}")
+    
+    started = time.time()
+    imported_now = 0
+    reader = ExportReader(path, byte_offset)
+    
+    try:
+        chat = await load_import_chat(chat_id) if chat_id is not None else None
+        
+        while not is_shutting_down:
+            if chat is None:
+                header = await asyncio.to_thread(reader.next_chat)
+                if header is None:
+                    break
                 
-    except Exception as e:
-        logger.error(f"Ошибка обновления общего количества для пользователя {user_id}: {e}")
+                chat_id = export_chat_id(header['type'], header['id'])
+                if chat_id is None:
+                    # Каналы и личные переписки бот не считает
+                    await asyncio.to_thread(skip_export_chat, reader)
+                    continue
+                
+                chat = await load_import_chat(chat_id)
+                logger.info(f"Импорт чата {header['name'] or chat_id} ({chat_id}) из {path.name}")
+            
+            batch = await asyncio.to_thread(collect_import_batch, reader, chat)
+            imported_now += len(batch['history'])
+            messages_imported += len(batch['history'])
+            
+            await storage.write_import_batch(source, chat_id, batch, reader.offset, messages_imported)
+            
+            if batch['history']:
+                chat['last_message_id'] = batch['last_message_id']
+                await invalidate_chat(chat_id)
+            
+            elapsed = max(time.time() - started, 0.001)
+            logger.info(
+                f"Импорт {path.name}: {reader.offset / max(file_size, 1):.1%}, "
+                f"{messages_imported} сообщений ({imported_now / elapsed:.0f}/с)"
+            )
+            
+            if batch['finished']:
+                chat = None
+        else:
+            logger.info(f"Импорт {path.name} прерван, продолжится со следующего запуска")
+            return imported_now
+    finally:
+        reader.close()
+    
+    await storage.finish_import(source)
+    
+    logger.info(f"Импорт {path.name} завершен: {messages_imported} сообщений за {time.time() - started:.1f} с")
+    return imported_now
+
+async def import_history_command(paths):
+    """Импорт экспортов из командной строки: python main.py --import-history result.json ..."""
+    await init_storage()
+    try:
+        async with import_lock:
+            for path in paths:
+                await import_history_file(path)
+    finally:
+        await close_storage()
 
 # ==================== ОБРАБОТЧИКИ КОМАНД ====================
 async def handle_start(message: types.Message):
@@ -692,7 +3920,7 @@ async def handle_start(message: types.Message):
     elif chat_type == ChatType.PRIVATE:
         chat_title = message.from_user.full_name
     
-    update_chat_settings(message.chat.id, chat_title, chat_type)
+    await update_chat_settings(message.chat.id, chat_title, chat_type)
     
     welcome_text = """
 👋 Привет! Я бот для подсчета статистики сообщений в чате.
@@ -713,9 +3941,11 @@ async def handle_start(message: types.Message):
 /mystats - Ваша личная статистика
 /yesterday - Топ за вчера
 /weekly - Статистика за неделю
+/monthly - Статистика за месяц
+/range &lt;с&gt; &lt;по&gt; - Статистика за период
 /help - Помощь по командам
 /reset_today - Сбросить счетчики (админы)
-/scan_history - Просканировать историю сообщений (админы)
+/scan_history - Импортировать историю из экспорта (владельцы бота)
 
 💫 <b>Автоматически:</b>
 • Ежедневный отчет
@@ -739,7 +3969,7 @@ async def handle_help(message: types.Message):
     elif chat_type == ChatType.PRIVATE:
         chat_title = message.from_user.full_name
     
-    update_chat_settings(message.chat.id, chat_title, chat_type)
+    await update_chat_settings(message.chat.id, chat_title, chat_type)
         
     help_text = """
 <b>📚 Доступные команды:</b>
@@ -750,10 +3980,14 @@ async def handle_help(message: types.Message):
 /mystats - Ваша личная статистика
 /yesterday - Топ за вчера
 /weekly - Статистика за неделю
+/monthly - Статистика за месяц
+/range &lt;с&gt; &lt;по&gt; - Статистика за период
 
 ⚙️ <b>Для администраторов:</b>
 /reset_today - Сбросить счетчики на сегодня
-/scan_history - Просканировать историю сообщений
+
+🔧 <b>Для владельцев бота:</b>
+/scan_history - Импортировать историю из экспорта
 
 🎉 <b>Автоматически:</b>
 • Ежедневный отчет
@@ -765,7 +3999,7 @@ async def handle_help(message: types.Message):
     await message.reply(help_text)
 
 async def handle_scan_history(message: types.Message):
-    """Сканирование истории сообщений"""
+    """Импорт истории сообщений из экспортов"""
     if is_shutting_down:
         return
     
@@ -777,28 +4011,74 @@ async def handle_scan_history(message: types.Message):
     elif chat_type == ChatType.PRIVATE:
         chat_title = message.from_user.full_name
     
-    update_chat_settings(message.chat.id, chat_title, chat_type)
+    await update_chat_settings(message.chat.id, chat_title, chat_type)
     
-    # Проверяем права администратора
-    if chat_type in [ChatType.GROUP, ChatType.SUPERGROUP]:
+    # Импорт затрагивает все чаты из файлов экспорта, а список файлов раскрывает чужие чаты
+    if message.from_user.id not in BOT_OWNER_IDS:
+        await message.reply("⚠️ Импорт истории запускают только владельцы бота.")
+        return
+    
+    # Импорт выполняет один процесс; команда могла прийти в воркер другого чата
+    if is_maintenance_process():
+        started = start_history_import()
+    else:
         try:
-            chat_admins = await bot_instance.get_chat_administrators(message.chat.id)
-            admin_ids = [admin.user.id for admin in chat_admins]
-            
-            if message.from_user.id not in admin_ids:
-                await message.reply("⚠️ Эта команда доступна только администраторам.")
-                return
+            started = (await call_worker(MAINTENANCE_WORKER, "import", {}))["started"]
         except Exception as e:
-            logger.error(f"Error checking admin rights: {e}")
-            await message.reply("⚠️ Не удалось проверить права администратора.")
+            logger.error(f"Не удалось запустить импорт в воркере {MAINTENANCE_WORKER}: {e}")
+            await message.reply("⚠️ Не удалось запустить импорт истории, попробуйте позже.")
             return
     
-    await message.reply("🔄 Начинаю сканирование истории сообщений... Это может занять некоторое время.")
+    if not started:
+        text = "🔄 Импорт истории уже выполняется."
+    else:
+        text = (
+            f"🔄 Запускаю импорт истории из экспортов Telegram Desktop в папке "
+            f"<code>{HISTORY_IMPORT_DIR}</code>. Результаты будут учтены в статистике."
+        )
+    
+    imports = await storage.list_imports(5)
+    
+    if imports:
+        text += "\n\n<b>📥 Файлы экспорта:</b>\n"
+        for source, file_size, byte_offset, messages_imported, status in imports:
+            progress = "готово" if status == 'done' else f"{byte_offset / max(file_size or 1, 1):.0%}"
+            text += f"• {Path(source).name}: {progress}, {messages_imported} сообщ.\n"
+    
+    await message.reply(text)
+
+async def render_status(chat_id, chat_type):
+    """Текст /status"""
+    members_with_stats = await get_sorted_members(chat_id)
+    
+    if not members_with_stats:
+        return "📊 Пока нет статистики сообщений в этом чате.", None
     
-    # Запускаем сканирование в фоне
-    asyncio.create_task(scan_all_messages())
+    if chat_type == ChatType.PRIVATE:
+        if len(members_with_stats) > 0:
+            user_stats = members_with_stats[0]
+            text = f"<b>📊 Ваша статистика</b>\n\n"
+            text += f"👤 <b>{user_stats['username']}</b>\n"
+            text += f"📅 <b>Сегодня:</b> {user_stats['today']} сообщений\n"
+            text += f"🗓️ <b>Вчера:</b> {user_stats['yesterday']} сообщений\n"
+            text += f"📊 <b>Всего:</b> {user_stats['total']} сообщений\n"
+        else:
+            text = "📊 Пока нет статистики сообщений."
+    else:
+        text = f"<b>📊 Статистика чата</b>\n\n"
+        
+        # Показываем топ-5
+        for i, member in enumerate(members_with_stats[:5], 1):
+            username = member['username']
+            today_count = member['today']
+            total_count = member['total']
+            
+            emoji = "👑" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else "👤"
+            
+            text += f"<b>{i}. {emoji} {username}:</b>\n"
+            text += f"   📅 Сегодня: {today_count} | 📊 Всего: {total_count}\n\n"
     
-    await message.reply("✅ Сканирование истории запущено. Результаты будут учтены в статистике.")
+    return text, None
 
 async def handle_status(message: types.Message):
     """Обработчик команды /status"""
@@ -813,7 +4093,7 @@ async def handle_status(message: types.Message):
     elif chat_type == ChatType.PRIVATE:
         chat_title = message.from_user.full_name
     
-    update_chat_settings(message.chat.id, chat_title, chat_type)
+    await update_chat_settings(message.chat.id, chat_title, chat_type)
         
     logger.info(f"Command /status received from {message.from_user.id}")
     
@@ -825,41 +4105,88 @@ async def handle_status(message: types.Message):
             await message.reply("⚠️ В каналах статистика не собирается.")
             return
         
-        members_with_stats = await get_sorted_members(chat_id)
+        text, _ = await cached_response(chat_id, "status", None, lambda: render_status(chat_id, chat_type))
+        await message.reply(text)
         
-        if not members_with_stats:
-            await message.reply("📊 Пока нет статистики сообщений в этом чате.")
-            return
+    except Exception as e:
+        logger.error(f"Error in /status: {e}")
+        await message.reply("⚠️ Произошла ошибка при получении статистики.")
+
+async def render_top_page(chat_id, board: ChatLeaderboard, page: int):
+    """Текст страницы /top и кнопки навигации"""
+    pages = max(1, -(-len(board.members) // TOP_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    start = page * TOP_PAGE_SIZE
+    
+    text = f"<b>🏆 Топ участников сегодня</b>"
+    if pages > 1:
+        text += f" <i>(стр. {page + 1} из {pages})</i>"
+    text += "\n\n"
+    
+    for i, member in enumerate(board.page(start, start + TOP_PAGE_SIZE), start + 1):
+        username = member['username']
+        today_count = member['today']
+        total_count = member['total']
         
-        if chat_type == ChatType.PRIVATE:
-            if len(members_with_stats) > 0:
-                user_stats = members_with_stats[0]
-                text = f"<b>📊 Ваша статистика</b>\n\n"
-                text += f"👤 <b>{user_stats['username']}</b>\n"
-                text += f"📅 <b>Сегодня:</b> {user_stats['today']} сообщений\n"
-                text += f"🗓️ <b>Вчера:</b> {user_stats['yesterday']} сообщений\n"
-                text += f"📊 <b>Всего:</b> {user_stats['total']} сообщений\n"
-            else:
-                text = "📊 Пока нет статистики сообщений."
+        emoji = "👑" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
+        
+        text += f"<b>{emoji} {username}:</b>\n"
+        text += f"   📅 Сегодня: {today_count} сообщ. | 📊 Всего: {total_count}\n\n"
+    
+    # Получаем количество сообщений до бота
+    before_bot = await storage.get_messages_before_bot(chat_id)
+    
+    text += f"<b>📈 Итого по чату:</b>\n"
+    text += f"📅 Сегодня: <b>{board.today_sum}</b> сообщ.\n"
+    text += f"📊 Всего с ботом: <b>{board.total_sum}</b> сообщ.\n"
+    if before_bot > 0:
+        text += f"📜 До добавления бота: <b>{before_bot}</b> сообщ.\n"
+        text += f"📈 Общее всего: <b>{board.total_sum + before_bot}</b> сообщ."
+    
+    if pages == 1:
+        return text, None
+    
+    buttons = []
+    if page > 0:
+        buttons.append(types.InlineKeyboardButton(text="⬅️", callback_data=f"top:{page - 1}"))
+    buttons.append(types.InlineKeyboardButton(text="📍 Мое место", callback_data="top:me"))
+    if page < pages - 1:
+        buttons.append(types.InlineKeyboardButton(text="➡️", callback_data=f"top:{page + 1}"))
+    return text, types.InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+async def handle_top_page(callback: types.CallbackQuery):
+    """Кнопки навигации по страницам /top"""
+    if is_shutting_down or not callback.message:
+        await callback.answer()
+        return
+    
+    try:
+        chat_id = callback.message.chat.id
+        board = await get_leaderboard(chat_id)
+        
+        target = callback.data.split(":", 1)[1]
+        if target == "me":
+            rank = board.rank(callback.from_user.id)
+            if rank is None:
+                await callback.answer("Вас пока нет в рейтинге этого чата", show_alert=True)
+                return
+            page = (rank - 1) // TOP_PAGE_SIZE
+            await callback.answer(f"Ваше место: {rank} из {len(board.members)}")
         else:
-            text = f"<b>📊 Статистика чата</b>\n\n"
-            
-            # Показываем топ-5
-            for i, member in enumerate(members_with_stats[:5], 1):
-                username = member['username']
-                today_count = member['today']
-                total_count = member['total']
-                
-                emoji = "👑" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else "👤"
-                
-                text += f"<b>{i}. {emoji} {username}:</b>\n"
-                text += f"   📅 Сегодня: {today_count} | 📊 Всего: {total_count}\n\n"
+            page = int(target)
+            await callback.answer()
         
-        await message.reply(text)
+        text, keyboard = await cached_response(
+            chat_id, "top", page, lambda: render_top_page(chat_id, board, page)
+        )
+        try:
+            await callback.message.edit_text(text, reply_markup=keyboard)
+        except TelegramBadRequest:
+            # Страница не изменилась
+            pass
         
     except Exception as e:
-        logger.error(f"Error in /status: {e}")
-        await message.reply("⚠️ Произошла ошибка при получении статистики.")
+        logger.error(f"Error in /top navigation: {e}")
 
 async def handle_top(message: types.Message):
     """Обработчик команды /top"""
@@ -874,7 +4201,7 @@ async def handle_top(message: types.Message):
     elif chat_type == ChatType.PRIVATE:
         chat_title = message.from_user.full_name
     
-    update_chat_settings(message.chat.id, chat_title, chat_type)
+    await update_chat_settings(message.chat.id, chat_title, chat_type)
         
     logger.info(f"Command /top received from {message.from_user.id}")
         
@@ -890,42 +4217,16 @@ async def handle_top(message: types.Message):
             await message.reply("ℹ️ В личных чатах используйте команду /mystats.")
             return
         
-        members_with_stats = await get_sorted_members(chat_id)
+        board = await get_leaderboard(chat_id)
         
-        if not members_with_stats:
+        if not board.members:
             await message.reply("📊 Пока нет статистики сообщений в этом чате.")
             return
         
-        text = f"<b>🏆 Топ участников сегодня</b>\n\n"
-        
-        top_limit = min(10, len(members_with_stats))
-        
-        for i, member in enumerate(members_with_stats[:top_limit], 1):
-            username = member['username']
-            today_count = member['today']
-            total_count = member['total']
-            
-            emoji = "👑" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-            
-            text += f"<b>{emoji} {username}:</b>\n"
-            text += f"   📅 Сегодня: {today_count} сообщ. | 📊 Всего: {total_count}\n\n"
-        
-        total_today = sum(member['today'] for member in members_with_stats)
-        total_all = sum(member['total'] for member in members_with_stats)
-        
-        # Получаем количество сообщений до бота
-        cursor.execute("SELECT total_messages_before_bot FROM chat_settings WHERE chat_id = ?", (chat_id,))
-        before_bot_result = cursor.fetchone()
-        before_bot = before_bot_result[0] if before_bot_result else 0
-        
-        text += f"<b>📈 Итого по чату:</b>\n"
-        text += f"📅 Сегодня: <b>{total_today}</b> сообщ.\n"
-        text += f"📊 Всего с ботом: <b>{total_all}</b> сообщ.\n"
-        if before_bot > 0:
-            text += f"📜 До добавления бота: <b>{before_bot}</b> сообщ.\n"
-            text += f"📈 Общее всего: <b>{total_all + before_bot}</b> сообщ."
-        
-        await message.reply(text)
+        text, keyboard = await cached_response(
+            chat_id, "top", 0, lambda: render_top_page(chat_id, board, 0)
+        )
+        await message.reply(text, reply_markup=keyboard)
         
     except Exception as e:
         logger.error(f"Error in /top: {e}")
@@ -944,7 +4245,7 @@ async def handle_mystats(message: types.Message):
     elif chat_type == ChatType.PRIVATE:
         chat_title = message.from_user.full_name
     
-    update_chat_settings(message.chat.id, chat_title, chat_type)
+    await update_chat_settings(message.chat.id, chat_title, chat_type)
         
     logger.info(f"Command /mystats received from {message.from_user.id}")
     
@@ -952,14 +4253,10 @@ async def handle_mystats(message: types.Message):
         user_id = message.from_user.id
         chat_id = message.chat.id
         
-        cursor.execute("""
-            SELECT username, today, yesterday, total, first_seen 
-            FROM messages WHERE user_id=? AND chat_id=?
-        """, (user_id, chat_id))
-        row = cursor.fetchone()
+        row = await storage.get_user_stats(chat_id, user_id, current_day())
         
         if row:
-            username, today, yesterday, total, first_seen = row
+            username, today, yesterday, total, first_seen, total_all_chats, today_all_chats, chats_count = row
             
             try:
                 if isinstance(first_seen, str):
@@ -976,14 +4273,14 @@ async def handle_mystats(message: types.Message):
             text += f"🗓️ <b>Вчера:</b> {yesterday} сообщений\n"
             text += f"📊 <b>Всего в этом чате:</b> {total} сообщений\n"
             
-            # Получаем общую статистику по всем чатам
-            cursor.execute("""
-                SELECT SUM(total) FROM messages WHERE user_id=?
-            """, (user_id,))
-            total_all_chats = cursor.fetchone()[0] or 0
+            # Место в рейтинге чата: бинарный поиск в уже упорядоченном рейтинге
+            board = await get_leaderboard(chat_id)
+            rank = board.rank(user_id)
+            if rank:
+                text += f"🏅 <b>Место в чате:</b> {rank} из {len(board.members)}\n"
             
-            if total_all_chats > total:
-                text += f"📈 <b>Всего во всех чатах:</b> {total_all_chats} сообщений\n"
+            if chats_count > 1:
+                text += f"📈 <b>Во всех чатах ({chats_count}):</b> сегодня {today_all_chats}, всего {total_all_chats} сообщений\n"
             
             text += f"📅 <b>С нами с:</b> {first_seen_str}"
             
@@ -995,6 +4292,23 @@ async def handle_mystats(message: types.Message):
         logger.error(f"Error in /mystats: {e}")
         await message.reply("⚠️ Произошла ошибка при получении статистики.")
 
+async def render_yesterday(chat_id):
+    """Текст /yesterday"""
+    rows, total_yesterday = await storage.yesterday_top(chat_id, current_day(), 10)
+    
+    if not rows:
+        return "📊 Вчера не было сообщений или статистика не собрана.", None
+        
+    text = f"<b>📊 Топ за вчера</b>\n\n"
+    
+    for i, (username, count) in enumerate(rows, 1):
+        emoji = "👑" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
+        
+        text += f"{emoji} <b>{username}:</b> {count} сообщ.\n"
+    
+    text += f"\n<b>📈 Итого за вчера:</b> {total_yesterday} сообщений"
+    return text, None
+
 async def handle_yesterday(message: types.Message):
     """Обработчик команды /yesterday"""
     if is_shutting_down:
@@ -1008,7 +4322,7 @@ async def handle_yesterday(message: types.Message):
     elif chat_type == ChatType.PRIVATE:
         chat_title = message.from_user.full_name
     
-    update_chat_settings(message.chat.id, chat_title, chat_type)
+    await update_chat_settings(message.chat.id, chat_title, chat_type)
         
     logger.info(f"Command /yesterday received from {message.from_user.id}")
     
@@ -1020,37 +4334,59 @@ async def handle_yesterday(message: types.Message):
             await message.reply("⚠️ В каналах статистика не собирается.")
             return
         
-        cursor.execute("""
-            SELECT username, yesterday as count 
-            FROM messages 
-            WHERE chat_id = ? AND yesterday > 0 
-            ORDER BY yesterday DESC 
-            LIMIT 10
-        """, (chat_id,))
-        rows = cursor.fetchall()
-        
-        if not rows:
-            await message.reply("📊 Вчера не было сообщений или статистика не собрана.")
-            return
-            
-        text = f"<b>📊 Топ за вчера</b>\n\n"
-        
-        for i, (username, count) in enumerate(rows, 1):
-            emoji = "👑" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-            
-            text += f"{emoji} <b>{username}:</b> {count} сообщ.\n"
-        
-        cursor.execute("SELECT SUM(yesterday) FROM messages WHERE chat_id = ?", (chat_id,))
-        total_yesterday = cursor.fetchone()[0] or 0
-        
-        text += f"\n<b>📈 Итого за вчера:</b> {total_yesterday} сообщений"
-        
+        text, _ = await cached_response(chat_id, "yesterday", None, lambda: render_yesterday(chat_id))
         await message.reply(text)
         
     except Exception as e:
         logger.error(f"Error in /yesterday: {e}")
         await message.reply("⚠️ Произошла ошибка при получении статистики.")
 
+def parse_date(value: str):
+    """Дата из аргумента команды: ДД.ММ.ГГГГ или ГГГГ-ММ-ДД"""
+    for date_format in ('%d.%m.%Y', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            continue
+    return None
+
+async def render_period_stats(chat_id, start_date, end_date, title, summary_title):
+    """Статистика чата за период из дневных агрегатов одним запросом"""
+    rows = await storage.period_stats(
+        chat_id, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')
+    )
+    
+    if not rows:
+        return None
+    
+    period_days = (end_date - start_date).days + 1
+    text = f"<b>{title}</b>\n\n"
+    
+    total_messages_period = 0
+    total_active_period = 0
+    
+    for date_str, total_messages, active_users in rows:
+        # Подробности по дням показываем только для периодов до месяца
+        if period_days <= 31:
+            date_obj = datetime.strptime(date_str, '%Y-%m-%d')
+            text += f"<b>{date_obj.strftime('%d.%m')}:</b> {total_messages} сообщ. от {active_users} чел.\n"
+        total_messages_period += total_messages
+        total_active_period += active_users
+    
+    days_with_data = len(rows)
+    if days_with_data < period_days:
+        text += f"\n<i>Данных за {period_days - days_with_data} дней нет</i>\n"
+    
+    text += f"\n<b>📈 {summary_title}:</b>\n"
+    text += f"📨 Сообщений: <b>{total_messages_period}</b>\n"
+    text += f"👥 Активных пользователей: <b>{total_active_period}</b>\n"
+    
+    if days_with_data > 0:
+        avg_per_day = total_messages_period // days_with_data
+        text += f"📊 В среднем в день: <b>{avg_per_day}</b> сообщ."
+    
+    return text
+
 async def handle_weekly(message: types.Message):
     """Обработчик команды /weekly"""
     if is_shutting_down:
@@ -1064,7 +4400,7 @@ async def handle_weekly(message: types.Message):
     elif chat_type == ChatType.PRIVATE:
         chat_title = message.from_user.full_name
     
-    update_chat_settings(message.chat.id, chat_title, chat_type)
+    await update_chat_settings(message.chat.id, chat_title, chat_type)
         
     logger.info(f"Command /weekly received from {message.from_user.id}")
     
@@ -1072,47 +4408,103 @@ async def handle_weekly(message: types.Message):
         end_date = datetime.now().date()
         start_date = end_date - timedelta(days=6)
         
-        cursor.execute("""
-            SELECT date, total_messages, active_users 
-            FROM daily_stats 
-            WHERE date BETWEEN ? AND ?
-            ORDER BY date DESC
-        """, (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')))
-        
-        rows = cursor.fetchall()
+        text = await render_period_stats(
+            message.chat.id, start_date, end_date, "📅 Статистика за неделю", "Итоги недели"
+        )
         
-        if not rows:
+        if not text:
             await message.reply("📊 Недостаточно данных для недельного отчета.")
             return
-            
-        text = f"<b>📅 Статистика за неделю</b>\n\n"
         
-        total_messages_week = 0
-        total_active_week = 0
+        await message.reply(text)
         
-        for date_str, total_messages, active_users in rows:
-            date_obj = datetime.strptime(date_str, '%Y-%m-%d')
-            text += f"<b>{date_obj.strftime('%d.%m')}:</b> {total_messages} сообщ. от {active_users} чел.\n"
-            total_messages_week += total_messages
-            total_active_week += active_users
+    except Exception as e:
+        logger.error(f"Error in /weekly: {e}")
+        await message.reply("⚠️ Произошла ошибка при получении недельной статистики.")
+
+async def handle_monthly(message: types.Message):
+    """Обработчик команды /monthly"""
+    if is_shutting_down:
+        return
+    
+    # Обновляем настройки чата
+    chat_type = message.chat.type
+    chat_title = None
+    if chat_type in [ChatType.GROUP, ChatType.SUPERGROUP]:
+        chat_title = message.chat.title
+    elif chat_type == ChatType.PRIVATE:
+        chat_title = message.from_user.full_name
+    
+    await update_chat_settings(message.chat.id, chat_title, chat_type)
         
-        days_with_data = len(rows)
-        if days_with_data < 7:
-            text += f"\n<i>Данных за {7 - days_with_data} дней нет</i>\n"
+    logger.info(f"Command /monthly received from {message.from_user.id}")
+    
+    try:
+        end_date = datetime.now().date()
+        start_date = end_date - timedelta(days=29)
         
-        text += f"\n<b>📈 Итоги недели:</b>\n"
-        text += f"📨 Сообщений: <b>{total_messages_week}</b>\n"
-        text += f"👥 Активных пользователей: <b>{total_active_week}</b>\n"
+        text = await render_period_stats(
+            message.chat.id, start_date, end_date, "🗓️ Статистика за месяц", "Итоги месяца"
+        )
         
-        if days_with_data > 0:
-            avg_per_day = total_messages_week // days_with_data
-            text += f"📊 В среднем в день: <b>{avg_per_day}</b> сообщ."
+        if not text:
+            await message.reply("📊 Недостаточно данных для месячного отчета.")
+            return
         
         await message.reply(text)
         
     except Exception as e:
-        logger.error(f"Error in /weekly: {e}")
-        await message.reply("⚠️ Произошла ошибка при получении недельной статистики.")
+        logger.error(f"Error in /monthly: {e}")
+        await message.reply("⚠️ Произошла ошибка при получении месячной статистики.")
+
+async def handle_range(message: types.Message):
+    """Обработчик команды /range <с> <по>"""
+    if is_shutting_down:
+        return
+    
+    # Обновляем настройки чата
+    chat_type = message.chat.type
+    chat_title = None
+    if chat_type in [ChatType.GROUP, ChatType.SUPERGROUP]:
+        chat_title = message.chat.title
+    elif chat_type == ChatType.PRIVATE:
+        chat_title = message.from_user.full_name
+    
+    await update_chat_settings(message.chat.id, chat_title, chat_type)
+        
+    logger.info(f"Command /range received from {message.from_user.id}")
+    
+    try:
+        args = (message.text or "").split()[1:]
+        start_date = parse_date(args[0]) if len(args) == 2 else None
+        end_date = parse_date(args[1]) if len(args) == 2 else None
+        
+        if not start_date or not end_date or start_date > end_date:
+            await message.reply(
+                "ℹ️ Использование: /range &lt;с&gt; &lt;по&gt;\n"
+                "Например: /range 01.05.2025 31.05.2025"
+            )
+            return
+        
+        if (end_date - start_date).days >= 366:
+            await message.reply("⚠️ Период не должен превышать год.")
+            return
+        
+        text = await render_period_stats(
+            message.chat.id, start_date, end_date,
+            f"📆 Статистика за {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}",
+            "Итоги периода"
+        )
+        
+        if not text:
+            await message.reply("📊 Нет данных за выбранный период.")
+            return
+        
+        await message.reply(text)
+        
+    except Exception as e:
+        logger.error(f"Error in /range: {e}")
+        await message.reply("⚠️ Произошла ошибка при получении статистики за период.")
 
 async def handle_reset_today(message: types.Message):
     """Обработчик команды /reset_today"""
@@ -1127,7 +4519,7 @@ async def handle_reset_today(message: types.Message):
     elif chat_type == ChatType.PRIVATE:
         chat_title = message.from_user.full_name
     
-    update_chat_settings(message.chat.id, chat_title, chat_type)
+    await update_chat_settings(message.chat.id, chat_title, chat_type)
         
     logger.info(f"Command /reset_today received from {message.from_user.id}")
         
@@ -1145,41 +4537,17 @@ async def handle_reset_today(message: types.Message):
         chat_id = message.chat.id
         
         try:
-            chat_admins = await bot_instance.get_chat_administrators(chat_id)
-            admin_ids = [admin.user.id for admin in chat_admins]
-            
-            if message.from_user.id not in admin_ids:
+            if not await is_chat_admin(chat_id, message.from_user.id):
                 await message.reply("⚠️ Эта команда доступна только администраторам.")
                 return
         except Exception as e:
             logger.error(f"Error checking admin rights: {e}")
             await message.reply("⚠️ Не удалось проверить права администратора.")
             return
-            
-        cursor.execute("SELECT SUM(today) FROM messages WHERE chat_id = ?", (chat_id,))
-        total_today = cursor.fetchone()[0] or 0
-        
-        cursor.execute("SELECT COUNT(DISTINCT user_id) FROM messages WHERE chat_id = ? AND today > 0", (chat_id,))
-        active_today = cursor.fetchone()[0] or 0
-        
-        cursor.execute("SELECT user_id, today FROM messages WHERE chat_id = ? AND today > 0 ORDER BY today DESC LIMIT 1", (chat_id,))
-        top_user = cursor.fetchone()
-        
-        today_date = datetime.now().strftime('%Y-%m-%d')
-        cursor.execute("""
-            INSERT OR REPLACE INTO daily_stats 
-            (date, total_messages, active_users, top_user_id, top_user_count)
-            VALUES (?, ?, ?, ?, ?)
-        """, (
-            today_date,
-            total_today,
-            active_today,
-            top_user[0] if top_user else None,
-            top_user[1] if top_user else 0
-        ))
         
-        cursor.execute("UPDATE messages SET yesterday = today, today = 0 WHERE chat_id = ?", (chat_id,))
-        conn.commit()
+        await flush_counters()
+            
+        total_today, active_today = await storage.reset_today(chat_id, current_day())
         
         clear_chat_cache(chat_id)
         
@@ -1192,201 +4560,521 @@ async def handle_reset_today(message: types.Message):
         logger.error(f"Error in /reset_today: {e}")
         await message.reply("⚠️ Произошла ошибка при сбросе счетчиков.")
 
+async def handle_chat_member(update: types.ChatMemberUpdated):
+    """Изменение прав участника или самого бота: список администраторов устарел"""
+    admin_statuses = ("administrator", "creator")
+    if (update.old_chat_member.status in admin_statuses
+            or update.new_chat_member.status in admin_statuses):
+        chat_admins.pop(update.chat.id)
+
+def is_counted_message(message: types.Message) -> bool:
+    """Учитывается ли сообщение в статистике (текст без команды проверяет фильтр)"""
+    if not message.from_user or message.from_user.is_bot:
+        return False
+    return message.chat.type != ChatType.CHANNEL
+
+async def register_message_chat(message: types.Message):
+    """Обновить настройки чата, из которого пришло сообщение"""
+    chat_type = message.chat.type
+    chat_title = None
+    if chat_type in [ChatType.GROUP, ChatType.SUPERGROUP]:
+        chat_title = message.chat.title
+    elif chat_type == ChatType.PRIVATE:
+        chat_title = message.from_user.full_name
+    
+    await update_chat_settings(message.chat.id, chat_title, chat_type)
+
+def buffer_counted_message(message: types.Message, message_time: datetime):
+    """Добавить сообщение в буфер счетчиков без обращения к БД"""
+    user_id = message.from_user.id
+    username = message.from_user.full_name
+    chat_id = message.chat.id
+    
+    remember_user(message.from_user)
+    
+    # Счетчики копятся в памяти и пишутся в БД пачками; журнал сохраняет их до записи
+    buffer_message(chat_id, user_id, username, message_time)
+    if counter_journal:
+        counter_journal.append(chat_id, user_id, username, message_time)
+
+async def record_message(message: types.Message, message_time: datetime):
+    """Добавить сообщение в буфер счетчиков"""
+    await register_message_chat(message)
+    buffer_counted_message(message, message_time)
+
 async def count_messages(message: types.Message):
     """Подсчет сообщений"""
     if is_shutting_down:
         return
-        
-    if not message.from_user:
+    
+    if not is_counted_message(message):
         return
+    
+    await record_message(message, datetime.now())
+    
+    if len(pending_history) >= COUNTER_FLUSH_MAX_MESSAGES:
+        await flush_counters()
 
-    user_id = message.from_user.id
-    username = message.from_user.full_name
-    chat_id = message.chat.id
-    chat_type = message.chat.type
+# ==================== ШАРДИРОВАНИЕ ====================
+def ring_hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
 
-    if chat_type == ChatType.CHANNEL:
-        return
+class HashRing:
+    """Консистентное хеширование: при изменении числа воркеров переезжает ~1/N чатов"""
+    
+    def __init__(self, nodes, vnodes: int = HASH_RING_VNODES):
+        self.ring = sorted(
+            (ring_hash(f"{node}:{replica}"), node)
+            for node in nodes for replica in range(vnodes)
+        )
+        self.keys = [point for point, _ in self.ring]
+    
+    def owner(self, key) -> int:
+        index = bisect.bisect(self.keys, ring_hash(str(key))) % len(self.ring)
+        return self.ring[index][1]
+
+hash_ring = HashRing(range(WORKER_COUNT))
+
+def process_role() -> str:
+    """single - один процесс, coordinator - принимает обновления, worker - обрабатывает чаты"""
+    if worker_id is not None:
+        return "worker"
+    return "coordinator" if WORKER_COUNT > 1 else "single"
+
+def owns_chat(chat_id) -> bool:
+    """Обрабатывает ли этот процесс указанный чат"""
+    return worker_id is None or hash_ring.owner(chat_id) == worker_id
+
+def is_maintenance_process() -> bool:
+    """Выполняет ли этот процесс задачи над всей базой, в том числе импорт истории.
+    
+    Блокировка импорта действует внутри одного процесса, поэтому импорт в двух
+    воркерах сразу посчитал бы один и тот же файл дважды.
+    """
+    return worker_id is None or worker_id == MAINTENANCE_WORKER
 
-    if message.from_user.is_bot:
+async def call_worker(index: int, action: str, payload: dict) -> dict:
+    """Служебный запрос к воркеру index"""
+    global forward_session
+    
+    if forward_session is None:
+        forward_session = ClientSession()
+    
+    url = f"http://127.0.0.1:{WORKER_BASE_PORT + index}{WORKER_INTERNAL_PATH}/{action}"
+    async with forward_session.post(url, json=payload, headers={"X-Worker-Secret": WORKER_SECRET}) as response:
+        response.raise_for_status()
+        return await response.json()
+
+async def internal_handler(request):
+    """Служебные запросы от координатора и других воркеров"""
+    if request.headers.get("X-Worker-Secret") != WORKER_SECRET:
+        return web.Response(status=403)
+    
+    action = request.match_info["action"]
+    payload = await request.json()
+    
+    if action == "invalidate":
+        for chat_id in payload["chat_ids"]:
+            clear_chat_cache(chat_id)
+        return web.json_response({"ok": True})
+    if action == "import":
+        return web.json_response({"started": start_history_import()})
+    if action == "count":
+        messages = [types.Message.model_validate(raw) for raw in payload["messages"]]
+        return web.json_response({"rows": await count_backlog(messages)})
+    return web.Response(status=404)
+
+async def invalidate_chat(chat_id):
+    """Сбросить кэши чата в процессе, который им владеет"""
+    if owns_chat(chat_id):
+        clear_chat_cache(chat_id)
         return
+    
+    index = hash_ring.owner(chat_id)
+    try:
+        await call_worker(index, "invalidate", {"chat_ids": [chat_id]})
+    except Exception as e:
+        logger.warning(f"Не удалось сбросить кэш чата {chat_id} в воркере {index}: {e}")
 
-    # Обновляем настройки чата
-    chat_title = None
-    if chat_type in [ChatType.GROUP, ChatType.SUPERGROUP]:
-        chat_title = message.chat.title
-    elif chat_type == ChatType.PRIVATE:
-        chat_title = message.from_user.full_name
+def update_chat_id(update: types.Update):
+    """Чат, к которому относится обновление, или None"""
+    try:
+        event = update.event
+    except Exception:
+        return None
+    
+    chat = getattr(event, 'chat', None) or getattr(getattr(event, 'message', None), 'chat', None)
+    return chat.id if chat else None
+
+async def route_update(handler, update: types.Update, data: dict):
+    """Middleware координатора: передать обновление воркеру, который владеет чатом"""
+    chat_id = update_chat_id(update)
+    index = hash_ring.owner(chat_id) if chat_id is not None else 0
+    url = f"http://127.0.0.1:{WORKER_BASE_PORT + index}{WORKER_UPDATE_PATH}"
+    payload = update.model_dump_json(by_alias=True, exclude_none=True)
+    
+    # Несколько попыток на случай перезапуска воркера
+    for attempt in range(3):
+        try:
+            async with forward_session.post(url, data=payload, headers={
+                "Content-Type": "application/json",
+                "X-Telegram-Bot-Api-Secret-Token": WORKER_SECRET,
+            }) as response:
+                if response.status == 200:
+                    return
+                logger.warning(f"Воркер {index} ответил {response.status} на обновление {update.update_id}")
+        except ClientError as e:
+            logger.warning(f"Воркер {index} недоступен: {e}")
+        await asyncio.sleep(1)
     
-    update_chat_settings(chat_id, chat_title, chat_type)
+    logger.error(f"Обновление {update.update_id} не передано воркеру {index}")
 
-    current_time = datetime.now()
+async def supervise_worker(index: int):
+    """Запустить воркер и перезапускать его при падении"""
+    env = {**os.environ, "WORKER_ID": str(index), "WORKER_SECRET": WORKER_SECRET}
     
-    # Сохраняем в историю всех сообщений
-    cursor.execute("""
-        INSERT INTO all_messages_history 
-        (chat_id, user_id, username, message_date, message_count)
-        VALUES (?, ?, ?, ?, 1)
-    """, (chat_id, user_id, username, current_time.isoformat()))
+    while not is_shutting_down:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), "--worker", env=env
+        )
+        worker_processes[index] = process
+        logger.info(f"Воркер {index} запущен (PID {process.pid})")
+        
+        returncode = await process.wait()
+        if is_shutting_down:
+            break
+        
+        logger.error(f"Воркер {index} завершился с кодом {returncode}, перезапуск...")
+        await asyncio.sleep(1)
+
+async def start_workers():
+    """Запустить WORKER_COUNT воркеров под наблюдением координатора"""
+    global forward_session
     
-    cursor.execute("SELECT * FROM messages WHERE user_id=? AND chat_id=?", (user_id, chat_id))
-    row = cursor.fetchone()
+    forward_session = ClientSession()
+    for index in range(WORKER_COUNT):
+        run_in_background(supervise_worker(index))
+    logger.info(f"Запущено воркеров: {WORKER_COUNT}")
 
-    if row:
-        last_updated_str = row[6]  # last_updated находится на 7 позиции (индекс 6)
-        if last_updated_str:
+async def wait_for_workers(timeout: float) -> bool:
+    """Дождаться, пока все воркеры начнут отвечать на /health"""
+    deadline = time.monotonic() + timeout
+    waiting = set(range(WORKER_COUNT))
+    
+    while waiting and time.monotonic() < deadline:
+        for index in list(waiting):
             try:
-                if 'Z' in last_updated_str:
-                    last_updated_str = last_updated_str.replace('Z', '+00:00')
-                last_updated = datetime.fromisoformat(last_updated_str)
-                
-                if current_time.date() > last_updated.date():
-                    cursor.execute("""
-                        UPDATE messages
-                        SET yesterday = today,
-                            today = 1,
-                            total = total + 1,
-                            username = ?,
-                            last_updated = ?
-                        WHERE user_id=? AND chat_id=?
-                    """, (username, current_time.isoformat(), user_id, chat_id))
-                else:
-                    cursor.execute("""
-                        UPDATE messages
-                        SET today = today + 1,
-                            total = total + 1,
-                            username = ?,
-                            last_updated = ?
-                        WHERE user_id=? AND chat_id=?
-                    """, (username, current_time.isoformat(), user_id, chat_id))
-            except Exception as e:
-                logger.error(f"Error parsing last_updated: {e}, resetting counters")
-                cursor.execute("""
-                    UPDATE messages
-                    SET today = today + 1,
-                        total = total + 1,
-                        username = ?,
-                        last_updated = ?
-                    WHERE user_id=? AND chat_id=?
-                """, (username, current_time.isoformat(), user_id, chat_id))
-        else:
-            cursor.execute("""
-                UPDATE messages
-                SET today = today + 1,
-                    total = total + 1,
-                    username = ?,
-                    last_updated = ?
-                WHERE user_id=? AND chat_id=?
-            """, (username, current_time.isoformat(), user_id, chat_id))
-    else:
-        cursor.execute("""
-            INSERT INTO messages (user_id, chat_id, username, today, total, first_seen, last_updated)
-            VALUES (?, ?, ?, 1, 1, ?, ?)
-        """, (user_id, chat_id, username, current_time.isoformat(), current_time.isoformat()))
+                async with forward_session.get(f"http://127.0.0.1:{WORKER_BASE_PORT + index}/health") as response:
+                    if response.status == 200:
+                        waiting.discard(index)
+            except ClientError:
+                pass
+        if waiting:
+            await asyncio.sleep(0.5)
+    
+    return not waiting
 
-    conn.commit()
-    clear_chat_cache(chat_id)
+async def stop_workers():
+    """Остановить воркеры; каждый сам записывает свой буфер счетчиков"""
+    processes = [process for process in worker_processes.values() if process.returncode is None]
     
-    # Обновляем общее количество с учетом истории
-    await update_total_count_for_user(user_id, chat_id, username)
+    for process in processes:
+        process.terminate()
+    
+    try:
+        await asyncio.wait_for(asyncio.gather(*(process.wait() for process in processes)), timeout=30)
+    except asyncio.TimeoutError:
+        for process in processes:
+            if process.returncode is None:
+                process.kill()
 
-# ==================== ОСНОВНАЯ ФУНКЦИЯ ====================
-async def main():
-    global bot_instance, dp, scheduler_instance, polling_task
+# ==================== ДОГОНЯЮЩИЙ РЕЖИМ ====================
+def message_local_time(message: types.Message) -> datetime:
+    """Время отправки сообщения в локальном времени, как у счетчиков"""
+    return message.date.astimezone().replace(tzinfo=None)
+
+async def count_backlog(messages) -> int:
+    """Учесть сообщения очереди по их датам одной записью буфера, вернуть число строк счетчиков"""
+    # Чаты регистрируются заранее: между буферизацией и записью нет ожиданий,
+    # и периодическая запись не разобьет порцию на части
+    for message in messages:
+        await register_message_chat(message)
     
-    # Регистрируем обработчики сигналов
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+    for message in messages:
+        buffer_counted_message(message, message_local_time(message))
     
-    # Инициализация базы данных
-    init_database()
+    rows = len(pending_counters)
+    await flush_counters()
+    return rows
+
+async def forward_backlog(index: int, messages) -> int:
+    """Передать порцию очереди воркеру index; вернуть число строк счетчиков"""
+    payload = {"messages": [
+        message.model_dump(mode="json", by_alias=True, exclude_none=True,
+                           include={"message_id", "date", "chat", "from_user"})
+        for message in messages
+    ]}
     
-    # Создание бота и диспетчера
-    bot_instance = Bot(
-        token=API_TOKEN, 
+    for attempt in range(5):
+        try:
+            return (await call_worker(index, "count", payload))["rows"]
+        except Exception as e:
+            logger.warning(f"Воркер {index} не принял очередь: {e}")
+            await asyncio.sleep(1)
+    
+    logger.error(f"Догоняющий режим: {len(messages)} сообщений не переданы воркеру {index}")
+    return 0
+
+async def catch_up_updates():
+    """Учесть сообщения, отправленные, пока бот был остановлен.
+    
+    Очередь getUpdates читается пачками до конца; сообщения группируются в буфере
+    счетчиков по (чат, участник, день) своей даты и записываются одной транзакцией
+    (у координатора - в воркере, который владеет чатом).
+    Остальные обновления (команды, кнопки) устарели и пропускаются.
+    """
+    started = time.monotonic()
+    cutoff = datetime.now() - timedelta(hours=CATCHUP_MAX_AGE_HOURS)
+    allowed_updates = dp.resolve_used_update_types()
+    role = process_role()
+    offset = None
+    received = too_old = 0
+    backlog = {}  # номер воркера (0 без воркеров) -> сообщения
+    
+    # getUpdates недоступен при установленном webhook; очередь при удалении сохраняется
+    await bot_instance.delete_webhook(drop_pending_updates=False)
+    
+    while not is_shutting_down:
+        updates = await bot_instance.get_updates(
+            offset=offset, limit=CATCHUP_BATCH_SIZE, timeout=0, allowed_updates=allowed_updates
+        )
+        received += len(updates)
+        
+        for update in updates:
+            offset = update.update_id + 1
+            message = update.message
+            if (not message or not message.text or message.text.startswith('/')
+                    or not is_counted_message(message)):
+                continue
+            
+            if message_local_time(message) < cutoff:
+                too_old += 1
+                continue
+            
+            index = hash_ring.owner(message.chat.id) if role == "coordinator" else 0
+            backlog.setdefault(index, []).append(message)
+        
+        # Неполная пачка - очередь прочитана; новые сообщения получит обычный polling
+        if len(updates) < CATCHUP_BATCH_SIZE:
+            break
+    
+    if offset is not None:
+        # Подтверждаем прочитанное, иначе polling получит эти обновления повторно
+        await bot_instance.get_updates(offset=offset, limit=1, timeout=0, allowed_updates=allowed_updates)
+    
+    counted = sum(len(messages) for messages in backlog.values())
+    rows = 0
+    
+    if role != "coordinator":
+        if backlog:
+            rows = await count_backlog(backlog[0])
+    elif backlog:
+        # Воркеры только что запущены: без ожидания первые порции ушли бы в пустоту
+        if not await wait_for_workers(CATCHUP_WORKER_WAIT):
+            logger.warning(f"Не все воркеры ответили за {CATCHUP_WORKER_WAIT} с")
+        
+        for index, messages in backlog.items():
+            for start in range(0, len(messages), CATCHUP_FORWARD_CHUNK):
+                rows += await forward_backlog(index, messages[start:start + CATCHUP_FORWARD_CHUNK])
+    
+    logger.info(
+        f"Догоняющий режим: обновлений {received}, учтено сообщений {counted} "
+        f"({rows} строк счетчиков), старше {CATCHUP_MAX_AGE_HOURS:g} ч пропущено {too_old}, "
+        f"за {time.monotonic() - started:.1f} с"
+    )
+
+# ==================== ОСНОВНАЯ ФУНКЦИЯ ====================
+def create_bot():
+    """Бот с учетом BOT_API_URL и метриками вызовов Bot API"""
+    session = AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL)) if BOT_API_URL else None
+    bot = Bot(
+        token=API_TOKEN,
+        session=session,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     )
-    dp = Dispatcher()
+    bot.session.middleware(measure_api_call)
+    return bot
+
+def create_dispatcher():
+    """Диспетчер со всеми обработчиками"""
+    dispatcher = Dispatcher()
+    dispatcher.update.outer_middleware(measure_update)
+    dispatcher.message.middleware(measure_handler)
+    dispatcher.callback_query.middleware(measure_handler)
     
     # Регистрация обработчиков
-    dp.message.register(handle_start, Command("start"))
-    dp.message.register(handle_help, Command("help"))
-    dp.message.register(handle_status, Command("status"))
-    dp.message.register(handle_top, Command("top"))
-    dp.message.register(handle_mystats, Command("mystats"))
-    dp.message.register(handle_yesterday, Command("yesterday"))
-    dp.message.register(handle_weekly, Command("weekly"))
-    dp.message.register(handle_reset_today, Command("reset_today"))
-    dp.message.register(handle_scan_history, Command("scan_history"))
-    dp.message.register(count_messages, F.text & ~F.text.startswith('/'))
-    
-    # Запуск HTTP-сервера в отдельном потоке
-    http_thread = threading.Thread(target=run_http_server, daemon=True)
-    http_thread.start()
-    logger.info("HTTP сервер запущен на порту 10000")
-    
-    # Регистрация команд бота
-    try:
-        await bot_instance.set_my_commands([
-            types.BotCommand(command="start", description="🚀 Запустить бота"),
-            types.BotCommand(command="status", description="📊 Статистика чата"),
-            types.BotCommand(command="top", description="🏆 Топ-10 участников"),
-            types.BotCommand(command="mystats", description="📈 Ваша статистика"),
-            types.BotCommand(command="yesterday", description="🗓️ Топ за вчера"),
-            types.BotCommand(command="weekly", description="📅 Статистика за неделю"),
-            types.BotCommand(command="reset_today", description="🔄 Сбросить счетчики"),
-            types.BotCommand(command="scan_history", description="🔍 Сканировать историю"),
-            types.BotCommand(command="help", description="❓ Помощь по командам")
-        ])
-        logger.info("Команды бота зарегистрированы")
-    except Exception as e:
-        logger.error(f"Ошибка регистрации команд: {e}")
+    dispatcher.message.register(handle_start, Command("start"))
+    dispatcher.message.register(handle_help, Command("help"))
+    dispatcher.message.register(handle_status, Command("status"))
+    dispatcher.message.register(handle_top, Command("top"))
+    dispatcher.message.register(handle_mystats, Command("mystats"))
+    dispatcher.message.register(handle_yesterday, Command("yesterday"))
+    dispatcher.message.register(handle_weekly, Command("weekly"))
+    dispatcher.message.register(handle_monthly, Command("monthly"))
+    dispatcher.message.register(handle_range, Command("range"))
+    dispatcher.message.register(handle_reset_today, Command("reset_today"))
+    dispatcher.message.register(handle_scan_history, Command("scan_history"))
+    dispatcher.message.register(count_messages, F.text & ~F.text.startswith('/'))
+    dispatcher.callback_query.register(handle_top_page, F.data.startswith("top:"))
+    dispatcher.chat_member.register(handle_chat_member)
+    dispatcher.my_chat_member.register(handle_chat_member)
     
-    # Проверка авторизации
-    try:
-        me = await bot_instance.get_me()
-        logger.info(f"Бот успешно авторизован: @{me.username} (ID: {me.id})")
-    except Exception as e:
-        logger.error(f"Ошибка авторизации: {e}")
-        return
+    # Обработчик ошибок
+    @dispatcher.errors()
+    async def errors_handler(update: types.Update, exception: Exception):
+        if not is_shutting_down:
+            logger.error(f"Update {update} caused error: {exception}")
+        return True
     
-    # Настройка планировщика
+    return dispatcher
+
+def create_scheduler():
+    """Планировщик фоновых задач процесса, который обрабатывает чаты"""
     scheduler = AsyncIOScheduler()
-    scheduler_instance = scheduler
+    
+    # Периодическая запись буфера счетчиков
+    scheduler.add_job(
+        timed_job(flush_counters), "interval", seconds=COUNTER_FLUSH_INTERVAL_MS / 1000,
+        max_instances=1, coalesce=True
+    )
+    logger.info(f"Запланирована запись счетчиков каждые {COUNTER_FLUSH_INTERVAL_MS} мс")
+    
+    if counter_journal:
+        scheduler.add_job(
+            timed_job(sync_journal), "interval", seconds=JOURNAL_FSYNC_INTERVAL_MS / 1000,
+            max_instances=1, coalesce=True
+        )
+    
+    # Фоновая сверка счетчиков с историей
+    scheduler.add_job(
+        timed_job(reconcile_counters), "interval", minutes=RECONCILE_INTERVAL_MINUTES,
+        max_instances=1, coalesce=True
+    )
+    logger.info(f"Запланирована сверка счетчиков каждые {RECONCILE_INTERVAL_MINUTES} мин")
+    
+    # Очистка просроченных записей кэшей
+    scheduler.add_job(timed_job(purge_caches), "interval", minutes=1, max_instances=1, coalesce=True)
     
     # Упоминания каждый час
-    scheduler.add_job(send_hourly_mention, "cron", hour="*", minute=0, misfire_grace_time=300)
+    scheduler.add_job(timed_job(send_hourly_mention), "cron", hour="*", minute=0, misfire_grace_time=300)
     logger.info("Запланированы упоминания каждый час")
     
     # Ежедневный отчет в 20:00
-    scheduler.add_job(daily_report, "cron", hour=20, minute=0, misfire_grace_time=300)
+    scheduler.add_job(timed_job(daily_report), "cron", hour=20, minute=0, misfire_grace_time=300)
     logger.info("Запланирован ежедневный отчет в 20:00")
     
     # Автосброс в полночь
-    scheduler.add_job(auto_reset_counters, "cron", hour=0, minute=0, misfire_grace_time=300)
+    scheduler.add_job(timed_job(auto_reset_counters), "cron", hour=0, minute=0, misfire_grace_time=300)
     logger.info("Запланирован автосброс в 00:00")
     
-    # Автосканирование истории раз в день
-    scheduler.add_job(scan_all_messages, "cron", hour=3, minute=0, misfire_grace_time=300)
-    logger.info("Запланировано автосканирование истории в 03:00")
+    # Задачи над всей базой выполняет только один воркер
+    if is_maintenance_process():
+        # Свертка построчной истории в почасовые агрегаты
+        scheduler.add_job(timed_job(compact_history_job), "cron", minute=5, misfire_grace_time=300)
+        logger.info("Запланирована ежечасная свертка истории")
+        
+        # Импорт новых экспортов истории раз в день
+        scheduler.add_job(timed_job(scan_all_messages), "cron", hour=3, minute=0, misfire_grace_time=300)
+        logger.info("Запланировано автосканирование истории в 03:00")
+    
+    return scheduler
+
+async def main():
+    global bot_instance, dp, scheduler_instance, polling_task
+    
+    # Регистрируем обработчики сигналов
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        logger.error("Для режима webhook нужно указать WEBHOOK_URL")
+        return
+    
+    role = process_role()
+    
+    if role == "coordinator":
+        # Миграции выполняются один раз до запуска воркеров
+        await init_storage()
+        await close_storage()
+        await start_workers()
+    else:
+        # Инициализация базы данных
+        await init_storage()
+        await load_chat_registry()
+        await open_journal()
+    
+    # Создание бота и диспетчера
+    bot_instance = create_bot()
+    dp = create_dispatcher()
+    
+    if role == "coordinator":
+        # Координатор не обрабатывает обновления сам, а передает их воркерам
+        dp.update.outer_middleware(route_update)
+    
+    # HTTP-сервер работает в том же event loop, что и бот
+    await start_http_server()
+    logger.info(f"HTTP сервер запущен ({role})")
+    
+    # Регистрация команд бота
+    if role != "worker":
+        try:
+            await bot_instance.set_my_commands([
+                types.BotCommand(command="start", description="🚀 Запустить бота"),
+                types.BotCommand(command="status", description="📊 Статистика чата"),
+                types.BotCommand(command="top", description="🏆 Топ-10 участников"),
+                types.BotCommand(command="mystats", description="📈 Ваша статистика"),
+                types.BotCommand(command="yesterday", description="🗓️ Топ за вчера"),
+                types.BotCommand(command="weekly", description="📅 Статистика за неделю"),
+                types.BotCommand(command="monthly", description="🗓️ Статистика за месяц"),
+                types.BotCommand(command="range", description="📆 Статистика за период"),
+                types.BotCommand(command="reset_today", description="🔄 Сбросить счетчики"),
+                types.BotCommand(command="scan_history", description="🔍 Импортировать историю"),
+                types.BotCommand(command="help", description="❓ Помощь по командам")
+            ])
+            logger.info("Команды бота зарегистрированы")
+        except Exception as e:
+            logger.error(f"Ошибка регистрации команд: {e}")
     
+    # Проверка авторизации
     try:
-        scheduler.start()
-        logger.info("Планировщик запущен")
-        
-        # Тестовый запуск функции упоминаний
-        logger.info("Тестовый запуск функции упоминаний...")
-        await send_hourly_mention()
-        
+        me = await bot_instance.get_me()
+        logger.info(f"Бот успешно авторизован: @{me.username} (ID: {me.id})")
     except Exception as e:
-        logger.error(f"Ошибка запуска планировщика: {e}")
+        logger.error(f"Ошибка авторизации: {e}")
+        return
     
-    # Обработчик ошибок
-    @dp.errors()
-    async def errors_handler(update: types.Update, exception: Exception):
-        if not is_shutting_down:
-            logger.error(f"Update {update} caused error: {exception}")
-        return True
+    # Накопившиеся обновления учитываем до запуска планировщика и приема новых
+    catch_up = role != "worker" and CATCHUP_MAX_AGE_HOURS > 0
+    if catch_up:
+        try:
+            await catch_up_updates()
+        except Exception as e:
+            logger.error(f"Ошибка догоняющего режима: {e}")
+    
+    # Настройка планировщика: у координатора нет своих чатов
+    if role != "coordinator":
+        scheduler_instance = create_scheduler()
+        
+        try:
+            scheduler_instance.start()
+            logger.info("Планировщик запущен")
+            
+            # Тестовый запуск функции упоминаний
+            logger.info("Тестовый запуск функции упоминаний...")
+            await send_hourly_mention()
+            
+        except Exception as e:
+            logger.error(f"Ошибка запуска планировщика: {e}")
     
     try:
         logger.info("Бот запущен и готов к работе...")
@@ -1396,7 +5084,26 @@ async def main():
         logger.info("3. Ежедневные отчеты")
         logger.info("4. Автосброс статистики")
         
-        polling_task = asyncio.create_task(dp.start_polling(bot_instance, skip_updates=True, handle_signals=False))
+        if role == "worker":
+            # Обновления присылает координатор, здесь только ждем завершения
+            polling_task = asyncio.get_running_loop().create_future()
+        elif BOT_MODE == "webhook":
+            # Несколько процессов могут стоять за балансировщиком с одним и тем же URL
+            await bot_instance.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+                drop_pending_updates=not catch_up
+            )
+            logger.info(f"Webhook установлен: {WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH}")
+            
+            # Обновления обрабатывает HTTP-сервер, здесь только ждем завершения
+            polling_task = asyncio.get_running_loop().create_future()
+        else:
+            # Webhook, оставшийся от режима webhook, мешает получать обновления через getUpdates;
+            # без догоняющего режима очередь отбрасывается
+            await bot_instance.delete_webhook(drop_pending_updates=not catch_up)
+            polling_task = asyncio.create_task(dp.start_polling(bot_instance, handle_signals=False))
         await polling_task
     except asyncio.CancelledError:
         logger.info("Получен сигнал отмены")
@@ -1419,7 +5126,16 @@ if __name__ == "__main__":
     loop.set_exception_handler(handle_exception)
     
     try:
-        loop.run_until_complete(main())
+        if "--compact-history" in sys.argv[1:]:
+            loop.run_until_complete(compact_history_command())
+        elif "--worker" in sys.argv[1:]:
+            worker_id = int(os.environ["WORKER_ID"])
+            loop.run_until_complete(main())
+        elif "--import-history" in sys.argv[1:]:
+            paths = sys.argv[sys.argv.index("--import-history") + 1:]
+            loop.run_until_complete(import_history_command(paths))
+        else:
+            loop.run_until_complete(main())
     except KeyboardInterrupt:
         logger.info("Received KeyboardInterrupt, shutting down...")
     except Exception as e:
@@ -0,0 +1,120 @@
+"""Миграции схемы SQLite на базе, созданной версией без миграций.
+
+Запуск: python -m unittest discover tests
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main
+
+def day_offset(days: int) -> datetime:
+    return datetime.now().replace(hour=12, minute=0, second=0, microsecond=0) + timedelta(days=days)
+
+class BaselineMigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "stats.db")
+        
+        # Схема версии 1 совпадает со схемой, которую создавала версия без миграций
+        db = sqlite3.connect(self.path)
+        for statement in main.SCHEMA_MIGRATIONS[0][1]:
+            db.execute(statement)
+        
+        rows = [
+            # user_id, today, yesterday, last_updated
+            (1, 3, 2, day_offset(0).isoformat()),
+            # Вчерашняя строка, полночный сброс не выполнялся
+            (2, 5, 9, day_offset(-1).isoformat()),
+            # Вчерашняя строка после полночного сброса: today уже перенесен в yesterday
+            (3, 0, 4, day_offset(-1).isoformat()),
+            # Строка, не обновлявшаяся несколько дней
+            (4, 7, 1, day_offset(-3).isoformat()),
+            # Строка без даты обновления
+            (5, 2, 0, None),
+        ]
+        db.executemany("""
+            INSERT INTO messages (user_id, chat_id, username, today, yesterday, total, last_updated, first_seen)
+            VALUES (?, -1, 'user', ?, ?, 100, ?, '2026-01-01T00:00:00')
+        """, rows)
+        db.commit()
+        db.close()
+    
+    def tearDown(self):
+        self.directory.cleanup()
+    
+    def migrate(self):
+        db = sqlite3.connect(self.path)
+        self.addCleanup(db.close)
+        main.migrate_database(db)
+        return db
+    
+    def test_migrates_to_latest_version(self):
+        db = self.migrate()
+        
+        self.assertEqual(db.execute("PRAGMA user_version").fetchone()[0], main.SCHEMA_MIGRATIONS[-1][0])
+        # Повторный запуск ничего не применяет
+        main.migrate_database(db)
+        self.assertEqual(db.execute("PRAGMA integrity_check").fetchone()[0], "ok")
+    
+    def test_rows_are_normalized_to_migration_day(self):
+        db = self.migrate()
+        today = main.current_day()
+        
+        rows = db.execute("SELECT user_id, day, today, yesterday, total FROM messages ORDER BY user_id").fetchall()
+        self.assertEqual(rows, [
+            (1, today, 3, 2, 100),
+            (2, today, 0, 5, 100),
+            (3, today, 0, 4, 100),
+            (4, today, 0, 0, 100),
+            (5, today, 2, 0, 100),
+        ])
+    
+    def test_daily_stats_backfill_uses_row_days(self):
+        db = self.migrate()
+        today = main.current_day()
+        yesterday = main.shift_day(today, -1)
+        
+        self.assertEqual(db.execute("""
+            SELECT date, user_id, message_count FROM user_daily_stats ORDER BY date, user_id
+        """).fetchall(), [
+            (yesterday, 1, 2), (yesterday, 2, 5), (yesterday, 3, 4),
+            (today, 1, 3), (today, 5, 2),
+        ])
+        self.assertEqual(db.execute("""
+            SELECT date, total_messages, active_users FROM chat_daily_stats ORDER BY date
+        """).fetchall(), [(yesterday, 11, 3), (today, 5, 2)])
+        self.assertEqual(db.execute("""
+            SELECT user_id, today, day FROM user_totals WHERE user_id = 4
+        """).fetchall(), [(4, 0, today)])
+    
+    def test_totals_before_history_are_seeded_once(self):
+        db = sqlite3.connect(self.path)
+        self.addCleanup(db.close)
+        db.execute("""
+            INSERT INTO all_messages_history (chat_id, user_id, username, message_date, message_count)
+            VALUES (-1, 1, 'user', '2026-01-01T10:00:00', 40)
+        """)
+        db.commit()
+        main.migrate_database(db)
+        
+        # Сверке не остается расхождений: история совпадает с total
+        self.assertEqual(db.execute("""
+            SELECT m.user_id, m.total, (
+                SELECT SUM(message_count) FROM message_history h
+                WHERE h.chat_id = m.chat_id AND h.user_id = m.user_id
+            )
+            FROM messages m WHERE m.user_id IN (1, 2)
+        """).fetchall(), [(1, 100, 100), (2, 100, 100)])
+        self.assertEqual(db.execute("""
+            SELECT message_count FROM message_rollup
+            WHERE user_id = 1 AND hour_bucket = '1970-01-01T00:00:00'
+        """).fetchall(), [(60,)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+"""Кэш готовых ответов команд.
+
+Запуск: python -m unittest discover tests
+"""
+import asyncio
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main
+
+CHAT_ID = -1001234567890
+
+class CachedResponseTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        main.rendered_responses.clear()
+        main.render_requests.clear()
+        main.chat_versions.clear()
+        self.state = {"messages": 10}
+        self.renders = 0
+        self.release = asyncio.Event()
+    
+    async def settle(self):
+        """Дать запущенным задачам дойти до ожидания"""
+        for _ in range(5):
+            await asyncio.sleep(0)
+    
+    async def render(self):
+        # Ответ строится по состоянию на начало построения
+        self.renders += 1
+        messages = self.state["messages"]
+        await self.release.wait()
+        return messages
+    
+    async def test_concurrent_requests_share_render(self):
+        first = asyncio.ensure_future(main.cached_response(CHAT_ID, "top", 0, self.render))
+        second = asyncio.ensure_future(main.cached_response(CHAT_ID, "top", 0, self.render))
+        await self.settle()
+        self.release.set()
+        
+        self.assertEqual(await asyncio.gather(first, second), [10, 10])
+        self.assertEqual(self.renders, 1)
+        # Готовый ответ берется из кэша
+        self.assertEqual(await main.cached_response(CHAT_ID, "top", 0, self.render), 10)
+        self.assertEqual(self.renders, 1)
+    
+    async def test_request_after_reset_does_not_join_old_render(self):
+        before = asyncio.ensure_future(main.cached_response(CHAT_ID, "top", 0, self.render))
+        await self.settle()
+        
+        self.state["messages"] = 0
+        main.clear_chat_cache(CHAT_ID)
+        after = asyncio.ensure_future(main.cached_response(CHAT_ID, "top", 0, self.render))
+        await self.settle()
+        self.release.set()
+        
+        self.assertEqual(await before, 10)
+        self.assertEqual(await after, 0)
+        self.assertEqual(self.renders, 2)
+        self.assertEqual(await main.cached_response(CHAT_ID, "top", 0, self.render), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+"""Рассылка с учетом лимитов Bot API.
+
+Запуск: python -m unittest discover tests
+"""
+import sys
+import types as pytypes
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main
+from aiogram.exceptions import TelegramRetryAfter
+
+class FloodBot:
+    """Первая отправка получает RetryAfter, остальные проходят"""
+    
+    def __init__(self):
+        self.sent = []
+    
+    async def send_message(self, chat_id, text, **kwargs):
+        if not self.sent:
+            self.sent.append(None)
+            raise TelegramRetryAfter(method=None, message="flood", retry_after=2)
+        self.sent.append(chat_id)
+        return pytypes.SimpleNamespace(message_id=len(self.sent))
+
+class SendLimitedTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.bucket = main.TokenBucket(100, 100)
+        self.sleeps = []
+        
+        async def sleep(seconds):
+            self.sleeps.append(seconds)
+        
+        for patcher in (
+            mock.patch.object(main, "bot_instance", FloodBot()),
+            mock.patch.object(main, "global_send_bucket", self.bucket),
+            mock.patch.object(main.asyncio, "sleep", sleep),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        main.chat_send_buckets.clear()
+    
+    async def test_retry_after_pauses_whole_bot(self):
+        with self.assertLogs(main.logger, "WARNING"):
+            await main.send_limited(-1, "текст")
+        
+        # Следующая отправка в другой чат ждет окончания ожидания
+        self.sleeps.clear()
+        await main.send_limited(-2, "текст")
+        self.assertEqual(main.bot_instance.sent, [None, -1, -2])
+        self.assertTrue(self.sleeps)
+        self.assertGreater(max(self.sleeps), 1.5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,245 @@
+"""Хранилище SQLite: запись буфера, рейтинги, журнал счетчиков и импорт истории.
+
+Каждый тест работает со своей временной базой.
+Запуск: python -m unittest discover tests
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main
+from aiogram import types
+
+CHAT_ID = -1001234567890
+
+def make_message(user_id: int, chat_id: int = CHAT_ID, message_time: datetime = None) -> types.Message:
+    return types.Message(
+        message_id=1,
+        date=message_time or datetime.now(),
+        chat=types.Chat(id=chat_id, type="supergroup", title="Группа"),
+        from_user=types.User(id=user_id, is_bot=False, first_name=f"Участник {user_id}"),
+        text="привет",
+    )
+
+class SQLiteTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = (main.STORAGE_BACKEND, main.DB_PATH, main.JOURNAL_PATH)
+        main.STORAGE_BACKEND = "sqlite"
+        main.DB_PATH = os.path.join(self.directory.name, "stats.db")
+        main.JOURNAL_PATH = os.path.join(self.directory.name, "counters.journal")
+        self.reset_memory()
+        await main.init_storage()
+        await main.load_chat_registry()
+    
+    async def asyncTearDown(self):
+        self.crash()
+        await main.close_storage()
+        main.STORAGE_BACKEND, main.DB_PATH, main.JOURNAL_PATH = self.settings
+        self.directory.cleanup()
+    
+    def reset_memory(self):
+        main.pending_counters.clear()
+        main.pending_history.clear()
+        main.pending_chat_activity.clear()
+        main.pending_profiles.clear()
+        main.leaderboards.clear()
+        main.user_profiles.clear()
+        main.chat_registry.clear()
+    
+    def crash(self):
+        """Потерять все, что процесс держал в памяти"""
+        if main.counter_journal:
+            main.counter_journal.close()
+            main.counter_journal = None
+        self.reset_memory()
+    
+    async def record(self, user_id: int, count: int, message_time: datetime = None):
+        for _ in range(count):
+            await main.record_message(make_message(user_id), message_time or datetime.now())
+    
+    async def user_total(self, user_id: int):
+        row = await main.storage.get_user_stats(CHAT_ID, user_id, main.current_day())
+        return row[3] if row else 0
+    
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory.name) if name.startswith("counters.journal"))
+
+class FlushAndLeaderboardTest(SQLiteTestCase):
+    async def test_leaderboard_reload_matches_flushed_counters(self):
+        await self.record(1, 2)
+        await self.record(2, 5)
+        await self.record(3, 1, datetime.now() - timedelta(days=1))
+        await main.flush_counters()
+        
+        board = await main.get_leaderboard(CHAT_ID)
+        self.assertEqual([member['user_id'] for member in board.top(10)], [2, 1, 3])
+        
+        # Следующая пачка применяется к загруженному рейтингу по месту
+        await self.record(1, 4)
+        await self.record(4, 1)
+        await main.flush_counters()
+        self.assertEqual([member['user_id'] for member in board.top(10)], [1, 2, 4, 3])
+        
+        main.leaderboards.clear()
+        reloaded = await main.get_leaderboard(CHAT_ID)
+        summary = lambda leaderboard: [
+            (member['user_id'], member['today'], member['yesterday'], member['total'])
+            for member in leaderboard.top(10)
+        ]
+        self.assertEqual(summary(reloaded), summary(board))
+        self.assertEqual((reloaded.today_sum, reloaded.total_sum, reloaded.active_count), (12, 13, 3))
+        self.assertEqual(reloaded.rank(3), 4)
+    
+    async def test_daily_stats_follow_flushes(self):
+        await self.record(1, 3)
+        await main.flush_counters()
+        await self.record(2, 4)
+        await main.flush_counters()
+        
+        rows = await main.storage.period_stats(CHAT_ID, main.current_day(), main.current_day())
+        self.assertEqual([tuple(row) for row in rows], [(main.current_day(), 7, 2)])
+
+class ChatRegistrationTest(SQLiteTestCase):
+    async def test_messages_before_bot_stop_at_registration(self):
+        # История чата, записанная до того, как бот его зарегистрировал
+        for _ in range(3):
+            main.buffer_message(CHAT_ID, 1, "Участник 1", datetime.now() - timedelta(days=2))
+        await main.flush_counters()
+        
+        await self.record(2, 1)
+        await main.flush_counters()
+        await asyncio.gather(*main.background_tasks)
+        
+        self.assertEqual(await main.storage.get_messages_before_bot(CHAT_ID), 3)
+        self.assertFalse(main.background_tasks)
+
+class JournalTest(SQLiteTestCase):
+    async def test_replay_after_crash(self):
+        await main.open_journal()
+        await self.record(1, 3)
+        await main.flush_counters()
+        
+        # Сообщения после последней записи есть только в журнале
+        await self.record(1, 2)
+        await self.record(2, 4)
+        await main.counter_journal.sync()
+        self.crash()
+        
+        await main.open_journal()
+        self.assertEqual((await self.user_total(1), await self.user_total(2)), (5, 4))
+        self.assertEqual(self.segments(), [])
+    
+    async def test_segment_committed_before_crash_is_not_replayed(self):
+        await main.open_journal()
+        await self.record(1, 3)
+        # Сбой между фиксацией пачки и удалением ее сегмента
+        main.counter_journal.release = lambda segment: None
+        await main.flush_counters()
+        self.assertTrue(self.segments())
+        self.crash()
+        
+        await main.open_journal()
+        self.assertEqual(await self.user_total(1), 3)
+        self.assertEqual(self.segments(), [])
+    
+    async def test_failed_replay_is_not_applied_twice(self):
+        await main.open_journal()
+        await self.record(1, 5)
+        await main.counter_journal.sync()
+        self.crash()
+        
+        write_counters = main.storage.write_counters
+        
+        async def fail(*args):
+            raise RuntimeError("БД недоступна")
+        
+        main.storage.write_counters = fail
+        with self.assertLogs(main.logger, "ERROR"):
+            await main.open_journal()
+        main.storage.write_counters = write_counters
+        self.crash()
+        
+        await main.open_journal()
+        self.assertEqual(await self.user_total(1), 5)
+    
+    async def test_torn_record_is_skipped(self):
+        await main.open_journal()
+        await self.record(1, 2)
+        await main.counter_journal.sync()
+        path = main.counter_journal.segment_path(main.counter_journal.segment)
+        self.crash()
+        with open(path, "ab") as journal_file:
+            journal_file.write(b"\x01\x02\x03")
+        
+        with self.assertLogs(main.logger, "WARNING"):
+            await main.open_journal()
+        self.assertEqual(await self.user_total(1), 2)
+
+class HistoryImportTest(SQLiteTestCase):
+    def write_export(self, count: int) -> Path:
+        base = datetime.now() - timedelta(days=3)
+        messages = [
+            {"id": index, "type": "message",
+             "date": (base + timedelta(minutes=index)).strftime('%Y-%m-%dT%H:%M:%S'),
+             "from": f"Участник {index % 3}", "from_id": f"user{index % 3 + 1}", "text": "привет"}
+            for index in range(1, count + 1)
+        ]
+        export = {"chats": {"list": [{"name": "Группа", "type": "private_supergroup",
+                                       "id": 1234567890, "messages": messages}]}}
+        path = Path(self.directory.name) / "result.json"
+        path.write_text(json.dumps(export, ensure_ascii=False), encoding="utf-8")
+        return path
+    
+    async def imported_total(self):
+        row = await main.db_fetchone("SELECT SUM(total) FROM messages WHERE chat_id = ?", (CHAT_ID,))
+        return row[0] or 0
+    
+    async def test_resume_after_interrupted_batch(self):
+        path = self.write_export(20)
+        batch_size = main.IMPORT_BATCH_MESSAGES
+        main.IMPORT_BATCH_MESSAGES = 6
+        self.addCleanup(setattr, main, "IMPORT_BATCH_MESSAGES", batch_size)
+        
+        write_import_batch = main.storage.write_import_batch
+        written = []
+        
+        async def interrupt(*args):
+            # Первая пачка записывается, вторая обрывается до фиксации
+            if written:
+                raise RuntimeError("процесс остановлен")
+            written.append(args)
+            await write_import_batch(*args)
+        
+        main.storage.write_import_batch = interrupt
+        with self.assertRaises(RuntimeError):
+            await main.import_history_file(path)
+        main.storage.write_import_batch = write_import_batch
+        self.assertEqual(await self.imported_total(), 6)
+        
+        state = await main.storage.get_import_state(str(path.resolve()))
+        self.assertEqual((state[2], state[3], state[4]), (CHAT_ID, 6, "running"))
+        
+        self.assertEqual(await main.import_history_file(path), 14)
+        self.assertEqual(await self.imported_total(), 20)
+        # Завершенный импорт повторно ничего не добавляет
+        self.assertEqual(await main.import_history_file(path), 0)
+        self.assertEqual(await self.imported_total(), 20)
+    
+    async def test_changed_file_skips_imported_messages(self):
+        path = self.write_export(10)
+        self.assertEqual(await main.import_history_file(path), 10)
+        
+        # Новый экспорт того же чата: учитываются только сообщения после уже импортированных
+        path = self.write_export(15)
+        self.assertEqual(await main.import_history_file(path), 5)
+        self.assertEqual(await self.imported_total(), 15)
+
+if __name__ == "__main__":
+    unittest.main()
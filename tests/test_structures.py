@@ -0,0 +1,133 @@
+"""Структуры в памяти: OrderIndex, ChatLeaderboard, LRUCache и HashRing.
+
+Запуск: python -m unittest discover tests
+"""
+import random
+import sys
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main
+
+class OrderIndexTest(unittest.TestCase):
+    def test_matches_sorted_list(self):
+        rng = random.Random(7)
+        index = main.OrderIndex()
+        index.load = 4  # мелкие блоки, чтобы проверить деление и удаление блоков
+        expected = []
+        
+        for step in range(2000):
+            if expected and rng.random() < 0.4:
+                key = expected.pop(rng.randrange(len(expected)))
+                index.remove(key)
+            else:
+                key = (rng.randrange(-50, 0), rng.randrange(-50, 0), step)
+                index.add(key)
+                expected.append(key)
+            expected.sort()
+            
+            if step % 50 == 0:
+                self.assertEqual(len(index), len(expected))
+                self.assertEqual(index.slice(0, len(expected)), expected)
+                if expected:
+                    probe = expected[rng.randrange(len(expected))]
+                    self.assertEqual(index.index(probe), expected.index(probe))
+                    start = rng.randrange(len(expected))
+                    self.assertEqual(index.slice(start, start + 7), expected[start:start + 7])
+
+class ChatLeaderboardTest(unittest.TestCase):
+    today = "2026-10-18"
+    
+    def make_board(self):
+        board = main.ChatLeaderboard(0)
+        board.load([
+            (1, "a", 5, 2, 10, self.today),
+            (2, "b", 3, 0, 30, self.today),
+            # Строка позавчерашнего дня приводится к текущему
+            (3, "c", 9, 1, 9, "2026-10-16"),
+        ], self.today)
+        return board
+    
+    def test_load_orders_by_today_then_total(self):
+        board = self.make_board()
+        self.assertEqual([member['user_id'] for member in board.top(10)], [1, 2, 3])
+        self.assertEqual(board.members[3]['today'], 0)
+        self.assertEqual(board.members[3]['yesterday'], 0)
+        self.assertEqual((board.today_sum, board.total_sum, board.active_count), (8, 49, 2))
+    
+    def test_apply_moves_member(self):
+        board = self.make_board()
+        board.apply(2, "b", 4, self.today)
+        self.assertEqual([member['user_id'] for member in board.top(10)], [2, 1, 3])
+        self.assertEqual(board.rank(1), 2)
+        self.assertEqual((board.today_sum, board.total_sum), (12, 53))
+    
+    def test_new_member_from_earlier_day_is_not_counted_today(self):
+        board = self.make_board()
+        self.assertTrue(board.apply(4, "d", 6, "2026-10-17"))
+        member = board.members[4]
+        self.assertEqual((member['today'], member['yesterday'], member['total']), (0, 6, 6))
+        self.assertEqual(board.active_count, 2)
+    
+    def test_backlog_applied_after_load(self):
+        board = main.ChatLeaderboard(0)
+        self.assertFalse(board.apply(1, "a", 2, self.today))
+        board.load([(1, "a", 5, 0, 10, self.today)], self.today)
+        self.assertEqual((board.members[1]['today'], board.members[1]['total']), (7, 12))
+
+class LRUCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = main.LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual((cache.peek("a"), cache.peek("b"), cache.peek("c")), (1, None, 3))
+        self.assertEqual(cache.stats()["evictions"], 1)
+    
+    def test_byte_limit(self):
+        cache = main.LRUCache(10, max_bytes=100, sizeof=lambda value: value)
+        cache.set("a", 60)
+        cache.set("b", 30)
+        cache.set("c", 30)
+        self.assertEqual(list(cache.entries), ["b", "c"])
+        self.assertEqual(cache.total_bytes, 60)
+    
+    def test_ttl_and_sliding_expiration(self):
+        now = [1000.0]
+        with mock.patch.object(main.time, "monotonic", lambda: now[0]):
+            cache = main.LRUCache(10, ttl=10, sliding=True)
+            cache.set("a", 1)
+            now[0] += 8
+            self.assertEqual(cache.get("a"), 1)
+            now[0] += 8
+            # Чтение продлило запись
+            self.assertEqual(cache.get("a"), 1)
+            now[0] += 11
+            self.assertIsNone(cache.get("a"))
+            self.assertEqual(cache.stats()["expirations"], 1)
+
+class HashRingTest(unittest.TestCase):
+    def test_routing_is_stable_and_balanced(self):
+        ring = main.HashRing(range(4))
+        chats = [-1000000000000 - chat for chat in range(4000)]
+        owners = [ring.owner(chat_id) for chat_id in chats]
+        
+        self.assertEqual(owners, [main.HashRing(range(4)).owner(chat_id) for chat_id in chats])
+        for node in range(4):
+            self.assertGreater(owners.count(node), 600)
+    
+    def test_adding_worker_moves_few_chats(self):
+        chats = [-1000000000000 - chat for chat in range(4000)]
+        before = main.HashRing(range(4))
+        after = main.HashRing(range(5))
+        moved = [chat_id for chat_id in chats if before.owner(chat_id) != after.owner(chat_id)]
+        
+        # Переезжают только чаты нового воркера
+        self.assertTrue(all(after.owner(chat_id) == 4 for chat_id in moved))
+        self.assertLess(len(moved), len(chats) * 0.3)
+
+if __name__ == "__main__":
+    unittest.main()